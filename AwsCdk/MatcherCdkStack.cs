@@ -154,16 +154,64 @@ public sealed class MatcherCdkStack : Stack
             min_episode_number = 2,
             episodes_to_match = 5,
             seconds_to_match = 6 * 60,
+            progressive_matching = false,
+            progressive_initial_secs = 120,
+            progressive_edge_margin_secs = 5,
+            progressive_duration_tolerance_secs = 5,
+            scene_priors = false,
+            scene_prior_margin_secs = 15,
+            segment_digest_matching = false,
+            analysis_sample_rate = 44100,
+            analysis_sample_format = "int16",
             notification_queue_url = videoRegisteredQueue.QueueUrl,
             get_series_to_match_lambda_name = config.GetSeriesToMatchLambdaName,
             update_video_scenes_lambda_name = config.UpdateVideoScenesLambdaName,
             temp_dir = "/tmp",
+            cache_dir = "/tmp/cache",
+            streaming_decode = false,
+            incremental_matching = false,
+            match_requested_only = false,
+            // The caches persist in cache_dir between the batches, enable them only on hosts with the disk for them.
+            segments_cache_max_bytes = 0,
+            decoded_audio_cache_max_bytes = 0,
+            fingerprints_cache_max_bytes = 0,
+            scene_priors_cache_max_bytes = 64L * 1024 * 1024,
+            playlist_fetch_threads = 8,
             download_threads = 12,
+            adaptive_download_threads = true,
+            download_threads_min = 2,
+            download_threads_max = 48,
+            parallel_groups = 1,
+            pipelined_intake = false,
+            intake_prefetch_episodes = 2,
+            group_download_threads = 0,
+            http_max_connections = 100,
+            http_max_connections_per_host = 0,
+            http_dns_cache_ttl_secs = 300,
+            http_keepalive_timeout_secs = 60,
             download_max_retries_for_ts = 3,
+            episode_download_retries = 1,
+            download_retry_base_delay_secs = 1,
+            download_retry_max_delay_secs = 30,
+            segment_timeout_secs = 60,
+            segment_hedging = true,
+            segment_hedge_min_delay_secs = 2,
+            prefetch_depth = 1,
+            prefetch_workers = 1,
+            decode_workers = 0,
+            max_rss_bytes = 0,
+            max_temp_disk_bytes = 0,
+            resource_soft_limit_ratio = 0.8,
+            prefetch_min_free_disk_bytes = 1024L * 1024 * 1024,
+            prefetch_min_free_memory_bytes = 512L * 1024 * 1024,
+            metrics_export = "emf",
+            metrics_namespace = "Bounan/Matcher",
             scene_after_opening_threshold_secs = 4,
             min_scene_length_secs = 20,
             operating_log_rate_per_minute = 1,
             batch_size = 10,
+            // The context episodes are downloaded again without the fingerprints cache, enable it together with the cache.
+            overlapping_batches = false,
         };
 
         var json = JsonConvert.SerializeObject(runtimeConfig, Formatting.Indented);
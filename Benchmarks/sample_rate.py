@@ -0,0 +1,127 @@
+"""
+Measures the accuracy/throughput trade-off of the analysis sample rate and sample format.
+
+Every configuration is run in a fresh process over the same synthetic episodes served by a local HLS server
+and compared with the reference configuration (44.1 kHz, int16), which matches the previous hardcoded behaviour.
+Run with: python -m Benchmarks.sample_rate
+"""
+import logging
+import math
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from Benchmarks.synthetic_hls import SyntheticEpisode, HlsServer, generate_episodes, install_loan_api_stand_in
+from Common.py.models import Scenes
+from Matcher.config.config import Config
+from Matcher.helpers import pre_request
+from Matcher.scenes_finder.find_scenes import find_scenes
+
+logger = logging.getLogger(__name__)
+
+EPISODES = 10
+EPISODE_DURATION_SECS = 24 * 60
+
+REFERENCE_CONFIGURATION = (44100, 'int16')
+CONFIGURATIONS: list[tuple[int, str]] = [
+    REFERENCE_CONFIGURATION,
+    (44100, 'float32'),
+    (22050, 'int16'),
+    (16000, 'int16'),
+    (16000, 'float32'),
+    (11025, 'int16'),
+    (8000, 'int16'),
+]
+
+BASE_CONFIGURATION: dict[str, str] = {
+    # The caches would hide the decoding cost.
+    'segments_cache_max_bytes': '0',
+    'decoded_audio_cache_max_bytes': '0',
+    'fingerprints_cache_max_bytes': '0',
+}
+
+# Boundaries closer than this to the reference are considered equal.
+TOLERANCE_SECS = 2.0
+
+
+def _run(episodes: list[SyntheticEpisode],
+         base_url: str,
+         sample_rate: int,
+         sample_format: str) -> tuple[float, list[Scenes]]:
+    """
+    Finds the scenes of all episodes as a single group. Executed in a separate process.
+    :return: Wall time and the found scenes in the episodes order
+    """
+    # Environment variables take precedence over the configuration and are inherited by the worker processes.
+    os.environ.update({**BASE_CONFIGURATION,
+                       'analysis_sample_rate': str(sample_rate),
+                       'analysis_sample_format': sample_format})
+
+    Config.initialize_from_dict({'temp_dir': os.path.join(tempfile.gettempdir(), 'matcher_benchmark')})
+    logging.basicConfig(level=logging.INFO)
+    install_loan_api_stand_in(base_url, episodes)
+
+    # The benchmark runs offline, so the worker processes must not log to CloudWatch.
+    pre_request.setup_logging = lambda: logging.basicConfig(level=logging.INFO)  # type: ignore
+
+    started_at = time.time()
+    scenes = [scenes for _, scenes in find_scenes([episode.video for episode in episodes])]  # type: ignore
+    return time.time() - started_at, scenes
+
+
+def _get_boundaries(scenes: Scenes) -> list[float]:
+    boundaries = []
+    for scene in (scenes.opening, scenes.ending):
+        boundaries.extend([scene.start, scene.end] if scene is not None else [math.nan, math.nan])
+    return boundaries
+
+
+def _compare(reference: list[Scenes], actual: list[Scenes]) -> tuple[float, float]:
+    """
+    :return: Share of boundaries that match the reference and mean absolute error of the matched ones
+    """
+    errors = []
+    matched = 0
+    total = 0
+    for reference_scenes, actual_scenes in zip(reference, actual):
+        for expected, found in zip(_get_boundaries(reference_scenes), _get_boundaries(actual_scenes)):
+            total += 1
+            if math.isnan(expected) and math.isnan(found):
+                matched += 1
+            elif not math.isnan(expected) and not math.isnan(found) and abs(expected - found) <= TOLERANCE_SECS:
+                matched += 1
+                errors.append(abs(expected - found))
+
+    mean_error = sum(errors) / len(errors) if errors else math.nan
+    return matched / total if total else math.nan, mean_error
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    Config.initialize_from_dict({})
+
+    directory = os.path.join(tempfile.gettempdir(), 'matcher_benchmark_episodes')
+    episodes = generate_episodes(directory, EPISODES, EPISODE_DURATION_SECS)
+
+    results: dict[tuple[int, str], tuple[float, list[Scenes]]] = {}
+    with HlsServer(directory) as server:
+        for sample_rate, sample_format in CONFIGURATIONS:
+            logger.info(f"Benchmarking {sample_rate} Hz {sample_format}...")
+            # A fresh process per configuration, so the environment of the previous one does not leak.
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                results[(sample_rate, sample_format)] = executor.submit(
+                    _run, episodes, server.base_url, sample_rate, sample_format).result()
+
+    _, reference_scenes = results[REFERENCE_CONFIGURATION]
+    print(f"{'rate':>6} {'format':>8} {'secs/episode':>13} {'speedup':>8} {'match':>6} {'mae, s':>7}")
+    reference_elapsed, _ = results[REFERENCE_CONFIGURATION]
+    for (sample_rate, sample_format), (elapsed, scenes) in results.items():
+        match_rate, mean_error = _compare(reference_scenes, scenes)
+        print(f"{sample_rate:>6} {sample_format:>8} {elapsed / len(episodes):>13.2f} "
+              f"{reference_elapsed / elapsed:>8.2f} {match_rate:>6.1%} {mean_error:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+Synthetic episodes with a shared opening and ending, served as HLS by a local HTTP server.
+Stands in for LoanApi in the offline benchmarks, so the whole pipeline runs without the CDN.
+"""
+import functools
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass, asdict
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from typing import Any
+
+import ffmpeg  # type: ignore
+import m3u8
+import numpy as np
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Low rate keeps the generation fast, the matcher resamples the audio to its analysis rate anyway.
+GENERATION_RATE = 16000
+OPENING_DURATION_SECS = 90
+ENDING_DURATION_SECS = 90
+SEGMENT_DURATION_SECS = 10
+
+MY_ANIME_LIST_ID = 1
+DUB = 'Synthetic'
+
+
+@dataclass
+class SyntheticVideo:
+    """Stand-in for LoanApi's AvailableVideo with the fields used by the matcher."""
+    id: int
+    my_anime_list_id: int
+    dub: str
+    episode: int
+
+
+@dataclass
+class SyntheticEpisode:
+    video: SyntheticVideo
+    duration: float
+    opening: tuple[float, float]
+    ending: tuple[float, float]
+
+
+def generate_episodes(directory: str, count: int, duration_secs: int, seed: int = 0) -> list[SyntheticEpisode]:
+    """
+    Generates the episodes into the directory or reuses the ones generated before with the same parameters.
+    Each episode is unique noise with the same opening and ending noise patterns inserted at random offsets.
+    """
+    manifest_path = os.path.join(directory, 'episodes.json')
+    parameters = {'count': count, 'duration_secs': duration_secs, 'seed': seed,
+                  'rate': GENERATION_RATE, 'segment_duration_secs': SEGMENT_DURATION_SECS}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest['parameters'] == parameters:
+            return [_episode_from_dict(episode) for episode in manifest['episodes']]
+
+    rng = np.random.default_rng(seed)
+    opening_pattern = _generate_noise(rng, OPENING_DURATION_SECS)
+    ending_pattern = _generate_noise(rng, ENDING_DURATION_SECS)
+
+    episodes: list[SyntheticEpisode] = []
+    for episode in range(1, count + 1):
+        # Some episodes start with the opening, the others have a cold open before it.
+        opening_start = 0 if rng.random() < 0.3 else int(rng.integers(10, 120))
+        # Some episodes end with the ending, the others have a scene after it.
+        ending_end = duration_secs - (0 if rng.random() < 0.5 else int(rng.integers(10, 60)))
+
+        audio = _generate_noise(rng, duration_secs)
+        _insert(audio, opening_pattern, opening_start)
+        _insert(audio, ending_pattern, ending_end - ENDING_DURATION_SECS)
+
+        episode_dir = os.path.join(directory, str(episode))
+        _encode_hls(audio, episode_dir)
+
+        playlist = m3u8.load(os.path.join(episode_dir, 'index.m3u8'))
+        episodes.append(SyntheticEpisode(
+            video=SyntheticVideo(episode, MY_ANIME_LIST_ID, DUB, episode),
+            duration=sum(segment.duration for segment in playlist.segments),
+            opening=(opening_start, opening_start + OPENING_DURATION_SECS),
+            ending=(ending_end - ENDING_DURATION_SECS, ending_end)))
+        logger.info(f"Generated episode {episode}/{count}")
+
+    with open(manifest_path, 'w') as f:
+        json.dump({'parameters': parameters, 'episodes': [asdict(episode) for episode in episodes]}, f)
+
+    return episodes
+
+
+class HlsServer:
+    """
+    Serves the generated episodes over HTTP in a background thread and counts the sent bytes.
+    """
+
+    _server: ThreadingHTTPServer
+    _thread: threading.Thread
+    _lock: threading.Lock
+    _bytes_sent: int = 0
+
+    def __init__(self, directory: str):
+        self._lock = threading.Lock()
+        handler = functools.partial(_CountingHandler, self._add_bytes_sent, directory=directory)
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name='hls-server', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        logger.info(f"Serving episodes at {self.base_url}")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{str(host)}:{port}'
+
+    @property
+    def bytes_sent(self) -> int:
+        with self._lock:
+            return self._bytes_sent
+
+    def _add_bytes_sent(self, value: int) -> None:
+        with self._lock:
+            self._bytes_sent += value
+
+
+class _CountingHandler(SimpleHTTPRequestHandler):
+    def __init__(self, add_bytes_sent, *args: Any, **kwargs: Any):
+        self._add_bytes_sent = add_bytes_sent
+        super().__init__(*args, **kwargs)
+
+    def copyfile(self, source, outputfile) -> None:
+        while chunk := source.read(64 * 1024):
+            outputfile.write(chunk)
+            self._add_bytes_sent(len(chunk))
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+# State of the LoanApi stand-in, set by install_loan_api_stand_in.
+_base_url: str = ''
+_videos: list[SyntheticVideo] = []
+
+
+def install_loan_api_stand_in(base_url: str, episodes: list[SyntheticEpisode]) -> None:
+    """
+    Replaces LoanApi's get_playlist and get_available_videos in the matcher modules with the local server.
+    """
+    global _base_url, _videos
+    _base_url = base_url
+    _videos = [episode.video for episode in episodes]
+
+    import Matcher.main
+    import Matcher.scenes_finder.find_scenes
+    Matcher.main.get_available_videos = get_available_videos  # type: ignore
+    Matcher.scenes_finder.find_scenes.get_playlist = get_playlist  # type: ignore
+
+
+def get_available_videos(_token: str, my_anime_list_id: int, dub: str) -> list[SyntheticVideo]:
+    return [video for video in _videos
+            if video.my_anime_list_id == my_anime_list_id and video.dub == dub]
+
+
+def get_playlist(video: SyntheticVideo) -> str:
+    """Returns the playlist with absolute segment URIs, the same as the CDN playlists."""
+    uri = f'{_base_url}/{video.episode}/index.m3u8'
+    response = requests.get(uri, timeout=30)
+    response.raise_for_status()
+
+    playlist = m3u8.loads(response.text, uri=uri)
+    for segment in playlist.segments:
+        segment.uri = segment.absolute_uri
+    return playlist.dumps()
+
+
+def _generate_noise(rng: np.random.Generator, duration_secs: int) -> np.ndarray:
+    return (rng.standard_normal(duration_secs * GENERATION_RATE) * 3000).astype(np.int16)
+
+
+def _insert(audio: np.ndarray, pattern: np.ndarray, start_secs: int) -> None:
+    start = start_secs * GENERATION_RATE
+    audio[start:start + pattern.shape[0]] = pattern
+
+
+def _encode_hls(audio: np.ndarray, directory: str) -> None:
+    os.makedirs(directory, exist_ok=True)
+    (ffmpeg
+     .input('pipe:0', format='s16le', ac=1, ar=GENERATION_RATE)
+     .output(os.path.join(directory, 'index.m3u8'), acodec='aac', audio_bitrate='64k', format='hls',
+             hls_time=SEGMENT_DURATION_SECS, hls_playlist_type='vod', hls_segment_type='mpegts',
+             hls_segment_filename=os.path.join(directory, 'seg%03d.ts'), loglevel="quiet")
+     .overwrite_output()
+     .run(input=audio.tobytes()))
+
+
+def _episode_from_dict(data: dict[str, Any]) -> SyntheticEpisode:
+    return SyntheticEpisode(video=SyntheticVideo(**data['video']),
+                            duration=data['duration'],
+                            opening=tuple(data['opening']),  # type: ignore
+                            ending=tuple(data['ending']))  # type: ignore
@@ -0,0 +1,156 @@
+"""
+Measures the end-to-end throughput of the matcher on synthetic episodes served by a local HLS server.
+
+Every configuration is run in a fresh process over the same episodes with cold caches and reports
+the wall time, the bytes sent by the server, the peak RSS and the accuracy of the found scenes.
+Run with: python -m Benchmarks.throughput
+"""
+import logging
+import math
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import Matcher.main
+from Benchmarks.synthetic_hls import SyntheticEpisode, HlsServer, generate_episodes, install_loan_api_stand_in
+from Common.py.models import VideoKey, MatcherResultRequest, Interval
+from Matcher.clients import animan_client
+from Matcher.config.config import Config
+from Matcher.helpers import pre_request
+
+logger = logging.getLogger(__name__)
+
+EPISODES = 12
+EPISODE_DURATION_SECS = 24 * 60
+
+# Overrides of the base configuration below.
+CONFIGURATIONS: list[dict[str, str]] = [
+    {},
+    {'download_threads': '4'},
+    {'download_threads': '24'},
+    {'batch_size': '5'},
+    {'batch_size': '20'},
+    {'seconds_to_match': '240'},
+]
+
+BASE_CONFIGURATION: dict[str, str] = {
+    'min_episode_number': '2',
+    'download_threads': '12',
+    'batch_size': '10',
+    'seconds_to_match': '360',
+    # Every run has to download and decode the episodes.
+    'segments_cache_max_bytes': '0',
+    'decoded_audio_cache_max_bytes': '0',
+    'fingerprints_cache_max_bytes': '0',
+}
+
+# Boundaries closer than this to the generated ones are considered found.
+TOLERANCE_SECS = 2.0
+
+type _Boundaries = dict[int, list[float]]
+
+
+def _run(episodes: list[SyntheticEpisode], base_url: str, overrides: dict[str, str]) -> tuple[float, _Boundaries, int]:
+    """
+    Processes all episodes as a single forced request. Executed in a separate process.
+    :return: Wall time, found boundaries by episode and peak RSS in bytes
+    """
+    # Environment variables take precedence over the configuration and are inherited by the worker processes.
+    os.environ.update({**BASE_CONFIGURATION, **overrides})
+
+    Config.initialize_from_dict({'temp_dir': os.path.join(tempfile.gettempdir(), 'matcher_benchmark')})
+    logging.basicConfig(level=logging.INFO)
+    install_loan_api_stand_in(base_url, episodes)
+
+    # The benchmark runs offline, so the worker processes must not log to CloudWatch.
+    pre_request.setup_logging = lambda: logging.basicConfig(level=logging.INFO)  # type: ignore
+
+    found: _Boundaries = {}
+
+    def update_video_scenes(data: MatcherResultRequest) -> None:
+        for item in data.items:
+            scenes = item.scenes
+            found[item.video_key.episode] = _get_boundaries(scenes.opening if scenes else None,
+                                                            scenes.ending if scenes else None)
+
+    animan_client.update_video_scenes = update_video_scenes  # type: ignore
+
+    videos_to_match = [VideoKey(episode.video.my_anime_list_id, episode.video.dub, episode.video.episode)
+                       for episode in episodes]
+    started_at = time.time()
+    Matcher.main._process_videos(videos_to_match, force=True)
+    elapsed = time.time() - started_at
+
+    # ru_maxrss is in kilobytes on Linux. The children are the prefetch workers.
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+    return elapsed, found, peak_rss
+
+
+def _get_boundaries(opening: Interval | None, ending: Interval | None) -> list[float]:
+    boundaries = []
+    for scene in (opening, ending):
+        boundaries.extend([scene.start, scene.end] if scene is not None else [math.nan, math.nan])
+    return boundaries
+
+
+def _get_expected_boundaries(episode: SyntheticEpisode, threshold_secs: float) -> list[float]:
+    """Applies the same extensions to the generated scenes as find_scenes does to the found ones."""
+    opening_start, opening_end = episode.opening
+    ending_start, ending_end = episode.ending
+    if opening_start < threshold_secs:
+        opening_start = 0
+    if episode.duration - ending_end <= threshold_secs:
+        ending_end = episode.duration
+    return [opening_start, opening_end, ending_start, ending_end]
+
+
+def _compare(episodes: list[SyntheticEpisode], found: _Boundaries) -> tuple[float, float]:
+    """
+    :return: Share of the generated boundaries that were found and mean absolute error of the found ones
+    """
+    errors = []
+    total = 0
+    for episode in episodes:
+        expected = _get_expected_boundaries(episode, Config.scene_after_opening_threshold_secs)
+        actual = found.get(episode.video.episode, [math.nan] * len(expected))
+        for expected_boundary, actual_boundary in zip(expected, actual):
+            total += 1
+            if not math.isnan(actual_boundary) and abs(expected_boundary - actual_boundary) <= TOLERANCE_SECS:
+                errors.append(abs(expected_boundary - actual_boundary))
+
+    mean_error = sum(errors) / len(errors) if errors else math.nan
+    return len(errors) / total if total else math.nan, mean_error
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    Config.initialize_from_dict({})
+
+    directory = os.path.join(tempfile.gettempdir(), 'matcher_benchmark_episodes')
+    episodes = generate_episodes(directory, EPISODES, EPISODE_DURATION_SECS)
+
+    results: list[tuple[dict[str, str], float, int, int, float, float]] = []
+    with HlsServer(directory) as server:
+        for overrides in CONFIGURATIONS:
+            logger.info(f"Benchmarking {overrides or 'base configuration'}...")
+            bytes_before = server.bytes_sent
+            # A fresh process per configuration isolates the peak RSS and the per-process download engine.
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                elapsed, found, peak_rss = executor.submit(_run, episodes, server.base_url, overrides).result()
+            match_rate, mean_error = _compare(episodes, found)
+            results.append((overrides, elapsed, server.bytes_sent - bytes_before, peak_rss, match_rate, mean_error))
+
+    print(f"{'configuration':<40} {'wall, s':>8} {'secs/episode':>13} {'MB sent':>8} "
+          f"{'peak RSS, MB':>13} {'match':>6} {'mae, s':>7}")
+    for overrides, elapsed, bytes_sent, peak_rss, match_rate, mean_error in results:
+        name = ', '.join(f'{key}={value}' for key, value in overrides.items()) or 'base'
+        print(f"{name:<40} {elapsed:>8.1f} {elapsed / len(episodes):>13.2f} {bytes_sent / 1024 ** 2:>8.1f} "
+              f"{peak_rss / 1024 ** 2:>13.0f} {match_rate:>6.1%} {mean_error:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ import boto3
 
 from Common.py.models import VideoKey, Scenes, MatcherResponse, MatcherResultRequest, MatcherResultRequestItem
 from Matcher.config.config import Config
+from Matcher.helpers import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -23,11 +24,13 @@ def get_videos_to_match() -> MatcherResponse:
 def update_video_scenes(data: MatcherResultRequest) -> None:
     payload = data.to_json()  # type: ignore
 
-    _get_client().invoke(
-        FunctionName=Config.update_video_scenes_lambda_name,
-        InvocationType='RequestResponse',
-        Payload=payload
-    )
+    with metrics.timer('upload'):
+        _get_client().invoke(
+            FunctionName=Config.update_video_scenes_lambda_name,
+            InvocationType='RequestResponse',
+            Payload=payload
+        )
+    metrics.count('uploaded_scenes', len(data.items))
 
 
 def upload_empty_scenes(videos_to_match: list[VideoKey]) -> None:
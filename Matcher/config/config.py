@@ -1,6 +1,8 @@
 import json
 import os
-from typing import TypeVar
+import threading
+from contextlib import contextmanager
+from typing import TypeVar, Iterator
 
 from Matcher.clients import ssm_client
 
@@ -16,6 +18,8 @@ def _add_name(func):
 
 class _Config:
     _configuration: dict[str, str] = {}
+    _exported: dict[str, str] = {}
+    _overrides = threading.local()
 
     def initialize_from_ssm(self) -> None:
         PARAMETER_NAME = os.environ.get('CONFIGURATION_PARAMETER_NAME')
@@ -26,10 +30,36 @@ class _Config:
     def initialize_from_dict(self, configuration: dict[str, str]) -> None:
         self._configuration.clear()
         self._configuration.update(configuration)
+        self._exported = {}
+
+    def initialize_from_export(self, exported: dict[str, str]) -> None:
+        """
+        Initializes the configuration of a worker process with the values exported by the main process.
+        The exported values are already resolved, so they take precedence over the environment of the worker.
+        """
+        self.initialize_from_dict(exported)
+        self._exported = dict(exported)
 
     def export(self) -> dict[str, str]:
+        """
+        Returns the values as they are resolved for the current thread, including the overrides.
+        """
         assert self._configuration is not None, "Configuration is not initialized."
-        return dict(self._configuration)
+        environ = {key: os.environ[key] for key in self._configuration if os.environ.get(key)}
+        return {**self._configuration, **environ, **self._exported, **self._get_overrides()}
+
+    @contextmanager
+    def override(self, values: dict[str, str]) -> Iterator[None]:
+        """
+        Overrides the configuration values for the current thread.
+        The overridden values are also exported to the worker processes.
+        """
+        previous_overrides = self._get_overrides()
+        self._overrides.values = {**previous_overrides, **values}
+        try:
+            yield
+        finally:
+            self._overrides.values = previous_overrides
 
     @property
     @_add_name
@@ -63,6 +93,60 @@ class _Config:
     def seconds_to_match(self, name: str = "") -> int:
         return int(self._get_value(name, 6 * 60))
 
+    @property
+    @_add_name
+    def progressive_matching(self, name: str = "") -> bool:
+        """ Match a shorter window first and extend it only for the episodes without a confident scene. """
+        return str(self._get_value(name, False)).lower() == 'true'
+
+    @property
+    @_add_name
+    def progressive_initial_secs(self, name: str = "") -> int:
+        """ Seconds of the head and the tail matched by the first pass of the progressive matching. """
+        return int(self._get_value(name, 120))
+
+    @property
+    @_add_name
+    def progressive_edge_margin_secs(self, name: str = "") -> int:
+        """ A scene closer to the inner edge of the window may continue beyond it and is matched again. """
+        return int(self._get_value(name, 5))
+
+    @property
+    @_add_name
+    def progressive_duration_tolerance_secs(self, name: str = "") -> int:
+        """ A scene whose duration differs more from the median of the batch is matched again. """
+        return int(self._get_value(name, 5))
+
+    @property
+    @_add_name
+    def scene_priors(self, name: str = "") -> bool:
+        """ Match the window around the scenes found for the other episodes of the title first. """
+        return str(self._get_value(name, False)).lower() == 'true'
+
+    @property
+    @_add_name
+    def scene_prior_margin_secs(self, name: str = "") -> int:
+        """ Seconds matched beyond the expected end of the opening and the expected start of the ending. """
+        return int(self._get_value(name, 15))
+
+    @property
+    @_add_name
+    def segment_digest_matching(self, name: str = "") -> bool:
+        """ Take the common part of two episodes from their segments with identical audio instead of comparing it. """
+        return str(self._get_value(name, False)).lower() == 'true'
+
+    @property
+    @_add_name
+    def analysis_sample_rate(self, name: str = "") -> int:
+        """ Sample rate of the audio passed to the recognizer (Hz). """
+        return int(self._get_value(name, 44100))
+
+    @property
+    @_add_name
+    def analysis_sample_format(self, name: str = "") -> str:
+        """ Sample format of the decoded audio: 'int16' or 'float32'. """
+        return self._get_value(name, 'int16')
+
     @property
     @_add_name
     def notification_queue_url(self, name: str = "") -> str:
@@ -83,16 +167,239 @@ class _Config:
     def temp_dir(self, name: str = "") -> str:
         return self._get_value(name, '/tmp')
 
+    @property
+    @_add_name
+    def cache_dir(self, name: str = "") -> str:
+        """ Directory of the caches shared by all jobs. """
+        return self._get_value(name, os.path.join(self.temp_dir, 'cache'))
+
+    @property
+    @_add_name
+    def streaming_decode(self, name: str = "") -> bool:
+        """ Pipe downloaded segments straight into ffmpeg instead of writing them to temporary files. """
+        return str(self._get_value(name, False)).lower() == 'true'
+
+    @property
+    @_add_name
+    def incremental_matching(self, name: str = "") -> bool:
+        """ Upload the scenes of each episode as soon as the episodes around it are matched. """
+        return str(self._get_value(name, False)).lower() == 'true'
+
+    @property
+    @_add_name
+    def match_requested_only(self, name: str = "") -> bool:
+        """ Upload only the requested episodes and use their neighbours as context without rematching them. """
+        return str(self._get_value(name, False)).lower() == 'true'
+
+    @property
+    @_add_name
+    def segments_cache_max_bytes(self, name: str = "") -> int:
+        """ Disk budget for downloaded video segments. 0 disables the cache. """
+        return int(self._get_value(name, 0))
+
+    @property
+    @_add_name
+    def decoded_audio_cache_max_bytes(self, name: str = "") -> int:
+        """ Disk budget for decoded audio of segment ranges. 0 disables the cache. """
+        return int(self._get_value(name, 0))
+
+    @property
+    @_add_name
+    def fingerprints_cache_max_bytes(self, name: str = "") -> int:
+        """ Disk budget for the analysed audio of the episodes and their comparisons. 0 disables the store. """
+        return int(self._get_value(name, 0))
+
+    @property
+    @_add_name
+    def scene_priors_cache_max_bytes(self, name: str = "") -> int:
+        """ Disk budget for the scenes found for each title, used as the scene priors. 0 disables the priors. """
+        return int(self._get_value(name, 64 * 1024 ** 2))
+
+    @property
+    @_add_name
+    def playlist_fetch_threads(self, name: str = "") -> int:
+        """ Number of playlists of a batch fetched concurrently. """
+        return int(self._get_value(name, 8))
+
     @property
     @_add_name
     def download_threads(self, name: str = "") -> int:
+        """ Initial concurrent downloads per host of a group, shared by its prefetch workers. """
         return int(self._get_value(name, 12))
 
+    @property
+    @_add_name
+    def adaptive_download_threads(self, name: str = "") -> bool:
+        """ Adjusts the concurrent downloads per host to the observed throughput, latency and failures. """
+        return str(self._get_value(name, True)).lower() == 'true'
+
+    @property
+    @_add_name
+    def download_threads_min(self, name: str = "") -> int:
+        return int(self._get_value(name, 2))
+
+    @property
+    @_add_name
+    def download_threads_max(self, name: str = "") -> int:
+        """ Concurrent downloads per host the adaptive limits of all groups grow to at most. """
+        return int(self._get_value(name, 48))
+
+    @property
+    @_add_name
+    def parallel_groups(self, name: str = "") -> int:
+        """ Number of anime/dub groups processed at the same time. """
+        return int(self._get_value(name, 1))
+
+    @property
+    @_add_name
+    def pipelined_intake(self, name: str = "") -> bool:
+        """ Lease and prepare the next group while the current one is processed. Used if parallel_groups is 1. """
+        return str(self._get_value(name, False)).lower() == 'true'
+
+    @property
+    @_add_name
+    def intake_prefetch_episodes(self, name: str = "") -> int:
+        """ Number of the first episodes of the next group downloaded into the enabled caches by the job intake. """
+        return int(self._get_value(name, 2))
+
+    @property
+    @_add_name
+    def group_download_threads(self, name: str = "") -> int:
+        """ Download threads per group. 0 shares download_threads equally between parallel groups. """
+        return int(self._get_value(name, 0))
+
+    @property
+    @_add_name
+    def http_max_connections(self, name: str = "") -> int:
+        """ Total number of simultaneous connections of the download engine. 0 means unlimited. """
+        return int(self._get_value(name, 100))
+
+    @property
+    @_add_name
+    def http_max_connections_per_host(self, name: str = "") -> int:
+        """ Number of simultaneous connections to the same host. 0 means unlimited. """
+        return int(self._get_value(name, 0))
+
+    @property
+    @_add_name
+    def http_dns_cache_ttl_secs(self, name: str = "") -> int:
+        return int(self._get_value(name, 300))
+
+    @property
+    @_add_name
+    def http_keepalive_timeout_secs(self, name: str = "") -> int:
+        """ How long an idle connection is kept open for the next request. """
+        return int(self._get_value(name, 60))
+
     @property
     @_add_name
     def download_max_retries_for_ts(self, name: str = "") -> int:
+        """ Download attempts per segment. A retry resumes from the last received byte. """
         return int(self._get_value(name, 3))
 
+    @property
+    @_add_name
+    def episode_download_retries(self, name: str = "") -> int:
+        """ Downloads of a failed episode before it is skipped and only the other episodes of the batch are matched. """
+        return int(self._get_value(name, 1))
+
+    @property
+    @_add_name
+    def download_retry_base_delay_secs(self, name: str = "") -> int:
+        """ Upper bound of the random delay before the first retry, doubled with every next one. """
+        return int(self._get_value(name, 1))
+
+    @property
+    @_add_name
+    def download_retry_max_delay_secs(self, name: str = "") -> int:
+        return int(self._get_value(name, 30))
+
+    @property
+    @_add_name
+    def segment_timeout_secs(self, name: str = "") -> int:
+        """ Time limit of a single download attempt of a segment, not counting the wait for a download slot. """
+        return int(self._get_value(name, 60))
+
+    @property
+    @_add_name
+    def segment_hedging(self, name: str = "") -> bool:
+        """ Sends a duplicate request for a segment that takes longer than 95% of the recent downloads. """
+        return str(self._get_value(name, True)).lower() == 'true'
+
+    @property
+    @_add_name
+    def segment_hedge_min_delay_secs(self, name: str = "") -> int:
+        return int(self._get_value(name, 2))
+
+    @property
+    @_add_name
+    def prefetch_depth(self, name: str = "") -> int:
+        """ Number of episodes downloaded in advance while the recognizer processes the current one. """
+        return int(self._get_value(name, 1))
+
+    @property
+    @_add_name
+    def prefetch_workers(self, name: str = "") -> int:
+        """ Number of worker processes that download episodes in advance. """
+        return int(self._get_value(name, 1))
+
+    @property
+    @_add_name
+    def decode_workers(self, name: str = "") -> int:
+        """ Decode worker processes per group. 0 means an equal share of the CPU cores. """
+        return int(self._get_value(name, 0))
+
+    @property
+    @_add_name
+    def max_rss_bytes(self, name: str = "") -> int:
+        """ Limit of the resident memory of the matcher and its worker processes. 0 is unlimited. """
+        return int(self._get_value(name, 0))
+
+    @property
+    @_add_name
+    def max_temp_disk_bytes(self, name: str = "") -> int:
+        """ Size of the temp dir without the caches the resource governor keeps within. 0 is unlimited. """
+        return int(self._get_value(name, 0))
+
+    @property
+    @_add_name
+    def resource_soft_limit_ratio(self, name: str = "") -> float:
+        """ Share of the limits at which prefetch pauses, batches shrink and decoded audio is spilled to disk. """
+        return float(self._get_value(name, 0.8))
+
+    @property
+    @_add_name
+    def prefetch_min_free_disk_bytes(self, name: str = "") -> int:
+        """ Prefetch is paused while the temp dir disk has less free space. """
+        return int(self._get_value(name, 1024 ** 3))
+
+    @property
+    @_add_name
+    def prefetch_min_free_memory_bytes(self, name: str = "") -> int:
+        """ Prefetch is paused while less memory is available. """
+        return int(self._get_value(name, 512 * 1024 ** 2))
+
+    @property
+    @_add_name
+    def metrics_export(self, name: str = "") -> str:
+        """
+        Comma-separated targets of the batch metrics: 'emf' (CloudWatch) and 'prometheus'.
+        Empty to only log them.
+        """
+        return self._get_value(name, '')
+
+    @property
+    @_add_name
+    def metrics_namespace(self, name: str = "") -> str:
+        """ CloudWatch namespace of the EMF metrics. """
+        return self._get_value(name, 'Bounan/Matcher')
+
+    @property
+    @_add_name
+    def metrics_prometheus_path(self, name: str = "") -> str:
+        """ Text file with the Prometheus metrics for the node exporter textfile collector. """
+        return self._get_value(name, os.path.join(self.temp_dir, 'metrics', 'matcher.prom'))
+
     @property
     @_add_name
     def scene_after_opening_threshold_secs(self, name: str = "") -> int:
@@ -111,15 +418,26 @@ class _Config:
     @property
     @_add_name
     def batch_size(self, name: str = "") -> int:
-        # It will automatically expand up to N*2-1=19 if the last batch contains
-        # less than N videos (N:10 -> B:19).
+        """ Maximum number of episodes a batch finds the scenes for. The batches are balanced to similar sizes. """
         return int(self._get_value(name, 10))
 
+    @property
+    @_add_name
+    def overlapping_batches(self, name: str = "") -> bool:
+        """ Extends each batch by episodes_to_match neighbours on both sides. Needs the fingerprints cache. """
+        return str(self._get_value(name, False)).lower() == 'true'
+
     def _get_value(self, key: str, default: T | None = None) -> str:
         assert self._configuration is not None, "Configuration is not initialized."
-        value = os.environ.get(key) or self._configuration.get(key, str(default))
+        value = (self._get_overrides().get(key)
+                 or self._exported.get(key)
+                 or os.environ.get(key)
+                 or self._configuration.get(key, str(default)))
         assert value is not None, f"Configuration value for '{key}' is not set."
         return value
 
+    def _get_overrides(self) -> dict[str, str]:
+        return getattr(self._overrides, 'values', {})
+
 
 Config = _Config()
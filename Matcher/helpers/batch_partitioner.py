@@ -0,0 +1,43 @@
+import math
+from typing import Generic, NamedTuple, TypeVar
+
+T = TypeVar('T')
+
+
+class Batch(NamedTuple, Generic[T]):
+    """
+    Consecutive episodes processed together.
+    The scenes are produced for the core episodes only, the context episodes around them
+    are compared with the core ones, so the episodes at the edges get as many neighbours as the others.
+    """
+    episodes: list[T]
+    core: list[T]
+
+
+def partition(episodes: list[T], core_size: int, context_size: int) -> list[Batch[T]]:
+    """
+    Splits the consecutive episodes into batches of balanced core sizes that differ by one at most,
+    as every episode analyses the same amount of audio.
+    With the context, each batch is extended by context_size episodes from the adjacent batches on both sides,
+    so the cores have at most core_size episodes.
+    Without it, the cores have at least core_size episodes, so the short tail is merged into the other batches
+    and the episodes at the edges keep enough neighbours.
+    """
+    if len(episodes) == 0:
+        return []
+
+    core_size = max(core_size, 1)
+    if context_size > 0:
+        batches_count = math.ceil(len(episodes) / core_size)
+    else:
+        batches_count = max(len(episodes) // core_size, 1)
+    base_size, larger_batches = divmod(len(episodes), batches_count)
+
+    batches: list[Batch[T]] = []
+    start = 0
+    for i in range(batches_count):
+        end = start + base_size + (1 if i < larger_batches else 0)
+        batches.append(Batch(episodes[max(start - context_size, 0):end + context_size], episodes[start:end]))
+        start = end
+
+    return batches
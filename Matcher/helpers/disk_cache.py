@@ -0,0 +1,128 @@
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class DiskCache:
+    """
+    Content-addressed file cache with a byte budget and LRU eviction.
+    The modification time of an entry is used as its last access time,
+    so the same directory can be shared between the worker processes.
+    """
+
+    _directory: str
+    _max_bytes: int
+
+    def __init__(self, directory: str, max_bytes: int):
+        self._directory = directory
+        self._max_bytes = max_bytes
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_bytes > 0
+
+    @staticmethod
+    def make_key(*parts: str) -> str:
+        """Builds a cache key from the parts that identify the content."""
+        return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        """
+        Returns the path of the cached entry or None if it is missing.
+        The entry is marked as recently used.
+        """
+        if not self.enabled:
+            return None
+
+        path = self._get_path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        logger.debug(f"Cache hit: {path}")
+        return path
+
+    def copy_to(self, key: str, target_path: str) -> bool:
+        """
+        Copies the cached entry to the target path.
+        :return: True if the entry was found, False otherwise
+        """
+        cached_path = self.get(key)
+        if cached_path is None:
+            return False
+
+        try:
+            self._link_or_copy(cached_path, target_path)
+        except FileNotFoundError:
+            # The entry was evicted by another process in the meantime.
+            return False
+
+        return True
+
+    def put(self, key: str, source_path: str, keep_source: bool = False) -> str:
+        """
+        Stores the file in the cache and evicts the least recently used entries if the budget is exceeded.
+        :param key: Cache key
+        :param source_path: Path of the file to store
+        :param keep_source: Whether to keep the source file in place or to move it into the cache
+        :return: Path of the cached entry
+        """
+        if not self.enabled:
+            return source_path
+
+        os.makedirs(self._directory, exist_ok=True)
+        path = self._get_path(key)
+
+        # Write to a unique temporary name first, so concurrent readers never see a partial entry.
+        temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        if keep_source:
+            self._link_or_copy(source_path, temp_path)
+        else:
+            shutil.move(source_path, temp_path)
+        os.replace(temp_path, path)
+        logger.debug(f"Cached {source_path} -> {path}")
+
+        self._evict(keep=path)
+        return path
+
+    def _evict(self, keep: str) -> None:
+        entries: list[tuple[float, int, str]] = []
+        for entry in os.scandir(self._directory):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self._max_bytes:
+                break
+            if path == keep:
+                continue
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            logger.debug(f"Evicted {path} from cache")
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self._directory, key)
+
+    @staticmethod
+    def _link_or_copy(source_path: str, target_path: str) -> None:
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        try:
+            os.link(source_path, target_path)
+        except OSError:
+            shutil.copyfile(source_path, target_path)
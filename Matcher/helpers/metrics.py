@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator, ParamSpec, TypeVar, Any
+
+from Matcher.config.config import Config
+
+TArgs = ParamSpec('TArgs')
+TResult = TypeVar('TResult')
+
+type _MetricKey = tuple[str, tuple[tuple[str, str], ...]]
+type MetricsSnapshot = dict[str, list[Any]]
+
+logger = logging.getLogger(__name__)
+
+# EMF documents must be sent as plain JSON messages, see matcher_logger.setup_logging.
+emf_logger = logging.getLogger('Matcher.metrics.emf')
+
+
+class Metrics:
+    """
+    Timers and counters of the processing stages.
+    Can be updated from several threads and merged with the metrics collected by the worker processes.
+    """
+
+    _lock: threading.Lock
+    _timers: dict[_MetricKey, list[float]]  # Count, total seconds and max seconds
+    _counters: dict[_MetricKey, float]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timers = {}
+        self._counters = {}
+
+    def add_time(self, name: str, seconds: float, labels: dict[str, str]) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            timer = self._timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def add_count(self, name: str, value: float, labels: dict[str, str]) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def snapshot(self) -> MetricsSnapshot:
+        """Returns the metrics in a picklable form for merge."""
+        with self._lock:
+            return {'timers': [[name, list(labels), *timer] for (name, labels), timer in self._timers.items()],
+                    'counters': [[name, list(labels), value] for (name, labels), value in self._counters.items()]}
+
+    def merge(self, snapshot: MetricsSnapshot) -> None:
+        with self._lock:
+            for name, labels, count, total, maximum in snapshot['timers']:
+                timer = self._timers.setdefault((name, tuple(map(tuple, labels))), [0, 0.0, 0.0])
+                timer[0] += count
+                timer[1] += total
+                timer[2] = max(timer[2], maximum)
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                self._counters[key] = self._counters.get(key, 0) + value
+
+    def get_summary(self) -> str:
+        """Returns a single line with all metrics for the logs."""
+        with self._lock:
+            timers = [f'{_format_key(key)}={total:.2f}s/{int(count)}'
+                      for key, (count, total, _) in sorted(self._timers.items())]
+            counters = [f'{_format_key(key)}={value:g}'
+                        for key, value in sorted(self._counters.items())]
+        return ' '.join(timers + counters)
+
+    def to_emf(self, namespace: str, properties: dict[str, str]) -> list[dict[str, Any]]:
+        """
+        Builds CloudWatch embedded metric format documents, one per label set.
+        The labels become the dimensions, the properties are only searchable in the logs.
+        """
+        documents: dict[tuple[tuple[str, str], ...], dict[str, Any]] = {}
+        definitions: dict[tuple[tuple[str, str], ...], list[dict[str, str]]] = {}
+
+        def add(labels: tuple[tuple[str, str], ...], name: str, unit: str, value: float) -> None:
+            if labels not in documents:
+                definitions[labels] = []
+                documents[labels] = {
+                    '_aws': {
+                        'Timestamp': int(time.time() * 1000),
+                        'CloudWatchMetrics': [{'Namespace': namespace,
+                                               'Dimensions': [[label for label, _ in labels]],
+                                               'Metrics': definitions[labels]}],
+                    },
+                    **properties,
+                    **dict(labels),
+                }
+            definitions[labels].append({'Name': name, 'Unit': unit})
+            documents[labels][name] = value
+
+        with self._lock:
+            for (name, labels), (count, total, maximum) in self._timers.items():
+                add(labels, f'{name}_seconds', 'Seconds', total)
+                add(labels, f'{name}_max_seconds', 'Seconds', maximum)
+                add(labels, f'{name}_count', 'Count', count)
+            for (name, labels), value in self._counters.items():
+                add(labels, name, 'Bytes' if name.endswith('_bytes') else 'Count', value)
+
+        return list(documents.values())
+
+    def to_prometheus(self, prefix: str) -> str:
+        """Builds the Prometheus text exposition format, timers are exported as summaries without quantiles."""
+        lines: list[str] = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._timers}):
+                lines.append(f'# TYPE {prefix}_{name}_seconds summary')
+                for (timer_name, labels), (count, total, _) in sorted(self._timers.items()):
+                    if timer_name == name:
+                        lines.append(f'{prefix}_{name}_seconds_sum{_format_labels(labels)} {total}')
+                        lines.append(f'{prefix}_{name}_seconds_count{_format_labels(labels)} {int(count)}')
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f'# TYPE {prefix}_{name}_total counter')
+                for (counter_name, labels), value in sorted(self._counters.items()):
+                    if counter_name == name:
+                        lines.append(f'{prefix}_{name}_total{_format_labels(labels)} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+_current: ContextVar[Metrics | None] = ContextVar('metrics', default=None)
+
+# Collects the metrics outside a batch and the totals exported to Prometheus.
+_process_metrics = Metrics()
+_process_totals = Metrics()
+
+
+def current() -> Metrics:
+    """Returns the metrics of the batch processed by the current thread or coroutine."""
+    return _current.get() or _process_metrics
+
+
+@contextmanager
+def collect() -> Iterator[Metrics]:
+    """Collects the metrics of the current thread and the coroutines started by it into a new instance."""
+    metrics = Metrics()
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+
+
+def bind(func: Callable[TArgs, TResult]) -> Callable[TArgs, TResult]:
+    """Binds the function to the current metrics, so it reports to them from another thread."""
+    metrics = current()
+
+    def run(*args: TArgs.args, **kwargs: TArgs.kwargs) -> TResult:
+        token = _current.set(metrics)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current.reset(token)
+
+    return run
+
+
+@contextmanager
+def timer(name: str, **labels: str) -> Iterator[None]:
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        current().add_time(name, time.perf_counter() - started_at, labels)
+
+
+def count(name: str, value: float = 1, **labels: str) -> None:
+    current().add_count(name, value, labels)
+
+
+def get_export_targets() -> set[str]:
+    return {target.strip() for target in Config.metrics_export.split(',') if target.strip()}
+
+
+def export(metrics: Metrics, properties: dict[str, str]) -> None:
+    """
+    Logs the metrics of a batch and exports them to the targets listed in Config.metrics_export:
+    'emf' for CloudWatch embedded metric format and 'prometheus' for a text file of the node exporter.
+    """
+    logger.info(f"Metrics {properties}: {metrics.get_summary()}")
+
+    targets = get_export_targets()
+    if 'emf' in targets:
+        for document in metrics.to_emf(Config.metrics_namespace, properties):
+            emf_logger.info(json.dumps(document))
+
+    if 'prometheus' in targets:
+        _process_totals.merge(metrics.snapshot())
+        try:
+            _write_atomically(Config.metrics_prometheus_path, _process_totals.to_prometheus('matcher'))
+        except OSError as e:
+            logger.error(f"Failed to write Prometheus metrics: {e}")
+
+
+def _write_atomically(path: str, content: str) -> None:
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+
+def _format_key(key: _MetricKey) -> str:
+    name, labels = key
+    return name + (f'[{",".join(value for _, value in labels)}]' if labels else '')
+
+
+def _format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    escaped = [(label, value.replace('\\', '\\\\').replace('"', '\\"')) for label, value in labels]
+    return '{' + ','.join(f'{label}="{value}"' for label, value in escaped) + '}'
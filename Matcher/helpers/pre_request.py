@@ -1,40 +1,221 @@
 import concurrent.futures
+import functools
+import importlib
 import logging
-from typing import Callable, TypeVar, Generic, ParamSpec
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, TypeVar, Generic, ParamSpec, Iterator
 
 from dotenv import load_dotenv
 
 from Matcher.config.config import Config
+from Matcher.helpers import metrics, resource_governor
+from Matcher.helpers.metrics import MetricsSnapshot
+from Matcher.helpers.system_resources import get_free_disk_bytes, get_available_memory_bytes
 from Matcher.matcher_logger import setup_logging
 
 TArgs = ParamSpec('TArgs')
 TResult = TypeVar('TResult')
+TIntermediate = TypeVar('TIntermediate')
 
 USE_MULTIPROCESSING = True  # Use False to prevent PyCharm debug issues
 
+# Imported by the shared workers in advance, so the first requests do not wait for them.
+# Both stages of the requests are methods of the audio provider, which imports the audio merger.
+_DOWNLOAD_WARM_UP_MODULES = ['Matcher.scenes_finder.audio_provider']
+_DECODE_WARM_UP_MODULES = ['Matcher.scenes_finder.audio_provider']
+
 logger = logging.getLogger(__name__)
 
+_shared_pools: tuple[concurrent.futures.ProcessPoolExecutor, concurrent.futures.ProcessPoolExecutor] | None = None
+
+
+@contextmanager
+def shared_worker_pools() -> Iterator[None]:
+    """
+    Starts the worker processes used by all queues until the context exits,
+    so they are initialized once instead of for every queue.
+    The configuration of each request is passed along with it, so the queues may override it.
+    """
+    global _shared_pools
+    if not USE_MULTIPROCESSING:
+        yield
+        return
+
+    config = Config.export()
+    # Each group gets its own share of the workers, the job intake prepares the next job with its own worker.
+    workers = Config.prefetch_workers * Config.parallel_groups + (1 if Config.pipelined_intake else 0)
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                  initializer=PreRequestQueue._init_shared_worker,
+                                                  initargs=(config, _DOWNLOAD_WARM_UP_MODULES))
+    cpu_pool = concurrent.futures.ProcessPoolExecutor(max_workers=_get_decode_workers() * Config.parallel_groups,
+                                                      initializer=PreRequestQueue._init_shared_worker,
+                                                      initargs=(config, _DECODE_WARM_UP_MODULES))
+    try:
+        # Start the download workers now, the pool starts them lazily otherwise.
+        # The decode workers start with the first decodes.
+        concurrent.futures.wait([pool.submit(os.getpid) for _ in range(workers)])
+        logger.info("Shared worker pools started.")
+
+        _shared_pools = pool, cpu_pool
+        yield
+    finally:
+        _shared_pools = None
+        pool.shutdown(wait=True, cancel_futures=True)
+        cpu_pool.shutdown(wait=True, cancel_futures=True)
+        logger.info("Shared worker pools stopped.")
+
+
+def run_in_shared_pool(config: dict[str, str],
+                       func: Callable[TArgs, TResult],
+                       *args: TArgs.args,
+                       **kwargs: TArgs.kwargs) -> TResult:
+    """
+    Runs the request in the shared download pool with the given configuration and waits for its result.
+    The request runs in the current process if the shared pools are not started.
+    """
+    assert kwargs == {}, "Keyword arguments are not needed for now"
+    if _shared_pools is None:
+        with Config.override(config):
+            return func(*args, **kwargs)
+
+    future = _shared_pools[0].submit(PreRequestQueue[TArgs, TResult]._run_with_logger, config, func, *args, **kwargs)
+    return PreRequestQueue._merge_metrics(*future.result())
+
+
+def _get_decode_workers() -> int:
+    """Returns the number of the decode workers of a single group. By default, the groups share the CPU cores."""
+    return Config.decode_workers or max((os.cpu_count() or 1) // max(Config.parallel_groups, 1), 1)
+
+
+class _BoundedSubmitter:
+    """
+    Submits the requests of a queue to a pool and runs at most the given number of them at the same time,
+    so the queues sharing the pool keep their shares of its workers.
+    The futures returned by submit complete with the results of the requests.
+    """
+
+    _pool: concurrent.futures.ProcessPoolExecutor
+    _limit: int
+    _running: int = 0
+    _waiting: deque[tuple[concurrent.futures.Future, Callable, tuple]]
+    _submitted: list[concurrent.futures.Future]
+    # Reentrant, because a request may complete while it is submitted.
+    _lock: threading.RLock
+
+    def __init__(self, pool: concurrent.futures.ProcessPoolExecutor, limit: int):
+        self._pool = pool
+        self._limit = max(limit, 1)
+        self._waiting = deque()
+        self._submitted = []
+        self._lock = threading.RLock()
+
+    def submit(self, func: Callable, *args) -> concurrent.futures.Future:
+        result: concurrent.futures.Future = concurrent.futures.Future()
+        with self._lock:
+            self._waiting.append((result, func, args))
+            self._submit_waiting()
+        return result
+
+    def cancel(self) -> list[concurrent.futures.Future]:
+        """
+        Cancels the waiting requests and the submitted ones that have not started.
+        :return: Submitted requests to wait for
+        """
+        with self._lock:
+            for result, _, _ in self._waiting:
+                result.cancel()
+            self._waiting.clear()
+            submitted = list(self._submitted)
+        for future in submitted:
+            future.cancel()
+        return submitted
+
+    def _submit_waiting(self) -> None:
+        while self._waiting and self._running < self._limit:
+            result, func, args = self._waiting.popleft()
+            if not result.set_running_or_notify_cancel():
+                continue
+            try:
+                future = self._pool.submit(func, *args)
+            except BaseException as e:
+                result.set_exception(e)
+                continue
+            self._running += 1
+            self._submitted.append(future)
+            future.add_done_callback(functools.partial(self._on_done, result))
+
+    def _on_done(self, result: concurrent.futures.Future, future: concurrent.futures.Future) -> None:
+        with self._lock:
+            self._running -= 1
+            self._submitted.remove(future)
+            self._submit_waiting()
+
+        if future.cancelled():
+            result.set_exception(concurrent.futures.CancelledError())
+        elif future.exception() is not None:
+            result.set_exception(future.exception())
+        else:
+            result.set_result(future.result())
+
 
 class PreRequestQueue(Generic[TArgs, TResult]):
-    _pool: concurrent.futures.ProcessPoolExecutor | None
+    """
+    Bounded queue of requests that are executed in advance by a pool of worker processes.
+    A staged request continues in a separate pool of CPU workers, so the CPU stage of one request
+    overlaps with the first stage of the next ones. The prefetch depth bounds the requests in both stages.
+    Requests may complete in any order, results are popped by their keys.
+    The metrics collected by a request are merged into the metrics of the thread that pops its result.
+    The queue uses the shared worker pools if they are started, otherwise it starts its own pools.
+    Either way, it runs at most Config.prefetch_workers downloads and as many decodes as its decode workers at once.
+    """
+
+    _config: dict[str, str]
+    _pool: concurrent.futures.ProcessPoolExecutor | None = None
+    _cpu_pool: concurrent.futures.ProcessPoolExecutor | None = None
+    _downloads: _BoundedSubmitter | None = None
+    _decodes: _BoundedSubmitter | None = None
+    _owns_pools: bool = True
     _results: dict[int, Callable[[], TResult]]
+    _lock: threading.Lock
+    _closed: bool = False
 
     def __init__(self, config: dict[str, str]):
-        if USE_MULTIPROCESSING:
+        self._config = config
+        if _shared_pools is not None:
+            self._pool, self._cpu_pool = _shared_pools
+            self._owns_pools = False
+        elif USE_MULTIPROCESSING:
             self._pool = concurrent.futures.ProcessPoolExecutor(
-                max_workers=1,
+                max_workers=Config.prefetch_workers,
                 initializer=PreRequestQueue._init_worker,
                 initargs=(config,))
+        if self._pool:
+            self._downloads = _BoundedSubmitter(self._pool, Config.prefetch_workers)
 
         self._results: dict[int, Callable[[], TResult]] = {}
+        self._lock = threading.Lock()
 
     def __enter__(self):
         logger.info("Queue initialized.")
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self._pool:
-            self._pool.shutdown(wait=True)
+        # Close first, so the finished requests do not submit to the CPU pool anymore.
+        with self._lock:
+            self._closed = True
+        if self._downloads:
+            concurrent.futures.wait(self._downloads.cancel())
+        if self._decodes:
+            concurrent.futures.wait(self._decodes.cancel())
+
+        if self._owns_pools:
+            if self._pool:
+                self._pool.shutdown(wait=True, cancel_futures=True)
+            if self._cpu_pool:
+                self._cpu_pool.shutdown(wait=True, cancel_futures=True)
         self._results.clear()
         logger.info("Queue was reset and resources released.")
 
@@ -43,32 +224,129 @@ class PreRequestQueue(Generic[TArgs, TResult]):
                     *args: TArgs.args,
                     **kwargs: TArgs.kwargs) -> None:
         assert key not in self._results
-        assert len(self._results) < 2
+        assert len(self._results) < max(Config.prefetch_depth, 1)
         assert kwargs == {}, "Keyword arguments are not needed for now"
 
-        if self._pool:
-            future = self._pool.submit(self._run_with_logger,
-                                       func,
-                                       *args,
-                                       **kwargs)
-            self._results[key] = lambda: future.result()
+        if self._downloads:
+            future = self._downloads.submit(self._run_with_logger, self._config, func, *args)
+            self._results[key] = lambda: self._merge_metrics(*future.result())
         else:
             logger.warning("Multiprocessing is disabled")
             self._results[key] = lambda: func(*args, **kwargs)
 
+    def pre_request_staged(self, key: int,
+                           func: Callable[TArgs, TIntermediate],
+                           then: Callable[[TIntermediate], TResult],
+                           *args: TArgs.args,
+                           **kwargs: TArgs.kwargs) -> None:
+        """
+        Executes func in the worker pool and then its result in the CPU pool.
+        """
+        assert key not in self._results
+        assert len(self._results) < max(Config.prefetch_depth, 1)
+        assert kwargs == {}, "Keyword arguments are not needed for now"
+
+        if not self._downloads:
+            logger.warning("Multiprocessing is disabled")
+            self._results[key] = lambda: then(func(*args, **kwargs))
+            return
+
+        decodes = self._get_decodes()
+        result: concurrent.futures.Future[tuple[TResult, MetricsSnapshot, MetricsSnapshot]] = \
+            concurrent.futures.Future()
+
+        def on_first_stage_done(first: concurrent.futures.Future[tuple[TIntermediate, MetricsSnapshot]]) -> None:
+            with self._lock:
+                if self._closed:
+                    result.cancel()
+                    return
+                try:
+                    intermediate, first_snapshot = first.result()
+                    second_stage = decodes.submit(self._run_with_logger, self._config, then, intermediate)
+                except BaseException as e:
+                    result.set_exception(e)
+                    return
+
+            def on_second_stage_done(second: concurrent.futures.Future[tuple[TResult, MetricsSnapshot]]) -> None:
+                try:
+                    value, second_snapshot = second.result()
+                except BaseException as e:
+                    result.set_exception(e)
+                    return
+                result.set_result((value, first_snapshot, second_snapshot))
+
+            second_stage.add_done_callback(on_second_stage_done)
+
+        first_stage = self._downloads.submit(self._run_with_logger, self._config, func, *args)
+        first_stage.add_done_callback(on_first_stage_done)
+        self._results[key] = lambda: self._merge_metrics(*result.result())
+
+    def has_capacity(self) -> bool:
+        """
+        Returns True if one more request can be started without exceeding
+        the prefetch depth, the free disk and memory limits and the limits of the resource governor.
+        """
+        if len(self._results) >= Config.prefetch_depth:
+            return False
+
+        free_disk_bytes = get_free_disk_bytes(Config.temp_dir)
+        if free_disk_bytes < Config.prefetch_min_free_disk_bytes:
+            logger.debug(f"Prefetch is paused: {free_disk_bytes} bytes of disk are free.")
+            return False
+
+        available_memory_bytes = get_available_memory_bytes()
+        if available_memory_bytes < Config.prefetch_min_free_memory_bytes:
+            logger.debug(f"Prefetch is paused: {available_memory_bytes} bytes of memory are available.")
+            return False
+
+        if resource_governor.is_under_pressure():
+            logger.debug("Prefetch is paused: the resource limits are approached.")
+            return False
+
+        return True
+
     def pop_result(self, key: int) -> TResult:
-        res = self._results[key]()
-        del self._results[key]
-        return res
+        """
+        Waits for the result of the request. The request is removed even if it failed, so it can be made again.
+        """
+        return self._results.pop(key)()
+
+    def _get_decodes(self) -> _BoundedSubmitter:
+        if self._cpu_pool is None:
+            self._cpu_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=_get_decode_workers(),
+                initializer=PreRequestQueue._init_worker,
+                initargs=(self._config,))
+        if self._decodes is None:
+            self._decodes = _BoundedSubmitter(self._cpu_pool, _get_decode_workers())
+        return self._decodes
 
     @staticmethod
     def _init_worker(config: dict[str, str]) -> None:
         load_dotenv()
-        Config.initialize_from_dict(config)
+        Config.initialize_from_export(config)
         setup_logging()
 
     @staticmethod
-    def _run_with_logger(func: Callable[TArgs, TResult],
+    def _init_shared_worker(config: dict[str, str], modules: list[str]) -> None:
+        PreRequestQueue._init_worker(config)
+        for module in modules:
+            importlib.import_module(module)
+
+    @staticmethod
+    def _run_with_logger(config: dict[str, str],
+                         func: Callable[TArgs, TResult],
                          *args: TArgs.args,
-                         **kwargs: TArgs.kwargs) -> TResult:
-        return func(*args, **kwargs)
+                         **kwargs: TArgs.kwargs) -> tuple[TResult, MetricsSnapshot]:
+        # A worker runs one request at a time, so the configuration of the request is applied to the whole process,
+        # including the threads of the download engine.
+        Config.initialize_from_export(config)
+        with metrics.collect() as worker_metrics:
+            result = func(*args, **kwargs)
+        return result, worker_metrics.snapshot()
+
+    @staticmethod
+    def _merge_metrics(result: TResult, *snapshots: MetricsSnapshot) -> TResult:
+        for snapshot in snapshots:
+            metrics.current().merge(snapshot)
+        return result
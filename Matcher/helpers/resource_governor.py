@@ -0,0 +1,91 @@
+import logging
+import os
+import time
+
+import numpy as np
+
+from Matcher.config.config import Config
+from Matcher.helpers.system_resources import get_process_group_rss_bytes, get_directory_size_bytes
+
+logger = logging.getLogger(__name__)
+
+# Subdirectories of Config.temp_dir the matcher writes to, the rest of the temp dir is not measured.
+_TEMP_SUBDIRECTORIES = ('audio_merger', 'fingerprints', 'intake', 'jobs')
+# The temp dir is measured at most once in this period, the size is reused in between.
+_MEASUREMENT_INTERVAL_SECS = 1.0
+
+# Measured size and the time of the measurement by the temp dir.
+_temp_disk_bytes: dict[str, tuple[int, float]] = {}
+
+
+def get_pressure() -> float:
+    """
+    Returns the highest share of the Config.max_rss_bytes and Config.max_temp_disk_bytes limits in use.
+    The temp dir is measured without the caches, they are bounded by their own budgets.
+    0 if no limits are set.
+    """
+    pressure = 0.0
+    if Config.max_rss_bytes > 0:
+        pressure = max(pressure, get_process_group_rss_bytes() / Config.max_rss_bytes)
+    if Config.max_temp_disk_bytes > 0:
+        pressure = max(pressure, get_temp_disk_bytes() / Config.max_temp_disk_bytes)
+    return pressure
+
+
+def get_temp_disk_bytes() -> int:
+    """
+    Returns the size of the files the matcher keeps in the temp dir.
+    The measurement is reused for _MEASUREMENT_INTERVAL_SECS, as it walks the whole directory trees.
+    """
+    now = time.monotonic()
+    measured = _temp_disk_bytes.get(Config.temp_dir)
+    if measured is not None and now - measured[1] < _MEASUREMENT_INTERVAL_SECS:
+        return measured[0]
+
+    size = sum(get_directory_size_bytes(os.path.join(Config.temp_dir, subdirectory), exclude=Config.cache_dir)
+               for subdirectory in _TEMP_SUBDIRECTORIES)
+    _temp_disk_bytes[Config.temp_dir] = size, now
+    return size
+
+
+def is_under_pressure() -> bool:
+    """
+    Returns True if the usage approaches the limits, so the processing has to slow down to stay within them.
+    """
+    if Config.max_rss_bytes <= 0 and Config.max_temp_disk_bytes <= 0:
+        return False
+
+    pressure = get_pressure()
+    if pressure >= Config.resource_soft_limit_ratio:
+        logger.debug(f"Resources are under pressure: {pressure:.0%} of the limits are used.")
+        return True
+    return False
+
+
+def get_batch_size() -> int:
+    """
+    Returns Config.batch_size reduced to fit the limits.
+    The endings of a batch are kept in the temp dir until its openings are recognised,
+    on top of the episodes downloaded in advance.
+    The size is halved if the limits are approached already.
+    """
+    batch_size = Config.batch_size
+    if Config.max_temp_disk_bytes > 0:
+        part_bytes = _get_decoded_part_bytes()
+        budget = Config.max_temp_disk_bytes * Config.resource_soft_limit_ratio
+        budget -= max(Config.prefetch_depth, 1) * 2 * part_bytes
+        batch_size = min(batch_size, int(budget // part_bytes))
+
+    if is_under_pressure():
+        batch_size //= 2
+
+    batch_size = max(batch_size, 1)
+    if batch_size < Config.batch_size:
+        logger.info(f"Batch size is reduced to {batch_size} to fit the resource limits.")
+    return batch_size
+
+
+def _get_decoded_part_bytes() -> int:
+    """Returns the size of the decoded opening or ending of an episode."""
+    sample_bytes = np.dtype(Config.analysis_sample_format).itemsize
+    return Config.seconds_to_match * Config.analysis_sample_rate * sample_bytes
@@ -0,0 +1,76 @@
+import os
+import shutil
+
+
+def get_free_disk_bytes(path: str) -> int:
+    """
+    Returns the number of free bytes on the disk that contains the path.
+    The closest existing parent directory is used if the path does not exist yet.
+    """
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+
+    return shutil.disk_usage(path).free
+
+
+def get_available_memory_bytes() -> int:
+    """
+    Returns the amount of memory available for new allocations without swapping.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # Non-Linux systems: free physical pages are a conservative estimate.
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def get_process_group_rss_bytes() -> int:
+    """
+    Returns the resident memory of all processes in the process group of the current one:
+    the main process, its worker processes and their ffmpeg subprocesses.
+    Returns 0 if the process information is not available.
+    """
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    group = os.getpgrp()
+    total = 0
+    try:
+        pids = [entry for entry in os.listdir('/proc') if entry.isdigit()]
+    except OSError:
+        return 0
+
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                # The command name may contain spaces, the fields after it are space-separated.
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue  # The process has exited
+        # Fields after the command name start from the state (3rd field): pgrp is 5th, rss is 24th.
+        if int(fields[2]) == group:
+            total += int(fields[21]) * page_size
+
+    return total
+
+
+def get_directory_size_bytes(path: str, exclude: str | None = None) -> int:
+    """
+    Returns the total size of the files in the directory tree, skipping the excluded subdirectory.
+    """
+    total = 0
+    excluded = os.path.normpath(exclude) if exclude is not None else None
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if os.path.normpath(os.path.join(root, d)) != excluded]
+        for file in files:
+            try:
+                total += os.lstat(os.path.join(root, file)).st_size
+            except OSError:
+                pass  # The file was removed while walking
+    return total
@@ -0,0 +1,117 @@
+import logging
+import threading
+import time
+import traceback
+from typing import Callable, Generic, NamedTuple, TypeVar
+
+from Common.py.models import VideoKey
+from Matcher.clients import sqs_client, animan_client
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class Job(NamedTuple, Generic[T]):
+    """Leased videos to match and the result of their preparation or the error it raised."""
+    videos_to_match: list[VideoKey]
+    prepared: T | None
+    error: Exception | None
+
+
+class JobIntake(Generic[T]):
+    """
+    Leases the next job and prepares it in a background thread while the current job is processed,
+    so the processing starts as soon as the current job is finished.
+    A single job is leased ahead: the next one is leased only once the prepared one is taken.
+    On exit, the videos of the job leased but not taken are released with empty scenes.
+    """
+
+    _prepare: Callable[[list[VideoKey]], T]
+    _thread: threading.Thread
+    _condition: threading.Condition
+    # Videos leased by the thread and not taken yet, the prepared job once it is ready.
+    _leased: list[VideoKey] | None = None
+    _job: Job[T] | None = None
+    _stopped: bool = False
+
+    def __init__(self, prepare: Callable[[list[VideoKey]], T]):
+        """
+        :param prepare: Prepares the leased videos, called in the background thread
+        """
+        self._prepare = prepare
+        self._condition = threading.Condition()
+        # The thread may be waiting for a notification on exit, it holds no videos then and is not waited for.
+        self._thread = threading.Thread(target=self._run, name='job-intake', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        logger.info("Job intake started.")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._condition:
+            self._stopped = True
+            leased, self._leased, self._job = self._leased, None, None
+            self._condition.notify_all()
+
+        if leased is not None:
+            logger.info(f"Releasing the videos leased ahead: {leased}")
+            animan_client.upload_empty_scenes(leased)
+            # Wait for the preparation, so its downloads do not outlive the worker pools.
+            self._thread.join()
+        logger.info("Job intake stopped.")
+
+    def get(self) -> Job[T]:
+        """
+        Waits for the next prepared job and lets the intake lease the one after it.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._job is not None)
+            job = self._job
+            assert job is not None
+            self._leased, self._job = None, None
+            self._condition.notify_all()
+        return job
+
+    def _run(self) -> None:
+        while True:
+            videos_to_match = self._lease()
+            with self._condition:
+                if self._stopped:
+                    # Leased after the exit, nobody takes the job anymore.
+                    animan_client.upload_empty_scenes(videos_to_match)
+                    return
+                self._leased = videos_to_match
+
+            try:
+                job = Job(videos_to_match, self._prepare(videos_to_match), None)
+            except Exception as ex:
+                job = Job(videos_to_match, None, ex)
+
+            with self._condition:
+                if self._stopped:
+                    return
+                self._job = job
+                self._condition.notify_all()
+                # Wait until the job is taken, so only one job is leased ahead of the processing.
+                self._condition.wait_for(lambda: self._job is None)
+                if self._stopped:
+                    return
+
+    @staticmethod
+    def _lease() -> list[VideoKey]:
+        while True:
+            logger.info("Getting the data...")
+            try:
+                videos_to_match = animan_client.get_videos_to_match().videos_to_match
+                if len(videos_to_match) > 0:
+                    return videos_to_match
+
+                logger.info("No videos to match. Waiting for new videos...")
+                sqs_client.wait_for_notification()
+            except Exception as ex:
+                logger.error(f"An error occurred while getting the data: {ex}. "
+                             f"{[x for x in traceback.TracebackException.from_exception(ex).format()]}")
+                logger.info("Waiting for 3 seconds...")
+                time.sleep(3)
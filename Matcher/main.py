@@ -1,6 +1,8 @@
 import logging
+import os
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 
 from dotenv import load_dotenv
 from retry import retry
@@ -10,8 +12,12 @@ from LoanApi.LoanApi.get_available_videos import get_available_videos
 from LoanApi.LoanApi.models import AvailableVideo
 from Matcher.clients import sqs_client, animan_client
 from Matcher.config.config import Config
+from Matcher.helpers import metrics, resource_governor
+from Matcher.helpers.batch_partitioner import partition
+from Matcher.helpers.pre_request import shared_worker_pools
+from Matcher.job_intake import JobIntake
 from Matcher.matcher_logger import setup_logging
-from Matcher.scenes_finder.find_scenes import find_scenes
+from Matcher.scenes_finder.find_scenes import find_scenes, iterate_scenes, prefetch_audio
 
 logger = logging.getLogger(__name__)
 
@@ -75,29 +81,89 @@ def _get_scenes_to_upload(scenes_by_video: list[tuple[VideoKey, Scenes]]) -> Mat
 
 
 @retry(tries=2, delay=1)
-def _process_batch(videos_to_process: list[AvailableVideo]) -> None:
-    scenes_by_video = find_scenes(videos_to_process)
+def _process_batch(videos_to_process: list[AvailableVideo],
+                   targets: list[VideoKey] | None,
+                   uploaded_keys: list[VideoKey]) -> None:
+    """
+    Finds and uploads the scenes of the batch.
+    :param targets: Videos to upload the scenes for, None for all videos of the batch
+    :param uploaded_keys: Videos whose scenes are uploaded, kept between the retries,
+                          so the scenes uploaded before a failure are neither found again nor replaced
+    """
+    if Config.incremental_matching:
+        _process_batch_incrementally(videos_to_process, targets, uploaded_keys)
+        return
+
+    scenes_by_video = find_scenes(videos_to_process, targets)
     logger.info(f"Scenes by video: {scenes_by_video}")
 
     scenes_to_upload = _get_scenes_to_upload(scenes_by_video)
     logger.info(f"Scenes to upload ({len(scenes_to_upload.items)}): {scenes_to_upload.items}")
 
-    if len(scenes_to_upload.items) == len(videos_to_process):
+    keys = _get_keys_to_upload(videos_to_process, targets)
+    if len(scenes_to_upload.items) == len(keys):
         animan_client.update_video_scenes(scenes_to_upload)
         logger.info("Scenes uploaded.")
     else:
-        keys = [VideoKey(video.my_anime_list_id, video.dub, video.episode)
-                for video in videos_to_process]
         animan_client.upload_empty_scenes(keys)
         logger.error("Number of scenes to upload does not match number of videos to process.")
         logger.warning("Uploaded empty scenes.")
+    uploaded_keys.extend(keys)
+
+
+def _process_batch_incrementally(videos_to_process: list[AvailableVideo],
+                                 targets: list[VideoKey] | None,
+                                 uploaded_keys: list[VideoKey]) -> None:
+    """
+    Uploads the scenes of each episode as soon as they are found instead of waiting for the whole batch.
+    The videos uploaded by a previous attempt only provide context.
+    """
+    remaining_keys = [key for key in _get_keys_to_upload(videos_to_process, targets) if key not in uploaded_keys]
+    if len(remaining_keys) == 0:
+        return
+
+    for video_key, scenes in iterate_scenes(videos_to_process, remaining_keys):
+        logger.info(f"Scenes for {video_key}: {scenes}")
+        animan_client.update_video_scenes(_get_scenes_to_upload([(video_key, scenes)]))
+        uploaded_keys.append(video_key)
+    logger.info(f"Scenes uploaded ({len(uploaded_keys)}).")
+
+    missing_keys = [key for key in remaining_keys if key not in uploaded_keys]
+    if len(missing_keys) > 0:
+        animan_client.upload_empty_scenes(missing_keys)
+        uploaded_keys.extend(missing_keys)
+        logger.error("Scenes were not found for all videos to process.")
+        logger.warning("Uploaded empty scenes.")
+
+
+def _get_keys_to_upload(videos_to_process: list[AvailableVideo], targets: list[VideoKey] | None) -> list[VideoKey]:
+    keys = [VideoKey(video.my_anime_list_id, video.dub, video.episode)
+            for video in videos_to_process]
+    return [key for key in keys if targets is None or key in targets]
+
+
+def _get_compared_episodes(episodes: list[AvailableVideo], targets: list[VideoKey]) -> list[AvailableVideo]:
+    """
+    Returns the targets and the episodes within episodes_to_match of them, the only ones compared with the targets.
+    The episodes between a target and its kept neighbours are kept too, so the targets have the same neighbours.
+    """
+    target_indexes = [i for i, video in enumerate(episodes)
+                      if VideoKey(video.my_anime_list_id, video.dub, video.episode) in targets]
+    return [video for i, video in enumerate(episodes)
+            if any(abs(i - target_index) <= Config.episodes_to_match for target_index in target_indexes)]
 
 
-def _process_videos(videos_to_match: list[VideoKey], force: bool) -> None:
+def _process_videos(videos_to_match: list[VideoKey],
+                    force: bool,
+                    videos_to_process: list[AvailableVideo] | None = None) -> None:
+    """
+    :param videos_to_process: Videos prepared by the job intake, None to get them now
+    """
     logger.info(f"Received {len(videos_to_match)} videos to match: {videos_to_match}.")
     _ensure_if_all_videos_for_same_group(videos_to_match)
 
-    videos_to_process = _get_videos_to_process(videos_to_match, force)
+    if videos_to_process is None:
+        videos_to_process = _get_videos_to_process(videos_to_match, force)
     if len(videos_to_process) < Config.min_episode_number:
         logger.info("Not enough videos to process. Waiting for new videos...")
         animan_client.upload_empty_scenes(videos_to_match)
@@ -112,32 +178,78 @@ def _process_videos(videos_to_match: list[VideoKey], force: bool) -> None:
 
     logger.info(f"Videos to process ({len(videos_to_process)}): {videos_to_process}")
 
-    # Split videos to process into batches.
-    # Last batch should not contain less than Config.batch_size videos.
-    batches = [videos_to_process[i:i + Config.batch_size]
-               for i in range(0, len(videos_to_process), Config.batch_size)]
-    if len(batches) > 1 and len(batches[-1]) < Config.batch_size:
-        batches[-2].extend(batches.pop())
+    # Split videos to process into balanced batches that overlap by the episodes compared with each other.
+    # The windows of the overlapping episodes are restored from the fingerprint store instead of downloading,
+    # so the batches do not overlap without the store. The batches without the overlap are not shorter than the size.
+    overlapping = Config.overlapping_batches and Config.fingerprints_cache_max_bytes > 0
+    context_size = Config.episodes_to_match if overlapping else 0
+    batches = partition(videos_to_process, resource_governor.get_batch_size(), context_size)
+
+    # Settled neighbours only provide context for the requested videos, so their scenes are not rewritten.
+    requested = videos_to_match if Config.match_requested_only and not force else None
 
     for batch in batches:
-        try:
-            logger.info(f"Processing batch ({len(batch)}): {batch}")
-            _process_batch(batch)
-            logger.info("Batch processed.")
-        except Exception as e:
-            logger.error(f"Error occurred while processing batch: {e}")
-            keys = [VideoKey(video.my_anime_list_id, video.dub, video.episode)
-                    for video in batch]
-            animan_client.upload_empty_scenes(keys)
+        # The scenes of the context episodes are uploaded by the adjacent batches.
+        keys = _get_keys_to_upload(batch.core, requested)
+        if len(keys) == 0:
+            logger.info(f"Skipping batch without requested videos ({len(batch.core)}): {batch.core}")
+            continue
 
+        episodes = batch.episodes if requested is None else _get_compared_episodes(batch.episodes, keys)
+        uploaded_keys: list[VideoKey] = []
+        with metrics.collect() as batch_metrics:
+            try:
+                logger.info(f"Processing batch ({len(batch.core)} + {len(batch.episodes) - len(batch.core)} "
+                            f"context, {len(episodes)} compared): {episodes}")
+                with metrics.timer('batch'):
+                    _process_batch(episodes, keys, uploaded_keys)
+                logger.info("Batch processed.")
+            except Exception as e:
+                logger.error(f"Error occurred while processing batch: {e}")
+                metrics.count('failed_batches')
+                failed_keys = [key for key in keys if key not in uploaded_keys]
+                if len(failed_keys) > 0:
+                    animan_client.upload_empty_scenes(failed_keys)
 
-def main() -> None:
-    logger.info("Initializing the configuration...")
-    load_dotenv()
-    Config.initialize_from_ssm()
-    setup_logging()
+        metrics.export(batch_metrics, {'MyAnimeListId': str(batch.core[0].my_anime_list_id),
+                                       'Dub': batch.core[0].dub,
+                                       'Episodes': f'{batch.core[0].episode}-{batch.core[-1].episode}'})
 
-    logger.info("Starting the data processing...")
+
+def _get_group_key(videos_to_match: list[VideoKey]) -> tuple[int, str]:
+    return videos_to_match[0].my_anime_list_id, videos_to_match[0].dub
+
+
+def _get_group_download_threads() -> int:
+    """
+    Returns the number of download threads for a single group.
+    All parallel groups share the Config.download_threads budget.
+    """
+    fair_share = max(1, Config.download_threads // Config.parallel_groups)
+    if Config.group_download_threads > 0:
+        return min(Config.group_download_threads, fair_share)
+    return fair_share
+
+
+def _process_group_job(videos_to_match: list[VideoKey], slot: int) -> None:
+    """
+    Processes videos of a single group in an isolated temp dir with its share of the download budget.
+    """
+    job_config = {
+        'temp_dir': os.path.join(Config.temp_dir, 'jobs', str(slot)),
+        'cache_dir': Config.cache_dir,
+        'download_threads': str(_get_group_download_threads()),
+    }
+    with Config.override(job_config):
+        try:
+            _process_videos(videos_to_match, force=False)
+        except Exception as ex:
+            logger.error(f"An error occurred in job {slot}: {ex}. "
+                         f"{[x for x in traceback.TracebackException.from_exception(ex).format()]}")
+            animan_client.upload_empty_scenes(videos_to_match)
+
+
+def _run_sequentially() -> None:
     while True:
         logger.info("Getting the data...")
 
@@ -161,4 +273,117 @@ def main() -> None:
                 animan_client.upload_empty_scenes(videos_to_match)
             logger.info("Waiting for 3 seconds...")
             time.sleep(3)
+
+
+def _prepare_job(videos_to_match: list[VideoKey]) -> list[AvailableVideo]:
+    """
+    Gets the videos to process and downloads the first of them into the caches.
+    Nothing is downloaded if the caches are disabled: the processing fetches the playlists again.
+    Called by the job intake while the previous job is processed.
+    """
+    _ensure_if_all_videos_for_same_group(videos_to_match)
+    videos_to_process = _get_videos_to_process(videos_to_match, force=False)
+    if len(videos_to_process) >= Config.min_episode_number:
+        prefetch_audio(videos_to_process[:Config.intake_prefetch_episodes])
+    return videos_to_process
+
+
+def _run_pipelined() -> None:
+    """
+    Processes the groups one by one while the job intake leases and prepares the next group.
+    """
+    with JobIntake(_prepare_job) as intake:
+        while True:
+            videos_to_match: list[VideoKey] = []
+            try:
+                job = intake.get()
+                videos_to_match = job.videos_to_match
+                if job.error is not None:
+                    raise job.error
+
+                _process_videos(videos_to_match, force=False, videos_to_process=job.prepared)
+            except KeyboardInterrupt:
+                logger.error("Shutting down...")
+                break
+            except Exception as ex:
+                logger.error(f"An error occurred: {ex}. "
+                             f"{[x for x in traceback.TracebackException.from_exception(ex).format()]}")
+                if len(videos_to_match) > 0:
+                    animan_client.upload_empty_scenes(videos_to_match)
+                logger.info("Waiting for 3 seconds...")
+                time.sleep(3)
+
+
+def _run_scheduler() -> None:
+    """
+    Runs up to Config.parallel_groups group jobs at the same time.
+    Videos leased for a group that is already being processed are queued behind its job.
+    """
+    running: dict[tuple[int, str], tuple[int, Future[None]]] = {}
+    queued: dict[tuple[int, str], list[VideoKey]] = {}
+    with ThreadPoolExecutor(max_workers=Config.parallel_groups) as executor:
+        while True:
+            try:
+                for group, (_, future) in list(running.items()):
+                    if future.done():
+                        del running[group]
+
+                if len(running) >= Config.parallel_groups:
+                    wait([future for _, future in running.values()], return_when=FIRST_COMPLETED)
+                    continue
+
+                queued_group = next((group for group in queued if group not in running), None)
+                if queued_group is None:
+                    logger.info(f"Getting the data ({len(running)}/{Config.parallel_groups} jobs running)...")
+                    videos_to_match = animan_client.get_videos_to_match().videos_to_match
+                    if len(videos_to_match) == 0:
+                        if len(running) > 0:
+                            logger.info("No videos to match. Waiting for running jobs...")
+                            wait([future for _, future in running.values()], return_when=FIRST_COMPLETED)
+                        else:
+                            logger.info("No videos to match. Waiting for new videos...")
+                            sqs_client.wait_for_notification()
+                        continue
+
+                    group = _get_group_key(videos_to_match)
+                    if group in running:
+                        logger.info(f"Group {group} is already being processed. Queueing the videos behind it...")
+                        group_queue = queued.setdefault(group, [])
+                        group_queue.extend(key for key in videos_to_match if key not in group_queue)
+                        wait([future for _, future in running.values()], return_when=FIRST_COMPLETED)
+                        continue
+                else:
+                    group = queued_group
+                    videos_to_match = queued.pop(group)
+
+                busy_slots = {slot for slot, _ in running.values()}
+                slot = min(set(range(Config.parallel_groups)) - busy_slots)
+                logger.info(f"Starting job {slot} for group {group}.")
+                running[group] = slot, executor.submit(_process_group_job, videos_to_match, slot)
+            except KeyboardInterrupt:
+                logger.error("Shutting down...")
+                for videos_to_match in queued.values():
+                    animan_client.upload_empty_scenes(videos_to_match)
+                break
+            except Exception as ex:
+                logger.error(f"An error occurred: {ex}. "
+                             f"{[x for x in traceback.TracebackException.from_exception(ex).format()]}")
+                logger.info("Waiting for 3 seconds...")
+                time.sleep(3)
+
+
+def main() -> None:
+    logger.info("Initializing the configuration...")
+    load_dotenv()
+    Config.initialize_from_ssm()
+    setup_logging()
+
+    logger.info("Starting the data processing...")
+    with shared_worker_pools():
+        if Config.parallel_groups > 1:
+            _run_scheduler()
+        elif Config.pipelined_intake:
+            _run_pipelined()
+        else:
+            _run_sequentially()
     logger.info("Data processing stopped.")
@@ -3,6 +3,7 @@ import logging
 import watchtower
 
 from Matcher.config.config import Config
+from Matcher.helpers import metrics
 
 fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
@@ -22,3 +23,17 @@ def setup_logging() -> None:
                             logging.StreamHandler(),
                             cloudwatch_handler,
                         ])
+
+    if 'emf' not in metrics.get_export_targets():
+        return
+
+    # CloudWatch extracts the metrics only from the log events that consist of the EMF JSON document alone.
+    emf_handler = watchtower.CloudWatchLogHandler(log_group_name=Config.log_group_name,
+                                                  create_log_group=False,
+                                                  log_stream_name=f'{Config.log_group_name}-metrics',
+                                                  send_interval=10)
+    emf_handler.setFormatter(logging.Formatter('%(message)s'))
+    emf_logger = logging.getLogger('Matcher.metrics.emf')
+    emf_logger.setLevel(logging.INFO)
+    emf_logger.propagate = False
+    emf_logger.handlers = [emf_handler]
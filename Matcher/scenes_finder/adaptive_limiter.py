@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from Matcher.config.config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class Transfer:
+    """Outcome of a download reported to the limiter. The bytes are set by the downloader."""
+    bytes: int = 0
+
+
+class _HostLimiter:
+    """
+    AIMD limit of the concurrent downloads from a single host.
+    The limit is adjusted once per window of completed downloads:
+    it grows by one while the throughput holds up, shrinks by a quarter when the latency grows
+    as the requests queue up at the host and halves right after a failed download.
+    The limit never exceeds the ceiling of the latest download, so the share of the group is kept.
+    """
+
+    # Latency above the lowest observed one multiplied by this factor means that the host is saturated.
+    _LATENCY_TOLERANCE = 2.0
+    # Throughput is considered to hold up if it stays above this share of the previous window.
+    _THROUGHPUT_TOLERANCE = 0.9
+
+    _host: str
+    _limit: float
+    _ceiling: int
+    _active: int = 0
+    _condition: asyncio.Condition
+
+    _window_started_at: float = 0.0
+    _window_requests: int = 0
+    _window_bytes: int = 0
+    _window_latency: float = 0.0
+    _previous_throughput: float = 0.0
+    _min_latency: float = float('inf')
+
+    def __init__(self, host: str, limit: int, ceiling: int):
+        self._host = host
+        self._limit = limit
+        self._ceiling = ceiling
+        self._condition = asyncio.Condition()
+
+    async def acquire(self, ceiling: int) -> None:
+        """
+        :param ceiling: Concurrent downloads the current request may grow to at most
+        """
+        async with self._condition:
+            self._ceiling = ceiling
+            await self._condition.wait_for(lambda: self._active < self._get_limit())
+            if self._active == 0:
+                # Idle time between the episodes would look like a throughput drop.
+                self._reset_window()
+            self._active += 1
+
+    async def release(self) -> None:
+        async with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def on_success(self, transfer_bytes: int, seconds: float) -> None:
+        self._window_requests += 1
+        self._window_bytes += transfer_bytes
+        self._window_latency += seconds
+        if self._window_requests < self._get_limit():
+            return
+
+        throughput = self._window_bytes / max(time.perf_counter() - self._window_started_at, 1e-6)
+        latency = self._window_latency / self._window_requests
+        self._min_latency = min(self._min_latency, latency)
+
+        if latency > self._min_latency * self._LATENCY_TOLERANCE:
+            self._set_limit(self._limit * 0.75, f"latency {latency:.2f}s")
+        elif throughput >= self._previous_throughput * self._THROUGHPUT_TOLERANCE:
+            self._set_limit(self._limit + 1, f"throughput {throughput / 1024 ** 2:.1f} MB/s")
+
+        self._previous_throughput = throughput
+        self._reset_window()
+
+    def on_failure(self) -> None:
+        self._set_limit(self._limit * 0.5, "failed download")
+        self._previous_throughput = 0.0
+        self._reset_window()
+
+    def _get_limit(self) -> int:
+        return max(min(int(self._limit), self._ceiling), 1)
+
+    def _set_limit(self, limit: float, reason: str) -> None:
+        limit = min(max(limit, Config.download_threads_min), self._ceiling)
+        if int(limit) != int(self._limit):
+            logger.info(f"Download concurrency for {self._host}: {int(self._limit)} -> {int(limit)} ({reason})")
+        self._limit = limit
+
+    def _reset_window(self) -> None:
+        self._window_started_at = time.perf_counter()
+        self._window_requests = 0
+        self._window_bytes = 0
+        self._window_latency = 0.0
+
+
+class AdaptiveLimiter:
+    """
+    Limits the concurrent downloads per host and adapts the limits to the observed
+    throughput, latency and failures. The limits are kept for the lifetime of the download engine,
+    so they carry over between the episodes and the batches.
+    A limit starts at the share of Config.download_threads of the download worker
+    and grows up to its share of Config.download_threads_max, so the groups do not take each other's downloads.
+    Must be used from the download engine loop only.
+    """
+
+    _hosts: dict[str, _HostLimiter]
+
+    def __init__(self):
+        self._hosts = {}
+
+    @asynccontextmanager
+    async def acquire(self, host: str) -> AsyncIterator[Transfer]:
+        ceiling = get_process_ceiling()
+        limiter = self._hosts.get(host)
+        if limiter is None:
+            limiter = self._hosts[host] = _HostLimiter(host, get_process_budget(), ceiling)
+
+        await limiter.acquire(ceiling)
+        transfer = Transfer()
+        started_at = time.perf_counter()
+        try:
+            yield transfer
+        except Exception:
+            if Config.adaptive_download_threads:
+                limiter.on_failure()
+            raise
+        else:
+            if Config.adaptive_download_threads:
+                limiter.on_success(transfer.bytes, time.perf_counter() - started_at)
+        finally:
+            await limiter.release()
+
+
+def get_process_budget() -> int:
+    """Returns the share of Config.download_threads of a single download worker of the group."""
+    return max(1, Config.download_threads // max(Config.prefetch_workers, 1))
+
+
+def get_process_ceiling() -> int:
+    """
+    Returns the share of Config.download_threads_max of a single download worker,
+    the download workers of all parallel groups share it.
+    """
+    workers = max(Config.prefetch_workers, 1) * max(Config.parallel_groups, 1)
+    return max(get_process_budget(), Config.download_threads_max // workers)
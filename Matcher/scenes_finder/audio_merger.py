@@ -2,47 +2,165 @@ import asyncio
 import logging
 import os
 import time
+import uuid
+from typing import NamedTuple
 
 import ffmpeg  # type: ignore
+import numpy as np
 from aiohttp import ClientSession
-from retry.api import retry_call
 
 from Matcher.config.config import Config
+from Matcher.helpers import metrics
+from Matcher.helpers import resource_governor
+from Matcher.helpers.disk_cache import DiskCache
+from Matcher.scenes_finder.adaptive_limiter import AdaptiveLimiter
+from Matcher.scenes_finder.download_engine import get_download_engine
+from Matcher.scenes_finder.segment_digests import get_digest
+from Matcher.scenes_finder.segment_fetcher import fetch_segment
+from Matcher.scenes_finder.segment_ref import SegmentRef
 
 logger = logging.getLogger(__name__)
 
+# Sample format -> (ffmpeg raw format, ffmpeg codec, numpy dtype)
+_SAMPLE_FORMATS: dict[str, tuple[str, str, type[np.number]]] = {
+    'int16': ('s16le', 'pcm_s16le', np.int16),
+    'float32': ('f32le', 'pcm_f32le', np.float32),
+}
 
-def download_and_merge_parts(index: int, urls: list[str]) -> str:
+
+class DownloadedRanges(NamedTuple):
+    """
+    Video parts downloaded by download_parts_to_merge, passed to merge_downloaded_parts in another process.
+    """
+    part_index: int
+    ranges: list[list[SegmentRef]]
+    output_paths: list[str]
+    missing_ranges: list[int]  # Indexes of the ranges that were not restored from the cache
+    local_paths: list[str]  # Downloaded parts of the missing ranges in order
+    digests: list[list[str] | None]  # Digests of the segments per range, None if not computed
+
+
+def download_parts_to_merge(index: int, ranges: list[list[SegmentRef]]) -> DownloadedRanges:
     """
-    Downloads video parts from urls and merges them into a single wav file
+    Downloads video parts of all ranges in a single pass to be merged by merge_downloaded_parts.
+    Ranges that were decoded before are restored from the cache without downloading.
+    The segments of the downloaded ranges are hashed if Config.segment_digest_matching is set.
     """
     started_at = time.time()
     os.makedirs(_get_temp_dir(), exist_ok=True)
-    local_paths = _download_parts(urls)
-    logger.debug("Downloaded all video parts.")
 
-    playlist_path = _create_playlist_file(local_paths)
-    logger.debug("Created playlist file.")
+    output_paths = [os.path.normpath(os.path.join(_get_temp_dir(), f'{index}_{range_index}.wav'))
+                    for range_index in range(len(ranges))]
+    decoded_audio_cache = _get_decoded_audio_cache()
+    missing_ranges = [range_index for range_index, range_segments in enumerate(ranges)
+                      if not decoded_audio_cache.copy_to(_get_decoded_audio_key('wav', range_segments),
+                                                         output_paths[range_index])]
+    logger.debug(f"Restored {len(ranges) - len(missing_ranges)}/{len(ranges)} ranges from cache.")
+    metrics.count('decoded_audio_cache_hits', len(ranges) - len(missing_ranges))
 
-    output_path = _merge_parts(index, playlist_path)
-    logger.debug("Merged video parts into wav file.")
+    segments = [segment for range_index in missing_ranges for segment in ranges[range_index]]
+    local_paths = _download_parts(str(index), segments)
+    logger.info(f"Downloaded all video parts in {time.time() - started_at:.2f}s")
 
-    os.remove(playlist_path)
-    for part in local_paths:
+    digests: list[list[str] | None] = [None] * len(ranges)
+    if Config.segment_digest_matching:
+        range_start = 0
+        for range_index in missing_ranges:
+            range_paths = local_paths[range_start:range_start + len(ranges[range_index])]
+            range_start += len(ranges[range_index])
+            digests[range_index] = [_get_file_digest(path) for path in range_paths]
+
+    return DownloadedRanges(index, ranges, output_paths, missing_ranges, local_paths, digests)
+
+
+def merge_downloaded_parts(downloaded: DownloadedRanges) -> list[str]:
+    """
+    Merges the downloaded video parts of each range into its own wav file.
+    """
+    started_at = time.time()
+    decoded_audio_cache = _get_decoded_audio_cache()
+
+    range_start = 0
+    for range_index in downloaded.missing_ranges:
+        range_segments = downloaded.ranges[range_index]
+        range_paths = downloaded.local_paths[range_start:range_start + len(range_segments)]
+        range_start += len(range_segments)
+
+        playlist_path = _create_playlist_file(f'{downloaded.part_index}_{range_index}', range_paths)
+        logger.debug("Created playlist file.")
+
+        output_path = downloaded.output_paths[range_index]
+        _remove_output(output_path)
+        with metrics.timer('decode'):
+            _merge_parts(playlist_path, output_path)
+        decoded_audio_cache.put(_get_decoded_audio_key('wav', range_segments), output_path, keep_source=True)
+        logger.debug("Merged video parts into wav file.")
+
+        os.remove(playlist_path)
+
+    for part in downloaded.local_paths:
         os.remove(part)
     logger.debug("Deleted parts and playlist file.")
+    logger.info(f"Merged in {time.time() - started_at:.2f}s")
+
+    return downloaded.output_paths
+
+
+def download_and_decode_parts(index: int,
+                              ranges: list[list[SegmentRef]]) -> tuple[list[str], list[list[str] | None]]:
+    """
+    Downloads video parts of all ranges and pipes them straight into ffmpeg without intermediate files.
+    Each range is decoded into a .npy file with mono PCM samples, which is memory-mapped by load_pcm.
+    :return: Paths of the .npy files and, if Config.segment_digest_matching is set,
+             the digests of the segments of the downloaded ranges
+    """
+    started_at = time.time()
+    os.makedirs(_get_temp_dir(), exist_ok=True)
+
+    output_paths = [os.path.normpath(os.path.join(_get_temp_dir(), f'{index}_{range_index}.npy'))
+                    for range_index in range(len(ranges))]
+    decoded_audio_cache = _get_decoded_audio_cache()
+    missing_ranges = [range_index for range_index, range_segments in enumerate(ranges)
+                      if not decoded_audio_cache.copy_to(_get_decoded_audio_key('npy', range_segments),
+                                                         output_paths[range_index])]
+    logger.debug(f"Restored {len(ranges) - len(missing_ranges)}/{len(ranges)} ranges from cache.")
+    metrics.count('decoded_audio_cache_hits', len(ranges) - len(missing_ranges))
+
+    logger.debug("Downloading and decoding video parts...")
+    missing_digests = get_download_engine().run(
+        lambda session: _download_and_decode_ranges(session,
+                                                     [ranges[range_index] for range_index in missing_ranges],
+                                                     [output_paths[range_index] for range_index in missing_ranges]))
+    digests: list[list[str] | None] = [None] * len(ranges)
+    for range_index, range_digests in zip(missing_ranges, missing_digests):
+        digests[range_index] = range_digests
+
+    for range_index in missing_ranges:
+        decoded_audio_cache.put(_get_decoded_audio_key('npy', ranges[range_index]), output_paths[range_index],
+                                keep_source=True)
     logger.info(f"Finished in {time.time() - started_at:.2f}s")
 
-    return os.path.normpath(output_path)
+    return output_paths, digests
 
 
-def _download_parts(urls: list[str]) -> list[str]:
+def load_pcm(path: str, offset: float, duration: float, rate: int) -> np.ndarray:
+    """
+    Loads the samples decoded by download_and_decode_parts.
+    The file is memory-mapped, so only the requested window is read from disk.
+    """
+    samples = np.load(path, mmap_mode='r')
+    start = int(offset * rate)
+    end = start + int(duration * rate)
+    return samples[start:end]
+
+
+def _download_parts(prefix: str, segments: list[SegmentRef]) -> list[str]:
     logger.debug("Downloading video parts...")
-    return asyncio.run(_download_all_files(urls))
+    return get_download_engine().run(lambda session: _download_all_files(session, prefix, segments))
 
 
-def _create_playlist_file(parts_paths: list[str]) -> str:
-    playlist_path = os.path.join(_get_temp_dir(), 'playlist.txt')
+def _create_playlist_file(name: str, parts_paths: list[str]) -> str:
+    playlist_path = os.path.join(_get_temp_dir(), f'playlist_{name}.txt')
     with open(playlist_path, 'w') as f:
         for part in parts_paths:
             f.write(f'file {part.replace("\\", "/")}\n')
@@ -51,49 +169,207 @@ def _create_playlist_file(parts_paths: list[str]) -> str:
     return playlist_path
 
 
-def _merge_parts(index: int, playlist_path: str) -> str:
+def _merge_parts(playlist_path: str, output_path: str) -> None:
     """
     Merges video parts into a single wav file
     """
-    output_path = os.path.join(_get_temp_dir(), f'{index}.wav')
     (ffmpeg
      .input(playlist_path, format='concat', safe=0)
-     .output(output_path, ac=1, ar=44100, format='wav', y=None, loglevel="quiet")
+     .output(output_path, ac=1, ar=Config.analysis_sample_rate, acodec=_get_sample_format()[1],
+             format='wav', y=None, loglevel="quiet")
      .run(overwrite_output=True))
     logger.debug(f"Merged video parts into {output_path}")
 
-    return output_path
 
+async def _download_all_files(session: ClientSession, prefix: str, segments: list[SegmentRef]) -> list[str]:
+    limiter = get_download_engine().limiter
+
+    tasks = [_download_part(limiter, session, f'{prefix}_{i}', segment) for i, segment in enumerate(segments)]
+    results = await asyncio.gather(*tasks)
+    return results
+
+
+async def _download_part(limiter: AdaptiveLimiter, session: ClientSession, name: str, segment: SegmentRef) -> str:
+    """
+    Downloads the segment into the temp dir or restores it from the cache.
+    The file is a link or a copy of the cache entry, so the entry may be evicted before the parts are merged.
+    """
+    segments_cache = _get_segments_cache()
+    segment_key = segments_cache.make_key(*segment.get_cache_key_parts())
+    file_path = os.path.join(_get_temp_dir(), f'{name}.ts')
+    if segments_cache.copy_to(segment_key, file_path):
+        metrics.count('segment_cache_hits')
+        return file_path
+
+    data = await fetch_segment(session, limiter, segment)
+    if os.path.exists(file_path):  # TODO: Create a better way to handle temporary files. Content manager?
+        logger.debug(f"File already exists, deleting: {file_path}")
+        os.remove(file_path)
+    with open(file_path, 'wb') as f:
+        f.write(data)
+    logger.debug(f"Downloaded {segment.url} -> {file_path}")
+    segments_cache.put(segment_key, file_path, keep_source=True)
+    return file_path
+
+
+async def _download_and_decode_ranges(session: ClientSession,
+                                      ranges: list[list[SegmentRef]],
+                                      output_paths: list[str]) -> list[list[str] | None]:
+    limiter = get_download_engine().limiter
+
+    tasks = [_download_and_decode_range(limiter, session, range_segments, output_path)
+             for range_segments, output_path in zip(ranges, output_paths)]
+    return list(await asyncio.gather(*tasks))
+
+
+async def _download_and_decode_range(limiter: AdaptiveLimiter,
+                                     session: ClientSession,
+                                     segments: list[SegmentRef],
+                                     output_path: str) -> list[str] | None:
+    """
+    Feeds the segments into a single ffmpeg process in playlist order while they are downloaded concurrently.
+    :return: Digests of the segments if Config.segment_digest_matching is set
+    """
+    raw_format, codec, dtype = _get_sample_format()
+    args = (ffmpeg
+            .input('pipe:0')
+            .output('pipe:1', ac=1, ar=Config.analysis_sample_rate, format=raw_format, acodec=codec,
+                    loglevel="quiet")
+            .compile())
+    process = await asyncio.create_subprocess_exec(*args,
+                                                   stdin=asyncio.subprocess.PIPE,
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.DEVNULL)
+    stdin, stdout = process.stdin, process.stdout
+    assert stdin is not None and stdout is not None
+
+    # Downloads overlap with decoding here, so the time of the whole range is reported as one stage.
+    started_at = time.perf_counter()
+    # Under resource pressure the samples are spilled to disk while they are decoded instead of being kept in memory.
+    spill_path = f'{output_path}.raw' if resource_governor.is_under_pressure() else None
+    reader = asyncio.create_task(_read_pcm(stdout, spill_path))
+    downloads = [asyncio.create_task(_download_part_to_memory(limiter, session, segment))
+                 for segment in segments]
+    digests: list[str] | None = [] if Config.segment_digest_matching else None
+    try:
+        for download in downloads:
+            data = await download
+            stdin.write(data)
+            if digests is not None:
+                digests.append(get_digest(data))
+            await stdin.drain()
+        stdin.close()
+        pcm = await reader
+    finally:
+        for download in downloads:
+            download.cancel()
+        if not reader.done():
+            reader.cancel()
+            if process.returncode is None:
+                process.kill()
+            await process.wait()
+            if spill_path is not None and os.path.exists(spill_path):
+                os.remove(spill_path)
+
+    if await process.wait() != 0:
+        raise RuntimeError(f"ffmpeg exited with code {process.returncode}")
+
+    _remove_output(output_path)
+    if spill_path is None:
+        np.save(output_path, np.frombuffer(pcm, dtype=dtype))
+    else:
+        _save_spilled_pcm(spill_path, output_path, dtype)
+        metrics.count('spilled_ranges')
+    metrics.current().add_time('download_and_decode', time.perf_counter() - started_at, {})
+    logger.debug(f"Decoded {len(segments)} video parts into {output_path}")
+    return digests
+
+
+async def _read_pcm(stdout: asyncio.StreamReader, spill_path: str | None) -> bytes:
+    """
+    Reads the decoded samples into memory or, if the spill path is set, writes them to that file and returns nothing.
+    """
+    if spill_path is None:
+        return await stdout.read()
+
+    with open(spill_path, 'wb') as f:
+        while chunk := await stdout.read(1024 * 1024):
+            f.write(chunk)
+    return b''
+
+
+def _save_spilled_pcm(spill_path: str, output_path: str, dtype: type[np.number]) -> None:
+    """
+    Converts the raw samples into a .npy file through memory-mapped files, so they are never loaded at once.
+    """
+    if os.path.getsize(spill_path) == 0:
+        np.save(output_path, np.empty(0, dtype=dtype))
+    else:
+        samples = np.memmap(spill_path, dtype=dtype, mode='r')
+        output = np.lib.format.open_memmap(output_path, mode='w+', dtype=dtype, shape=samples.shape)
+        chunk_size = 1024 * 1024
+        for start in range(0, samples.shape[0], chunk_size):
+            output[start:start + chunk_size] = samples[start:start + chunk_size]
+        output.flush()
+        del output, samples
+    os.remove(spill_path)
+
+
+async def _download_part_to_memory(limiter: AdaptiveLimiter, session: ClientSession, segment: SegmentRef) -> bytes:
+    segments_cache = _get_segments_cache()
+    segment_key = segments_cache.make_key(*segment.get_cache_key_parts())
+    cached_path = segments_cache.get(segment_key)
+    if cached_path is not None:
+        metrics.count('segment_cache_hits')
+        with open(cached_path, 'rb') as f:
+            return f.read()
+
+    data = await fetch_segment(session, limiter, segment)
+
+    if segments_cache.enabled:
+        file_path = os.path.join(_get_temp_dir(), f'{segment_key}.{uuid.uuid4().hex}.ts')
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        segments_cache.put(segment_key, file_path)
+
+    return data
+
+
+def _remove_output(path: str) -> None:
+    """
+    Removes the output file left by a failed batch before it is written in place.
+    The file may be a link to a cache entry, which would be overwritten with it.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _get_file_digest(path: str) -> str:
+    with open(path, 'rb') as f:
+        return get_digest(f.read())
+
+
+def _get_sample_format() -> tuple[str, str, type[np.number]]:
+    sample_format = Config.analysis_sample_format
+    if sample_format not in _SAMPLE_FORMATS:
+        raise ValueError(f"Unsupported sample format: {sample_format}. Expected one of {list(_SAMPLE_FORMATS)}.")
+    return _SAMPLE_FORMATS[sample_format]
 
-async def _download_all_files(urls: list[str]) -> list[str]:
-    sem = asyncio.Semaphore(Config.download_threads)
 
-    async with ClientSession() as session:
-        tasks = [_download_part_retried(sem, session, i, url) for i, url in enumerate(urls)]
-        results = await asyncio.gather(*tasks)
-        return results
+def _get_decoded_audio_key(audio_format: str, segments: list[SegmentRef]) -> str:
+    return DiskCache.make_key('ac=1',
+                              f'ar={Config.analysis_sample_rate}',
+                              f'sample_format={Config.analysis_sample_format}',
+                              f'format={audio_format}',
+                              *[part for segment in segments for part in segment.get_cache_key_parts()])
 
 
-async def _download_part_retried(sem: asyncio.Semaphore, session: ClientSession, index: int, url: str) -> str:
-    return await retry_call(_download_part,
-                            fkwargs={'sem': sem, 'session': session, 'index': index, 'url': url},
-                            tries=Config.download_max_retries_for_ts,
-                            delay=1,
-                            logger=logger)
+def _get_segments_cache() -> DiskCache:
+    return DiskCache(os.path.join(Config.cache_dir, 'segments'), Config.segments_cache_max_bytes)
 
 
-async def _download_part(sem: asyncio.Semaphore, session: ClientSession, index: int, url: str) -> str:
-    async with sem:
-        async with session.get(url) as response:
-            file_path = os.path.join(_get_temp_dir(), f'{index}.ts')
-            if os.path.exists(file_path):  # TODO: Create a better way to handle temporary files. Content manager?
-                logger.debug(f"File already exists, deleting: {file_path}")
-                os.remove(file_path)
-            with open(file_path, 'wb') as f:
-                async for data in response.content.iter_chunked(1024 * 1024):
-                    f.write(data)
-            logger.debug(f"Downloaded {url} -> {file_path}")
-            return file_path
+def _get_decoded_audio_cache() -> DiskCache:
+    return DiskCache(os.path.join(Config.cache_dir, 'decoded_audio'), Config.decoded_audio_cache_max_bytes)
 
 
 def _get_temp_dir() -> str:
@@ -1,95 +1,355 @@
 import logging
 import os
-from typing import Iterator
+from typing import Iterator, Iterable, NamedTuple
 
 import m3u8
 
 from Matcher.config.config import Config
-from Matcher.helpers.not_none import not_none
+from Matcher.helpers import metrics
 from Matcher.helpers.pre_request import PreRequestQueue
-from Matcher.scenes_finder.audio_merger import download_and_merge_parts
+from Matcher.scenes_finder import fingerprint_store
+from Matcher.scenes_finder.fingerprint_store import Part
+from Matcher.scenes_finder.audio_merger import download_and_decode_parts, download_parts_to_merge, \
+    merge_downloaded_parts, DownloadedRanges
+from Matcher.scenes_finder.segment_digests import get_window_digests
+from Matcher.scenes_finder.segment_ref import SegmentRef, get_segment_refs, get_init_segment_ref, is_truncatable
 
 logger = logging.getLogger(__name__)
 
+type _AudioFileInfo = tuple[str, float]
+type _AudioWindow = tuple[str, float, float]  # Path, offset and duration of the window to analyse
+
+
+class _DownloadedEpisode(NamedTuple):
+    """Video parts of the episode waiting to be merged and the durations of its opening and ending parts."""
+    ranges: DownloadedRanges
+    opening_duration: float
+    ending_duration: float
+
 
 class AudioProvider:
-    """Class that downloads and merges audio segments into a single wav file."""
+    """
+    Class that downloads the beginning and the end of each episode in a single pass
+    and decodes them into audio files for the openings and the endings recognizers.
+    The files are .wav files or, if Config.streaming_decode is set, .npy files for audio_merger.load_pcm.
+    The .wav files are merged by a separate pool of decode workers while the next episodes are downloaded.
+    The episodes found in the fingerprint store are restored as .npy files with the analysed windows only.
+    An episode that fails to download is retried and then skipped, so the other episodes are still yielded.
+    The iterators yield the indexes of the episodes in the source order along with the files.
+    """
 
     _DELETE_TEMP_FILES = True  # Set to False for debugging purposes
 
-    _truncated_durations_per_episode: list[float] = []
-    _initialized: bool = False
-    _completed: bool = False
+    # Share of a segment downloaded on top of the estimated one when the last segment is truncated.
+    _PARTIAL_SEGMENT_MARGIN = 0.1
 
-    _playlists: list[m3u8.M3U8]
-    _opening: bool
+    _episodes_iter: Iterator[tuple[str, m3u8.M3U8]]
+    _episodes: list[tuple[str, m3u8.M3U8]]
 
-    def __init__(self, playlists: list[m3u8.M3U8], opening: bool):
-        self._playlists = playlists
-        self._opening = opening
+    _opening_durations: list[float]
+    _ending_durations: list[float]
+    _pending_endings: list[tuple[int, _AudioWindow]]
+    _failed_episodes: list[int]
 
-    def get_iterator(self) -> Iterator[tuple[str, float, float]]:
-        """Generator that downloads and merges .wav files for each playlist."""
-        assert not self._initialized, "WavProcessor cannot be used twice."
-        self._initialized = True
+    _openings_initialized: bool = False
+    _openings_completed: bool = False
+    _endings_initialized: bool = False
+    _endings_completed: bool = False
 
-        if len(self._playlists) < 2:
-            self._completed = True
-            return
+    def __init__(self, episodes: Iterable[tuple[str, m3u8.M3U8]]):
+        """
+        :param episodes: Ids of the episodes in the fingerprint store and their playlists.
+                         They are consumed lazily, so the download of the first episode
+                         starts as soon as its playlist is available.
+        """
+        self._episodes_iter = iter(episodes)
+        self._episodes = []
+        self._opening_durations = []
+        self._ending_durations = []
+        self._pending_endings = []
+        self._failed_episodes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # Endings are kept on disk until they are consumed, so remove the leftovers if the recognizer failed.
+        for _, (path, _, _) in self._pending_endings:
+            self._delete_temp_file(path)
+        self._pending_endings.clear()
+
+    def get_openings_iterator(self) -> Iterator[tuple[int, _AudioWindow]]:
+        """
+        Generator that downloads both parts of each playlist and yields the audio files with openings.
+        The audio files with endings are kept for get_endings_iterator.
+        """
+        assert not self._openings_initialized, "Openings iterator cannot be used twice."
+        self._openings_initialized = True
+
+        for index, opening, ending in self._iterate_episodes():
+            self._pending_endings.append((index, ending))
+            yield index, opening
+
+            self._delete_temp_file(opening[0])
+
+        self._openings_completed = True
+
+    def get_episodes_iterator(self) -> Iterator[tuple[int, _AudioWindow, _AudioWindow]]:
+        """
+        Generator that downloads both parts of each playlist and yields the audio files
+        with the opening and the ending of each episode together.
+        Can be used instead of the openings and endings iterators.
+        """
+        assert not self._openings_initialized, "Episodes iterator cannot be used with other iterators."
+        self._openings_initialized = True
+        self._endings_initialized = True
+
+        for index, opening, ending in self._iterate_episodes():
+            yield index, opening, ending
 
+            self._delete_temp_file(opening[0])
+            self._delete_temp_file(ending[0])
+
+        self._openings_completed = True
+        self._endings_completed = True
+
+    def get_endings_iterator(self) -> Iterator[tuple[int, _AudioWindow]]:
+        """Generator that yields the audio files with endings downloaded by get_openings_iterator."""
+        assert self._openings_completed, "Openings iterator must be completed before endings."
+        assert not self._endings_initialized, "Endings iterator cannot be used twice."
+        self._endings_initialized = True
+
+        while self._pending_endings:
+            index, (path, offset, duration) = self._pending_endings[0]
+            yield index, (path, offset, duration)
+
+            self._pending_endings.pop(0)
+            self._delete_temp_file(path)
+
+        self._endings_completed = True
+
+    @property
+    def opening_truncated_durations(self) -> list[float]:
+        """Returns the list of truncated durations of the openings part per yielded episode."""
+        assert self._openings_completed, "Openings iterator must be completed before calling this method."
+        return self._opening_durations
+
+    @property
+    def ending_truncated_durations(self) -> list[float]:
+        """Returns the list of truncated durations of the endings part per yielded episode."""
+        assert self._endings_completed, "Endings iterator must be completed before calling this method."
+        return self._ending_durations
+
+    @property
+    def failed_episodes(self) -> list[int]:
+        """Returns the indexes of the episodes that were skipped because they failed to download."""
+        return self._failed_episodes
+
+    def _iterate_episodes(self) -> Iterator[tuple[int, _AudioWindow, _AudioWindow]]:
+        """
+        Downloads the episodes in advance and yields their openings and endings in the episodes order.
+        """
         config_dict = Config.export()
-        with PreRequestQueue[[m3u8.M3U8, bool, int], tuple[str, float]](config_dict) as queue:
-            queue.pre_request(0, self._get_wav, self._playlists[0], self._opening, 0)
+        with PreRequestQueue[[str, m3u8.M3U8, int], tuple[_AudioFileInfo, _AudioFileInfo]](config_dict) as queue:
+            next_to_request = self._request_ahead(queue, 0, 0)
+            if not self._load_episode(1):
+                return
 
-            for i, playlist in enumerate(self._playlists):
+            i = 0
+            while self._load_episode(i):
+                next_to_request = self._request_ahead(queue, i, next_to_request)
 
                 # Retrieve previous request result
-                wav_path, segments_duration = queue.pop_result(i)
-                if i + 1 < len(self._playlists):
-                    # Start next download in advance
-                    queue.pre_request(i + 1, self._get_wav, self._playlists[i + 1], self._opening, i + 1)
+                with metrics.timer('download_wait'):
+                    audio_files = self._pop_episode(queue, i)
 
-                truncated_duration = min(segments_duration, Config.seconds_to_match)
-                offset = 0 if self._opening else max(segments_duration - Config.seconds_to_match, 0)
+                # Start next downloads in advance
+                next_to_request = self._request_ahead(queue, i, next_to_request)
 
-                self._truncated_durations_per_episode.append(truncated_duration)
-                yield wav_path, offset, truncated_duration
+                if audio_files is None:
+                    i += 1
+                    continue
+                (opening_path, opening_duration), (ending_path, ending_duration) = audio_files
+                metrics.count('episodes')
 
-                if self._DELETE_TEMP_FILES and os.path.exists(wav_path):
-                    os.remove(wav_path)
+                truncated_opening_duration = min(opening_duration, Config.seconds_to_match)
+                self._opening_durations.append(truncated_opening_duration)
 
-        self._completed = True
+                truncated_ending_duration = min(ending_duration, Config.seconds_to_match)
+                ending_offset = max(ending_duration - Config.seconds_to_match, 0)
+                self._ending_durations.append(truncated_ending_duration)
 
-    @property
-    def truncated_durations(self) -> list[float]:
-        """Returns the list of truncated durations per episode."""
-        assert self._completed, "WavProcessor must be completed before calling this method."
-        return self._truncated_durations_per_episode
+                yield (i,
+                       (opening_path, 0, truncated_opening_duration),
+                       (ending_path, ending_offset, truncated_ending_duration))
+                i += 1
+
+    def _pop_episode(self,
+                     queue: PreRequestQueue[[str, m3u8.M3U8, int], tuple[_AudioFileInfo, _AudioFileInfo]],
+                     index: int) -> tuple[_AudioFileInfo, _AudioFileInfo] | None:
+        """
+        Waits for the requested episode and downloads it again if the download failed.
+        The segments downloaded before the failure are reused from the segments cache.
+        :return: Audio files of the episode or None if all attempts failed and the episode is skipped
+        """
+        for attempt in range(Config.episode_download_retries + 1):
+            if attempt > 0:
+                logger.warning(f"Retrying download of episode {index}...")
+                metrics.count('episode_retries')
+                self._pre_request(queue, index)
+            try:
+                return queue.pop_result(index)
+            except Exception as e:
+                logger.error(f"Failed to download episode {index}: {e!r}")
+
+        logger.error(f"Skipping episode {index}")
+        metrics.count('failed_episodes')
+        self._failed_episodes.append(index)
+        return None
+
+    def _request_ahead(self,
+                       queue: PreRequestQueue[[str, m3u8.M3U8, int], tuple[_AudioFileInfo, _AudioFileInfo]],
+                       current: int,
+                       next_to_request: int) -> int:
+        """
+        Requests the current episode if it was not requested yet
+        and as many following episodes as the queue has capacity for.
+        :return: Index of the next episode to request
+        """
+        while ((next_to_request <= current or queue.has_capacity())
+               and self._load_episode(next_to_request)):
+            self._pre_request(queue, next_to_request)
+            next_to_request += 1
+
+        return next_to_request
+
+    def _pre_request(self,
+                     queue: PreRequestQueue[[str, m3u8.M3U8, int], tuple[_AudioFileInfo, _AudioFileInfo]],
+                     index: int) -> None:
+        queue.pre_request_staged(index, self._download_audio_files, self._merge_audio_files,
+                                 *self._episodes[index], index)
+
+    def _load_episode(self, index: int) -> bool:
+        """
+        Takes episodes from the source until the one with the given index is loaded.
+        :return: True if the episode exists, False if the source has fewer episodes
+        """
+        while len(self._episodes) <= index:
+            episode = next(self._episodes_iter, None)
+            if episode is None:
+                return False
+            self._episodes.append(episode)
+
+        return True
+
+    def _delete_temp_file(self, path: str) -> None:
+        if self._DELETE_TEMP_FILES and os.path.exists(path):
+            os.remove(path)
+
+    @staticmethod
+    def prefetch(episode_id: str, playlist: m3u8.M3U8, episode: int) -> None:
+        """
+        Downloads and decodes the episode into the caches, so the episode is restored from them later.
+        Warn: this method is called in separate subprocesses.
+        """
+        for path, _ in AudioProvider._merge_audio_files(
+                AudioProvider._download_audio_files(episode_id, playlist, episode)):
+            os.remove(path)
 
     @staticmethod
-    def _get_wav(playlist: m3u8.M3U8, opening: bool, episode: int) -> tuple[str, float]:
+    def _download_audio_files(episode_id: str,
+                              playlist: m3u8.M3U8,
+                              episode: int) -> tuple[_AudioFileInfo, _AudioFileInfo] | _DownloadedEpisode:
         """
-        Downloads and merges audio segments into a single wav file.
+        Downloads the beginning and the end of the episode in a single pass.
+        The streamed parts are decoded while they are downloaded, the others are merged by _merge_audio_files.
         Warn: this method is called in separate subprocesses.
         """
-        segments, current_duration = AudioProvider._build_segments_list(playlist, opening)
-        wav_path = download_and_merge_parts(episode, segments)
-        return wav_path, current_duration
+        stored_opening = fingerprint_store.load_window(episode_id, 'opening')
+        stored_ending = fingerprint_store.load_window(episode_id, 'ending')
+        if stored_opening is not None and stored_ending is not None:
+            logger.info(f"Restored episode {episode} from the fingerprint store")
+            metrics.count('fingerprint_hits')
+            return stored_opening, stored_ending
+        for stored in (stored_opening, stored_ending):
+            if stored is not None:
+                os.remove(stored[0])
+
+        opening_segments, opening_duration = AudioProvider._build_segments_list(playlist, True)
+        ending_segments, ending_duration = AudioProvider._build_segments_list(playlist, False)
+        if Config.streaming_decode:
+            (opening_path, ending_path), (opening_digests, ending_digests) = download_and_decode_parts(
+                episode, [opening_segments, ending_segments])
+            AudioProvider._save_segment_digests(episode_id, 'opening', opening_segments, opening_digests,
+                                                opening_duration)
+            AudioProvider._save_segment_digests(episode_id, 'ending', ending_segments, ending_digests,
+                                                ending_duration)
+            return (opening_path, opening_duration), (ending_path, ending_duration)
+
+        downloaded = download_parts_to_merge(episode, [opening_segments, ending_segments])
+        opening_digests, ending_digests = downloaded.digests
+        AudioProvider._save_segment_digests(episode_id, 'opening', opening_segments, opening_digests, opening_duration)
+        AudioProvider._save_segment_digests(episode_id, 'ending', ending_segments, ending_digests, ending_duration)
+        return _DownloadedEpisode(downloaded, opening_duration, ending_duration)
 
     @staticmethod
-    def _build_segments_list(playlist: m3u8.M3U8, opening: bool) -> tuple[list[str], float]:
+    def _merge_audio_files(
+            audio_files: tuple[_AudioFileInfo, _AudioFileInfo] | _DownloadedEpisode
+    ) -> tuple[_AudioFileInfo, _AudioFileInfo]:
         """
-        Builds a list of segment URIs based on whether it's an opening or not.
+        Merges the downloaded parts of the episode into an audio file per part.
+        Warn: this method is called in separate subprocesses.
+        """
+        if not isinstance(audio_files, _DownloadedEpisode):
+            return audio_files
+
+        opening_path, ending_path = merge_downloaded_parts(audio_files.ranges)
+        return (opening_path, audio_files.opening_duration), (ending_path, audio_files.ending_duration)
+
+    @staticmethod
+    def _save_segment_digests(episode_id: str,
+                              part: Part,
+                              segments: list[SegmentRef],
+                              digests: list[str] | None,
+                              duration: float) -> None:
+        """
+        Stores the digests of the segments positioned in the window analysed by the recognizer.
+        Warn: this method is called in separate subprocesses.
+        """
+        if digests is None:
+            return
+
+        window_duration = min(duration, Config.seconds_to_match)
+        window_offset = 0 if part == 'opening' else duration - window_duration
+        fingerprint_store.save_segment_digests(episode_id, part,
+                                               get_window_digests(segments, digests, window_offset, window_duration))
+
+    @staticmethod
+    def _build_segments_list(playlist: m3u8.M3U8, opening: bool) -> tuple[list[SegmentRef], float]:
+        """
+        Builds a list of segments based on whether it's an opening or not.
+        The last segment of the opening is truncated to the matched window if the container allows it.
         Warn: this method is called in separate subprocesses.
         """
         current_duration = 0.0
-        segments = []
+        segments: list[SegmentRef] = []
+        truncatable = opening and is_truncatable(playlist)
 
-        segment_iter = playlist.segments if opening else reversed(playlist.segments)
+        segment_refs = get_segment_refs(playlist)
+        segment_iter = segment_refs if opening else reversed(segment_refs)
         for segment in segment_iter:
-            segments.append(not_none(segment.uri)) if opening else segments.insert(0, not_none(segment.uri))
-            current_duration += not_none(segment.duration)
+            remaining_duration = Config.seconds_to_match - current_duration
+            if truncatable and segment.duration > remaining_duration:
+                fraction = remaining_duration / segment.duration + AudioProvider._PARTIAL_SEGMENT_MARGIN
+                segment = segment._replace(fraction=min(fraction, 1.0))
+
+            segments.append(segment) if opening else segments.insert(0, segment)
+            current_duration += segment.duration
             if current_duration >= Config.seconds_to_match:
                 break
 
+        init_segment = get_init_segment_ref(playlist)
+        if init_segment is not None:
+            segments.insert(0, init_segment)
+
         return segments, current_duration
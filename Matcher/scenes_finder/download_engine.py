@@ -0,0 +1,93 @@
+import asyncio
+import atexit
+import logging
+import os
+import threading
+from typing import Callable, Awaitable, TypeVar
+
+from aiohttp import ClientSession, TCPConnector
+
+from Matcher.config.config import Config
+from Matcher.scenes_finder.adaptive_limiter import AdaptiveLimiter
+
+T = TypeVar('T')
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadEngine:
+    """
+    Long-lived event loop with an HTTP session shared by all downloads of the process.
+    Keeps connections to the CDN hosts alive between segments, episodes and batches,
+    as well as the download concurrency learned for each host.
+    """
+
+    _loop: asyncio.AbstractEventLoop
+    _thread: threading.Thread
+    _session: ClientSession | None = None
+    _limiter: AdaptiveLimiter
+
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._limiter = AdaptiveLimiter()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='download-engine', daemon=True)
+        self._thread.start()
+        logger.debug("Download engine started.")
+
+    def run(self, func: Callable[[ClientSession], Awaitable[T]]) -> T:
+        """
+        Runs the coroutine function with the shared session on the engine loop and waits for the result.
+        """
+        return asyncio.run_coroutine_threadsafe(self._run(func), self._loop).result()
+
+    @property
+    def limiter(self) -> AdaptiveLimiter:
+        """
+        Per-host download concurrency limits. Must be used by the coroutines running on the engine loop.
+        """
+        return self._limiter
+
+    def close(self) -> None:
+        """
+        Closes the pooled connections and stops the engine loop.
+        """
+        if self._session is not None and not self._session.closed:
+            asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        logger.debug("Download engine stopped.")
+
+    async def _run(self, func: Callable[[ClientSession], Awaitable[T]]) -> T:
+        return await func(self._get_session())
+
+    def _get_session(self) -> ClientSession:
+        if self._session is None or self._session.closed:
+            connector = TCPConnector(limit=Config.http_max_connections,
+                                     limit_per_host=Config.http_max_connections_per_host,
+                                     use_dns_cache=True,
+                                     ttl_dns_cache=Config.http_dns_cache_ttl_secs,
+                                     keepalive_timeout=Config.http_keepalive_timeout_secs)
+            self._session = ClientSession(connector=connector)
+            logger.debug("HTTP session created.")
+
+        return self._session
+
+
+_engine: DownloadEngine | None = None
+_engine_pid: int | None = None
+_engine_lock = threading.Lock()
+
+
+def get_download_engine() -> DownloadEngine:
+    """
+    Returns the download engine of the current process, creating it on first use.
+    """
+    global _engine, _engine_pid
+    with _engine_lock:
+        # A forked process inherits the object, but not the thread running its loop.
+        if _engine is None or _engine_pid != os.getpid():
+            _engine = DownloadEngine()
+            _engine_pid = os.getpid()
+            atexit.register(_engine.close)
+
+        return _engine
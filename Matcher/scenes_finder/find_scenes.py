@@ -1,69 +1,353 @@
 import logging
 import math
+import os
+import shutil
 import warnings
+from concurrent.futures import ThreadPoolExecutor, Future
 from statistics import median
+from typing import Iterator, NamedTuple
+from urllib.parse import urlparse
 
 import m3u8
+import numpy as np
+import requests
 from m3u8 import M3U8
 from series_intro_recognizer.config import Config as SirConfig
-from series_intro_recognizer.processors.audio_files import recognise_from_audio_files_with_offsets
+from series_intro_recognizer.processors.audio_files import _load, recognise_from_audio_files_with_offsets
+from series_intro_recognizer.processors.audio_samples import recognise_from_audio_samples
+from series_intro_recognizer.tp.interval import Interval as SirInterval
 
 from Common.py.models import VideoKey, Interval, Scenes
 from LoanApi.LoanApi.get_playlist import get_playlist
 from LoanApi.LoanApi.models import AvailableVideo, DownloadableVideo
 from Matcher.config.config import Config
+from Matcher.helpers import metrics, pre_request
 from Matcher.helpers.not_none import not_none
+from Matcher.scenes_finder.audio_merger import load_pcm
+from Matcher.scenes_finder import fingerprint_store, progressive_window, scene_priors
 from Matcher.scenes_finder.audio_provider import AudioProvider
+from Matcher.scenes_finder.incremental_recognizer import IncrementalRecognizer
 
 logger = logging.getLogger(__name__)
 
 
-def find_scenes(videos_to_process: list[AvailableVideo]) -> list[tuple[VideoKey, Scenes]]:
-    logger.debug("Processing videos")
+class _Episode(NamedTuple):
+    """Id of the episode in the fingerprint store and whether its scenes are requested."""
+    episode_id: str
+    target: bool
+
 
-    playlists_and_durations = [_get_playlist_and_duration(video)
-                               for video in videos_to_process]
+def find_scenes(videos_to_process: list[AvailableVideo],
+                targets: list[VideoKey] | None = None) -> list[tuple[VideoKey, Scenes]]:
+    """
+    Finds the scenes of the videos.
+    :param videos_to_process: Consecutive videos of the same group
+    :param targets: Videos to return the scenes for, None for all of them.
+                    The other videos are only compared with the targets.
+    """
+    logger.debug("Processing videos")
 
+    video_keys = [VideoKey(video.my_anime_list_id, video.dub, video.episode)
+                  for video in videos_to_process]
+    with ThreadPoolExecutor(max_workers=Config.playlist_fetch_threads) as executor:
+        playlist_futures = [executor.submit(metrics.bind(_try_get_playlist_and_duration), video)
+                            for video in videos_to_process]
+        window = scene_priors.get_window(video_keys) or progressive_window.get_initial_window()
+        found_scenes = _get_scenes_by_playlists(_iterate_non_empty_episodes(video_keys, playlist_futures, targets),
+                                                window)
+
+    playlists_and_durations = [future.result() for future in playlist_futures]
     empty_playlist_indexes = [i for i, playlist_and_duration in enumerate(playlists_and_durations)
                               if playlist_and_duration is None]
-    non_empty_playlists = [playlist_and_duration
-                           for _, playlist_and_duration in enumerate(playlists_and_durations)
-                           if playlist_and_duration is not None]
     if len(empty_playlist_indexes) > 0:
         logger.warning(f"Skipping empty episodes: {empty_playlist_indexes}")
 
-    found_scenes = _get_scenes_by_playlists(non_empty_playlists)
-
     all_scenes: list[Scenes] = list(found_scenes)
     for index in empty_playlist_indexes:
         all_scenes.insert(index, Scenes(None, None, None))
 
+    result = [(video_key, scenes) for video_key, scenes in zip(video_keys, all_scenes)
+              if _is_target(video_key, targets)]
+    scene_priors.save_scenes([(video_key, scenes, playlist_and_duration[1])
+                              for video_key, scenes, playlist_and_duration
+                              in zip(video_keys, all_scenes, playlists_and_durations)
+                              if playlist_and_duration is not None and _is_target(video_key, targets)])
+
+    return result
+
+
+def iterate_scenes(videos_to_process: list[AvailableVideo],
+                   targets: list[VideoKey] | None = None) -> Iterator[tuple[VideoKey, Scenes]]:
+    """
+    Yields the scenes of each episode as soon as the episodes_to_match episodes after it are matched,
+    so the results can be uploaded before the whole batch is processed.
+    The episodes are yielded in no particular order. Unlike find_scenes, the openings are fixed
+    with the median duration of the openings recognised so far instead of the whole batch.
+    :param targets: Videos to yield the scenes for, None for all of them
+    """
+    logger.debug("Processing videos incrementally")
+
+    sir_config = _get_sir_config()
     video_keys = [VideoKey(video.my_anime_list_id, video.dub, video.episode)
                   for video in videos_to_process]
-    result = list(zip(video_keys, all_scenes))
 
-    return result
+    # Filled while the audio provider consumes the playlists.
+    keys_and_durations: list[tuple[VideoKey, float]] = []
+    episodes: list[_Episode] = []
+    skipped_keys: list[VideoKey] = []
+
+    with ThreadPoolExecutor(max_workers=Config.playlist_fetch_threads) as executor:
+        playlist_futures = [executor.submit(metrics.bind(_try_get_playlist_and_duration), video)
+                            for video in videos_to_process]
+
+        def iterate_episodes() -> Iterator[tuple[str, M3U8]]:
+            for video_key, future in zip(video_keys, playlist_futures):
+                playlist_and_duration = future.result()
+                if playlist_and_duration is None:
+                    logger.warning(f"Skipping empty episode: {video_key}")
+                    if _is_target(video_key, targets):
+                        skipped_keys.append(video_key)
+                    continue
+
+                playlist, total_duration = playlist_and_duration
+                episode = _Episode(fingerprint_store.get_episode_id(video_key, playlist),
+                                   _is_target(video_key, targets))
+                keys_and_durations.append((video_key, total_duration))
+                episodes.append(episode)
+                yield episode.episode_id, playlist
+
+        openings_recognizer = IncrementalRecognizer(sir_config, 'opening')
+        endings_recognizer = IncrementalRecognizer(sir_config, 'ending')
+        # Indexes of the episodes pushed to the recognizers, the episodes that failed to download are not pushed.
+        pushed_indexes: list[int] = []
+        truncated_durations: dict[int, tuple[float, float]] = {}
+        opening_durations: list[float] = []
+        openings: dict[int, Interval] = {}
+        endings: dict[int, Interval] = {}
+
+        def complete(finalized_openings: list[tuple[int, SirInterval]],
+                     finalized_endings: list[tuple[int, SirInterval]]) -> Iterator[tuple[VideoKey, Scenes]]:
+            with metrics.timer('fix_up'):
+                for pushed_index, lib_opening in finalized_openings:
+                    index = pushed_indexes[pushed_index]
+                    opening = Interval(lib_opening.start, lib_opening.end)
+                    opening_durations.append(opening.end - opening.start)
+                    openings[index] = _fix_opening(opening, keys_and_durations[index][1], median(opening_durations))
+                for pushed_index, lib_ending in finalized_endings:
+                    index = pushed_indexes[pushed_index]
+                    ending = Interval(lib_ending.start, lib_ending.end)
+                    endings[index] = _fix_ending(ending, keys_and_durations[index][1], truncated_durations[index][1])
+
+            for index in sorted(openings.keys() & endings.keys()):
+                video_key, total_duration = keys_and_durations[index]
+                scenes = _combine_scenes(openings.pop(index), endings.pop(index), total_duration)
+                if episodes[index].target:
+                    yield video_key, _round_scenes(scenes)
+
+            while skipped_keys:
+                yield skipped_keys.pop(0), Scenes(None, None, None)
+
+        with AudioProvider(iterate_episodes()) as audio_provider:
+            for index, opening_window, ending_window in audio_provider.get_episodes_iterator():
+                pushed_indexes.append(index)
+                truncated_durations[index] = (opening_window[2], ending_window[2])
+                episode_id, target = episodes[index]
+                opening_samples = _load_and_store_samples(opening_window, episode_id, 'opening', sir_config)
+                finalized_openings = openings_recognizer.push(opening_samples, episode_id, target)
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    ending_samples = _load_and_store_samples(ending_window, episode_id, 'ending', sir_config)
+                    finalized_endings = endings_recognizer.push(ending_samples, episode_id, target)
+
+                yield from complete(finalized_openings, finalized_endings)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            finalized_openings, finalized_endings = openings_recognizer.finish(), endings_recognizer.finish()
+        yield from complete(finalized_openings, finalized_endings)
+
+    # The audio provider skips the episodes that failed to download
+    # and yields nothing if there are fewer than two episodes to compare.
+    for index, ((video_key, _), episode) in enumerate(zip(keys_and_durations, episodes)):
+        if episode.target and index not in truncated_durations:
+            yield video_key, Scenes(None, None, None)
+    while skipped_keys:
+        yield skipped_keys.pop(0), Scenes(None, None, None)
+
+
+def prefetch_audio(videos: list[AvailableVideo]) -> None:
+    """
+    Downloads the episodes into the caches in the shared worker pool, one episode at a time,
+    so the processing of the videos later starts with them.
+    Only the caches are kept, so nothing is prefetched if both the segments and the decoded audio caches
+    are disabled. The processing fetches the playlists again, as their segment URLs may expire meanwhile.
+    """
+    if Config.segments_cache_max_bytes <= 0 and Config.decoded_audio_cache_max_bytes <= 0:
+        return
+
+    config = {**Config.export(), 'temp_dir': os.path.join(Config.temp_dir, 'intake')}
+    try:
+        for index, video in enumerate(videos):
+            playlist_and_duration = _try_get_playlist_and_duration(video)
+            if playlist_and_duration is None:
+                continue
+
+            playlist, _ = playlist_and_duration
+            video_key = VideoKey(video.my_anime_list_id, video.dub, video.episode)
+            with metrics.timer('intake_prefetch'):
+                pre_request.run_in_shared_pool(config, AudioProvider.prefetch,
+                                               fingerprint_store.get_episode_id(video_key, playlist), playlist, index)
+            logger.info(f"Prefetched episode {video_key}")
+    finally:
+        # The prefetched episodes are kept in the caches, only the files of the failed downloads are left here.
+        shutil.rmtree(config['temp_dir'], ignore_errors=True)
+
+
+def _is_target(video_key: VideoKey, targets: list[VideoKey] | None) -> bool:
+    return targets is None or video_key in targets
+
+
+def _iterate_non_empty_episodes(video_keys: list[VideoKey],
+                                playlist_futures: list[Future[tuple[M3U8, float] | None]],
+                                targets: list[VideoKey] | None) -> Iterator[tuple[_Episode, M3U8, float]]:
+    """
+    Yields the fetched playlists with the ids of the episodes in the fingerprint store
+    in the order of the episodes as soon as each of them is available.
+    """
+    for video_key, future in zip(video_keys, playlist_futures):
+        playlist_and_duration = future.result()
+        if playlist_and_duration is not None:
+            playlist, total_duration = playlist_and_duration
+            episode = _Episode(fingerprint_store.get_episode_id(video_key, playlist),
+                               _is_target(video_key, targets))
+            yield episode, playlist, total_duration
+
 
+def _get_scenes_by_playlists(episodes_iter: Iterator[tuple[_Episode, M3U8, float]], window: int) -> list[Scenes]:
+    """
+    Matches the episodes within the window first and extends it for the episodes without a confident scene.
+    """
+    sir_config = _get_sir_config()
 
-def _get_scenes_by_playlists(playlists_and_durations: list[tuple[M3U8, float]]) -> list[Scenes]:
-    sir_config = SirConfig(series_window=Config.episodes_to_match,
-                           save_intermediate_results=False)
-    openings = _get_openings(playlists_and_durations, sir_config)
-    endings = _get_endings(playlists_and_durations, sir_config)
+    # Filled while the audio provider consumes the playlists, complete once the openings are recognised.
+    playlists_and_durations: list[tuple[M3U8, float]] = []
+    episodes: list[_Episode] = []
+
+    def iterate_episodes() -> Iterator[tuple[str, M3U8]]:
+        for episode, playlist, total_duration in episodes_iter:
+            playlists_and_durations.append((playlist, total_duration))
+            episodes.append(episode)
+            yield episode.episode_id, playlist
+
+    openings, endings = _match_episodes(iterate_episodes(), playlists_and_durations, episodes, window, sir_config)
+    _extend_window(openings, endings, playlists_and_durations, episodes, window, sir_config)
 
     result = []
-    for (_, total_duration), opening, ending in zip(playlists_and_durations, openings, endings):
-        scenes = _combine_scenes(opening, ending, total_duration)
-        rounded_scenes = _round_scenes(scenes)
-        result.append(rounded_scenes)
+    with metrics.timer('fix_up'):
+        for index, (_, total_duration) in enumerate(playlists_and_durations):
+            if index not in openings or index not in endings:
+                # The episode failed to download or there were too few episodes to compare.
+                result.append(Scenes(None, None, None))
+                continue
+
+            scenes = _combine_scenes(openings[index], endings[index], total_duration)
+            rounded_scenes = _round_scenes(scenes)
+            result.append(rounded_scenes)
 
     return result
 
 
+def _match_episodes(episodes_iter: Iterator[tuple[str, M3U8]],
+                    playlists_and_durations: list[tuple[M3U8, float]],
+                    episodes: list[_Episode],
+                    window: int,
+                    sir_config: SirConfig) -> tuple[dict[int, Interval], dict[int, Interval]]:
+    """
+    Matches the episodes within the window of the given seconds of their head and tail.
+    :return: Openings and endings by the indexes of the episodes that were downloaded
+    """
+    # The window is exported to the download workers along with the rest of the configuration.
+    with Config.override({'seconds_to_match': str(window)}):
+        with AudioProvider(episodes_iter) as audio_provider:
+            openings = _get_openings(audio_provider, playlists_and_durations, episodes, sir_config)
+            endings = _get_endings(audio_provider, playlists_and_durations, episodes, sir_config)
+
+    if len(audio_provider.failed_episodes) > 0:
+        logger.warning(f"Episodes failed to download: {audio_provider.failed_episodes}")
+
+    return openings, endings
+
+
+def _extend_window(openings: dict[int, Interval],
+                   endings: dict[int, Interval],
+                   playlists_and_durations: list[tuple[M3U8, float]],
+                   episodes: list[_Episode],
+                   window: int,
+                   sir_config: SirConfig) -> None:
+    """
+    Matches the requested episodes without a confident scene again within an extended window,
+    until all scenes are confident or the window reaches Config.seconds_to_match.
+    The neighbours of these episodes are matched with them as context, the segments downloaded
+    for the previous windows are reused from the segments cache.
+    Updates the openings and the endings in place.
+    """
+    total_durations = [total_duration for _, total_duration in playlists_and_durations]
+    while window < Config.seconds_to_match:
+        unconfident_openings, unconfident_endings = progressive_window.get_unconfident_scenes(
+            openings, endings, total_durations, window)
+        unconfident = sorted(index for index in unconfident_openings | unconfident_endings
+                             if episodes[index].target)
+        if len(unconfident) == 0:
+            return
+
+        next_window = progressive_window.get_next_window(window, len(openings), len(unconfident), openings, endings)
+        logger.info(f"Extending the window from {window}s to {next_window}s for episodes {unconfident}")
+        metrics.count('window_extensions')
+        metrics.count('window_extended_episodes', len(unconfident))
+        window = next_window
+
+        indexes = sorted({neighbour for index in unconfident
+                          for neighbour in range(index - Config.episodes_to_match, index + Config.episodes_to_match + 1)
+                          if neighbour in openings and neighbour in endings})
+        subset_episodes = [episodes[index]._replace(target=index in unconfident) for index in indexes]
+        subset_playlists_and_durations = [playlists_and_durations[index] for index in indexes]
+        subset_iter = ((episode.episode_id, playlist)
+                       for episode, (playlist, _) in zip(subset_episodes, subset_playlists_and_durations))
+        subset_openings, subset_endings = _match_episodes(subset_iter, subset_playlists_and_durations,
+                                                          subset_episodes, window, sir_config)
+
+        for subset_index, index in enumerate(indexes):
+            if index in unconfident_openings and subset_index in subset_openings:
+                openings[index] = subset_openings[subset_index]
+            if index in unconfident_endings and subset_index in subset_endings:
+                endings[index] = subset_endings[subset_index]
+
+
+def _get_sir_config() -> SirConfig:
+    return SirConfig(rate=Config.analysis_sample_rate,
+                     series_window=Config.episodes_to_match,
+                     save_intermediate_results=False)
+
+
+def _try_get_playlist_and_duration(video: DownloadableVideo) -> tuple[m3u8.M3U8, float] | None:
+    """
+    Returns None if the playlist fails to load, so only the episode is skipped instead of the whole batch.
+    """
+    try:
+        return _get_playlist_and_duration(video)
+    except Exception as ex:
+        logger.error(f"Failed to get playlist for video {video.id}: {ex}")
+        metrics.count('failed_playlists')
+        return None
+
+
 def _get_playlist_and_duration(video: DownloadableVideo) -> tuple[m3u8.M3U8, float] | None:
     logger.info(f"Getting playlist for video {video.id}")
-    playlist_content = get_playlist(video)
-    playlist = m3u8.loads(playlist_content)
+    with metrics.timer('playlist_fetch'):
+        playlist_content = get_playlist(video)
+        playlist = m3u8.loads(playlist_content)
+        if playlist.is_variant:
+            playlist = _load_media_playlist(playlist)
     if not playlist.segments:
         logger.warning(f"Skipping video {video.id} because it has no segments")
         return None
@@ -76,32 +360,140 @@ def _get_playlist_and_duration(video: DownloadableVideo) -> tuple[m3u8.M3U8, flo
     return playlist, total_duration
 
 
-def _get_openings(playlists_and_durations: list[tuple[M3U8, float]], sir_config: SirConfig) -> list[Interval]:
-    playlists = [playlist for playlist, _ in playlists_and_durations]
-    wav_processor = AudioProvider(playlists, True)
-    opening_iter = wav_processor.get_iterator()
-    lib_openings = recognise_from_audio_files_with_offsets(opening_iter, sir_config)
-    openings = [Interval(opening.start, opening.end) for opening in lib_openings]
+def _load_media_playlist(master_playlist: M3U8) -> M3U8:
+    """
+    Loads the media playlist with the fewest bytes per second of audio:
+    an audio-only rendition if the master playlist offers one, the lowest bandwidth variant otherwise.
+    """
+    audio_renditions = [media for media in master_playlist.media
+                        if media.type == 'AUDIO' and media.uri]
+    if audio_renditions:
+        rendition = next((media for media in audio_renditions if media.default == 'YES'), audio_renditions[0])
+        uri = rendition.absolute_uri if rendition.base_uri else rendition.uri
+        logger.info(f"Using audio-only rendition {uri}")
+    else:
+        variant = min(master_playlist.playlists, key=lambda stream: stream.stream_info.bandwidth or 0)
+        uri = variant.absolute_uri if variant.base_uri else variant.uri
+        logger.info(f"Using variant {uri} with bandwidth {variant.stream_info.bandwidth}")
+
+    if not urlparse(uri).scheme:
+        logger.warning(f"Cannot resolve relative playlist URI {uri} without a base URI")
+        return M3U8()
+
+    response = requests.get(uri, timeout=30)
+    response.raise_for_status()
+    return m3u8.loads(response.text, uri=uri)
+
+
+def _get_openings(audio_provider: AudioProvider,
+                  playlists_and_durations: list[tuple[M3U8, float]],
+                  episodes: list[_Episode],
+                  sir_config: SirConfig) -> dict[int, Interval]:
+    """
+    :return: Fixed openings by the indexes of the episodes that were downloaded
+    """
+    opening_iter = audio_provider.get_openings_iterator()
+    lib_openings = _recognise(opening_iter, episodes, 'opening', sir_config)
+    openings = [Interval(opening.start, opening.end) for _, opening in lib_openings]
+    downloaded_playlists_and_durations = [playlists_and_durations[index] for index, _ in lib_openings]
 
-    truncated_durations = wav_processor.truncated_durations
-    fixed_openings: list[Interval] = _fix_openings(openings, playlists_and_durations, truncated_durations)
+    truncated_durations = audio_provider.opening_truncated_durations
+    with metrics.timer('fix_up'):
+        fixed_openings: list[Interval] = _fix_openings(openings, downloaded_playlists_and_durations,
+                                                       truncated_durations)
 
-    return fixed_openings
+    return {index: opening for (index, _), opening in zip(lib_openings, fixed_openings)}
 
 
-def _get_endings(playlists_and_durations: list[tuple[M3U8, float]], sir_config: SirConfig) -> list[Interval]:
-    playlists = [playlist for playlist, _ in playlists_and_durations]
-    wav_processor = AudioProvider(playlists, False)
-    ending_iter = wav_processor.get_iterator()
+def _get_endings(audio_provider: AudioProvider,
+                 playlists_and_durations: list[tuple[M3U8, float]],
+                 episodes: list[_Episode],
+                 sir_config: SirConfig) -> dict[int, Interval]:
+    """
+    :return: Fixed endings by the indexes of the episodes that were downloaded
+    """
+    ending_iter = audio_provider.get_endings_iterator()
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        lib_endings = recognise_from_audio_files_with_offsets(ending_iter, sir_config)
-        endings = [Interval(ending.start, ending.end) for ending in lib_endings]
+        lib_endings = _recognise(ending_iter, episodes, 'ending', sir_config)
+        endings = [Interval(ending.start, ending.end) for _, ending in lib_endings]
+    downloaded_playlists_and_durations = [playlists_and_durations[index] for index, _ in lib_endings]
+
+    truncated_durations = audio_provider.ending_truncated_durations
+    with metrics.timer('fix_up'):
+        fixed_endings: list[Interval] = _fix_endings(endings, downloaded_playlists_and_durations,
+                                                     truncated_durations)
+
+    return {index: ending for (index, _), ending in zip(lib_endings, fixed_endings)}
+
+
+def _recognise(audio_iter: Iterator[tuple[int, tuple[str, float, float]]],
+               episodes: list[_Episode],
+               part: fingerprint_store.Part,
+               sir_config: SirConfig) -> list[tuple[int, SirInterval]]:
+    """
+    Passes the audio windows to the recognizer one by one.
+    If the fingerprint store is enabled, the comparisons of the episodes matched before are taken from it.
+    Otherwise, the windows are passed to the library as is.
+    :return: Indexes of the episodes and their intervals in the episodes order
+    """
+    if not fingerprint_store.is_enabled():
+        return _recognise_with_library(audio_iter, sir_config)
+
+    recognizer = IncrementalRecognizer(sir_config, part)
+    indexes: list[int] = []
+    intervals: list[SirInterval] = []
+    for index, audio_window in audio_iter:
+        indexes.append(index)
+        episode_id, target = episodes[index]
+        samples = _load_and_store_samples(audio_window, episode_id, part, sir_config)
+        intervals.extend(interval for _, interval in recognizer.push(samples, episode_id, target))
+    intervals.extend(interval for _, interval in recognizer.finish())
+
+    return list(zip(indexes, intervals))
 
-    truncated_durations = wav_processor.truncated_durations
-    fixed_endings: list[Interval] = _fix_endings(endings, playlists_and_durations, truncated_durations)
 
-    return fixed_endings
+def _recognise_with_library(audio_iter: Iterator[tuple[int, tuple[str, float, float]]],
+                            sir_config: SirConfig) -> list[tuple[int, SirInterval]]:
+    """
+    Recognises the windows with the public functions of the library.
+    Decoded .npy files are memory-mapped and sliced, .wav files are loaded by the library.
+    :return: Indexes of the episodes and their intervals in the episodes order
+    """
+    indexes: list[int] = []
+
+    def iterate_windows() -> Iterator[tuple[str, float, float]]:
+        for index, audio_window in audio_iter:
+            indexes.append(index)
+            yield audio_window
+
+    if Config.streaming_decode:
+        samples_iter = (load_pcm(path, offset, duration, sir_config.rate)
+                        for path, offset, duration in iterate_windows())
+        intervals = recognise_from_audio_samples(samples_iter, sir_config)
+    else:
+        intervals = recognise_from_audio_files_with_offsets(iterate_windows(), sir_config)
+
+    return list(zip(indexes, intervals))
+
+
+def _load_and_store_samples(audio_window: tuple[str, float, float],
+                            episode_id: str,
+                            part: fingerprint_store.Part,
+                            sir_config: SirConfig) -> np.ndarray:
+    """
+    Loads the window of the audio file and keeps it in the fingerprint store for the next batches.
+    Decoded .npy files are memory-mapped and sliced, .wav files are loaded the same way the recognizer does.
+    """
+    path, offset, duration = audio_window
+    with metrics.timer('audio_load'):
+        if path.endswith('.npy'):
+            samples = load_pcm(path, offset, duration, sir_config.rate)
+        else:
+            samples = _load(path, offset, duration, sir_config)
+
+    fingerprint_store.save_window(episode_id, part, samples)
+    return samples
 
 
 def _combine_scenes(opening: Interval, ending: Interval, total_duration: float) -> Scenes:
@@ -132,35 +524,37 @@ def _fix_openings(openings: list[Interval],
     """
     Fix openings by extending them to the beginning or prolonging them to the median duration.
     """
-    fixed_openings: list[Interval] = []
     zipped = list(zip(openings, truncated_durations, playlists_and_durations))
     median_duration = median([opening.end - opening.start for opening, _, _ in zipped])
-    for opening, duration, (_, total_duration) in zipped:
-        if opening.start < Config.scene_after_opening_threshold_secs:
-            # If the beginning of the opening is close to the beginning of the video, extend it.
-            fixed_openings.append(Interval(0, opening.end))
-        elif abs(total_duration - opening.end) < Config.scene_after_opening_threshold_secs:
-            # If the end of the opening is close to the end of the video, extend it to the average duration.
-            fixed_openings.append(Interval(opening.start,
-                                           opening.start + median_duration))
-        else:
-            fixed_openings.append(opening)
+    return [_fix_opening(opening, total_duration, median_duration)
+            for opening, _, (_, total_duration) in zipped]
 
-    return fixed_openings
+
+def _fix_opening(opening: Interval, total_duration: float, median_duration: float) -> Interval:
+    if opening.start < Config.scene_after_opening_threshold_secs:
+        # If the beginning of the opening is close to the beginning of the video, extend it.
+        return Interval(0, opening.end)
+    elif abs(total_duration - opening.end) < Config.scene_after_opening_threshold_secs:
+        # If the end of the opening is close to the end of the video, extend it to the average duration.
+        return Interval(opening.start,
+                        opening.start + median_duration)
+    else:
+        return opening
 
 
 def _fix_endings(endings: list[Interval],
                  playlists_and_durations: list[tuple[M3U8, float]],
                  truncated_durations: list[float]) -> list[Interval]:
-    fixed_endings: list[Interval] = []
     zipped = list(zip(endings, truncated_durations, playlists_and_durations))
-    for ending, duration, (_, total_duration) in zipped:
-        # Endings are truncated from the beginning, so we need to offset them.
-        offset = total_duration - duration
-        fixed_endings.append(Interval(ending.start + offset,
-                                      ending.end + offset))
+    return [_fix_ending(ending, total_duration, duration)
+            for ending, duration, (_, total_duration) in zipped]
+
 
-    return fixed_endings
+def _fix_ending(ending: Interval, total_duration: float, truncated_duration: float) -> Interval:
+    # Endings are truncated from the beginning, so we need to offset them.
+    offset = total_duration - truncated_duration
+    return Interval(ending.start + offset,
+                    ending.end + offset)
 
 
 def _valid_or_none(scene: Interval | None) -> Interval | None:
@@ -0,0 +1,155 @@
+import json
+import logging
+import os
+import uuid
+from typing import Literal, NamedTuple
+from urllib.parse import urlparse
+
+import m3u8
+import numpy as np
+from series_intro_recognizer.config import Config as SirConfig
+from series_intro_recognizer.tp.interval import Interval as SirInterval
+
+from Common.py.models import VideoKey
+from Matcher.config.config import Config
+from Matcher.helpers.disk_cache import DiskCache
+from Matcher.scenes_finder.segment_digests import SegmentDigest
+from Matcher.scenes_finder.segment_ref import get_segment_refs
+
+logger = logging.getLogger(__name__)
+
+type Part = Literal['opening', 'ending']
+
+
+class Comparison(NamedTuple):
+    """Stored result of the comparison of two episodes. intervals is None if they have no common part."""
+    intervals: tuple[SirInterval, SirInterval] | None
+
+
+def is_enabled() -> bool:
+    """The store is disabled if Config.fingerprints_cache_max_bytes is not positive."""
+    return _get_cache().enabled
+
+
+def get_episode_id(video_key: VideoKey, playlist: m3u8.M3U8) -> str:
+    """
+    Identifies the episode by its key and the media of its playlist, so a re-uploaded episode gets a new id.
+    Query strings are ignored because the segment URLs are often signed for each request.
+    """
+    return DiskCache.make_key(str(video_key.my_anime_list_id),
+                              str(video_key.dub),
+                              str(video_key.episode),
+                              *[f'{urlparse(ref.url).path} {ref.duration} {ref.byte_range}'
+                                for ref in get_segment_refs(playlist)])
+
+
+def load_window(episode_id: str, part: Part) -> tuple[str, float] | None:
+    """
+    Restores the analysed audio window of the episode into the temporary directory.
+    :return: Path of the .npy file and the duration of the window or None if it was not stored
+    """
+    path = os.path.join(_get_temp_dir(), f'{episode_id}_{part}.npy')
+    os.makedirs(_get_temp_dir(), exist_ok=True)
+    if not _get_cache().copy_to(_get_window_key(episode_id, part), path):
+        return None
+
+    samples = np.load(path, mmap_mode='r')
+    return path, samples.shape[0] / Config.analysis_sample_rate
+
+
+def save_window(episode_id: str, part: Part, samples: np.ndarray) -> None:
+    """Stores the analysed audio window of the episode unless it is stored already."""
+    cache = _get_cache()
+    key = _get_window_key(episode_id, part)
+    if not cache.enabled or cache.get(key) is not None:
+        return
+
+    os.makedirs(_get_temp_dir(), exist_ok=True)
+    temp_path = os.path.join(_get_temp_dir(), f'{uuid.uuid4().hex}.npy')
+    np.save(temp_path, samples)
+    cache.put(key, temp_path)
+
+
+def get_comparison(part: Part, episode_id1: str, episode_id2: str, cfg: SirConfig) -> Comparison | None:
+    """Returns the stored result of the comparison of two episodes or None if they were not compared yet."""
+    path = _get_cache().get(_get_comparison_key(part, episode_id1, episode_id2, cfg))
+    if path is None:
+        return None
+
+    try:
+        with open(path) as f:
+            intervals = json.load(f)
+    except FileNotFoundError:
+        # The entry was evicted by another process in the meantime.
+        return None
+
+    if intervals is None:
+        return Comparison(None)
+    return Comparison((SirInterval(*intervals[0]), SirInterval(*intervals[1])))
+
+
+def save_comparison(part: Part, episode_id1: str, episode_id2: str, cfg: SirConfig,
+                    intervals: tuple[SirInterval, SirInterval] | None) -> None:
+    cache = _get_cache()
+    if not cache.enabled:
+        return
+
+    os.makedirs(_get_temp_dir(), exist_ok=True)
+    temp_path = os.path.join(_get_temp_dir(), f'{uuid.uuid4().hex}.json')
+    with open(temp_path, 'w') as f:
+        json.dump([list(interval) for interval in intervals] if intervals is not None else None, f)
+    cache.put(_get_comparison_key(part, episode_id1, episode_id2, cfg), temp_path)
+
+
+def load_segment_digests(episode_id: str, part: Part) -> list[SegmentDigest] | None:
+    """Returns the stored digests of the segments of the analysed window or None if they were not stored."""
+    path = _get_cache().get(_get_digests_key(episode_id, part))
+    if path is None:
+        return None
+
+    try:
+        with open(path) as f:
+            return [SegmentDigest(*digest) for digest in json.load(f)]
+    except FileNotFoundError:
+        # The entry was evicted by another process in the meantime.
+        return None
+
+
+def save_segment_digests(episode_id: str, part: Part, digests: list[SegmentDigest]) -> None:
+    cache = _get_cache()
+    if not cache.enabled:
+        return
+
+    os.makedirs(_get_temp_dir(), exist_ok=True)
+    temp_path = os.path.join(_get_temp_dir(), f'{uuid.uuid4().hex}.json')
+    with open(temp_path, 'w') as f:
+        json.dump([list(digest) for digest in digests], f)
+    cache.put(_get_digests_key(episode_id, part), temp_path)
+
+
+def _get_window_key(episode_id: str, part: Part) -> str:
+    return DiskCache.make_key('window',
+                              episode_id,
+                              part,
+                              f'ar={Config.analysis_sample_rate}',
+                              f'sample_format={Config.analysis_sample_format}',
+                              f'seconds={Config.seconds_to_match}')
+
+
+def _get_digests_key(episode_id: str, part: Part) -> str:
+    return DiskCache.make_key('digests', _get_window_key(episode_id, part))
+
+
+def _get_comparison_key(part: Part, episode_id1: str, episode_id2: str, cfg: SirConfig) -> str:
+    return DiskCache.make_key('comparison',
+                              _get_window_key(episode_id1, part),
+                              _get_window_key(episode_id2, part),
+                              repr(cfg))
+
+
+def _get_cache() -> DiskCache:
+    return DiskCache(os.path.join(Config.cache_dir, 'fingerprints'), Config.fingerprints_cache_max_bytes)
+
+
+def _get_temp_dir() -> str:
+    return os.path.join(Config.temp_dir, 'fingerprints')
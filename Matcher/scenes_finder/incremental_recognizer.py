@@ -0,0 +1,138 @@
+import logging
+from typing import Any
+
+import cupy as cp  # type: ignore
+import numpy as np
+from series_intro_recognizer.config import Config as SirConfig
+from series_intro_recognizer.processors.audio_samples import _find_offsets_for_episode, _load_to_gpu_and_normalize
+from series_intro_recognizer.services.best_offset_finder import find_best_offset
+from series_intro_recognizer.services.interval_improver import improve_interval
+from series_intro_recognizer.tp.interval import Interval as SirInterval
+from series_intro_recognizer.tp.tp import GpuFloatArray
+
+from Matcher.config.config import Config
+from Matcher.helpers import metrics
+from Matcher.helpers.not_none import not_none
+from Matcher.scenes_finder import fingerprint_store
+from Matcher.scenes_finder.fingerprint_store import Part
+from Matcher.scenes_finder.segment_digests import SegmentDigest, find_shared_scene
+
+logger = logging.getLogger(__name__)
+
+
+class IncrementalRecognizer:
+    """
+    Sliding-window recognizer that matches the episodes as they are pushed.
+    Makes the same comparisons as recognise_from_audio_samples: each episode is compared
+    with the series_window following ones, so the interval of episode i is final
+    as soon as episode i + series_window is pushed.
+    The results of the comparisons of the identified episodes are reused from the fingerprint store.
+    If Config.segment_digest_matching is set, the episodes that share a single run of segments
+    with the same audio take it as their common part without comparing the audio.
+    Episodes pushed as non-targets only provide context: they are not compared with each other.
+    It relies on private functions of the library, so the batches are matched by it only
+    if the fingerprint store is enabled; the incremental mode always uses it.
+    """
+
+    _cfg: SirConfig
+    _part: Part
+    _window: list[tuple[int, str | None, bool, GpuFloatArray]]
+    _offsets: dict[int, list[SirInterval]]
+    _digests: dict[int, list[SegmentDigest]]
+    _next_index: int = 0
+
+    def __init__(self, cfg: SirConfig, part: Part):
+        self._cfg = cfg
+        self._part = part
+        self._window = []
+        self._offsets = {}
+        self._digests = {}
+
+    def push(self,
+             audio: np.ndarray[Any, np.dtype[Any]],
+             episode_id: str | None = None,
+             target: bool = True) -> list[tuple[int, SirInterval]]:
+        """
+        Compares the audio of the next episode with the previous episodes of the window.
+        :param audio: Audio window of the episode
+        :param episode_id: Id of the episode in the fingerprint store, None to always compare the audio
+        :param target: Whether the interval of the episode is needed or the episode only provides context
+        :return: Indexes and intervals of the episodes that became final, in the episodes order
+        """
+        index = self._next_index
+        self._next_index += 1
+
+        with metrics.timer('recognize', part=self._part):
+            gpu_audio = _load_to_gpu_and_normalize(audio)
+            self._offsets[index] = []
+            if Config.segment_digest_matching and episode_id is not None:
+                digests = fingerprint_store.load_segment_digests(episode_id, self._part)
+                if digests is not None:
+                    self._digests[index] = digests
+            for previous_index, previous_episode_id, previous_target, previous_audio in self._window:
+                if not target and not previous_target:
+                    continue
+
+                result = self._compare(previous_index, previous_episode_id, previous_audio,
+                                       index, episode_id, gpu_audio)
+                if result is None:
+                    continue
+
+                self._offsets[previous_index].append(result[0])
+                self._offsets[index].append(result[1])
+
+            self._window.append((index, episode_id, target, gpu_audio))
+
+            finalized = []
+            while len(self._window) > self._cfg.series_window:
+                finalized.append(self._finalize(self._window.pop(0)[0]))
+
+        return finalized
+
+    def finish(self) -> list[tuple[int, SirInterval]]:
+        """
+        Finalizes the episodes left in the window and releases the GPU memory.
+        A single pushed episode has nothing to be compared with, so it is returned as NaN interval.
+        """
+        with metrics.timer('recognize', part=self._part):
+            finalized = [self._finalize(index) for index, _, _, _ in self._window]
+        self._window.clear()
+        cp.get_default_memory_pool().free_all_blocks()
+
+        return finalized
+
+    def _compare(self,
+                 index1: int, episode_id1: str | None, audio1: GpuFloatArray,
+                 index2: int, episode_id2: str | None, audio2: GpuFloatArray) -> tuple[SirInterval, SirInterval] | None:
+        identified = episode_id1 is not None and episode_id2 is not None
+        if identified:
+            stored = fingerprint_store.get_comparison(self._part, not_none(episode_id1), not_none(episode_id2),
+                                                      self._cfg)
+            if stored is not None:
+                logger.debug('Reusing comparison of %s and %s', index1, index2)
+                metrics.count('stored_comparisons', part=self._part)
+                return stored.intervals
+
+        if index1 in self._digests and index2 in self._digests:
+            shared = find_shared_scene(self._digests[index1], self._digests[index2], self._cfg)
+            if shared is not None:
+                logger.debug('Taking the shared segments of %s and %s', index1, index2)
+                metrics.count('digest_comparisons', part=self._part)
+                # Adjusted to the borders of the windows as the intervals found by comparing the audio.
+                return (improve_interval(shared[0], audio1.shape[0] / self._cfg.rate, self._cfg),
+                        improve_interval(shared[1], audio2.shape[0] / self._cfg.rate, self._cfg))
+
+        logger.info('Processing %s and %s...', index1, index2)
+        metrics.count('comparisons', part=self._part)
+        result = _find_offsets_for_episode(index1, audio1, index2, audio2, self._cfg)
+        if identified:
+            fingerprint_store.save_comparison(self._part, not_none(episode_id1), not_none(episode_id2),
+                                              self._cfg, result)
+
+        return result
+
+    def _finalize(self, index: int) -> tuple[int, SirInterval]:
+        self._digests.pop(index, None)
+        interval = find_best_offset(self._offsets.pop(index), self._cfg)
+        logger.debug('For %s: %.1f, %.1f', index, interval.start, interval.end)
+        return index, interval
@@ -0,0 +1,78 @@
+import math
+from statistics import median
+from typing import Iterable
+
+from Common.py.models import Interval
+from Matcher.config.config import Config
+
+
+def get_initial_window() -> int:
+    """
+    Returns the seconds of the head and the tail of the episodes analysed by the first pass.
+    """
+    if not Config.progressive_matching:
+        return Config.seconds_to_match
+    return min(Config.progressive_initial_secs, Config.seconds_to_match)
+
+
+def get_unconfident_scenes(openings: dict[int, Interval],
+                           endings: dict[int, Interval],
+                           total_durations: list[float],
+                           window: int) -> tuple[set[int], set[int]]:
+    """
+    Returns the indexes of the episodes whose opening and whose ending may lie beyond the analysed window:
+    the scene was not found, touches the inner edge of the window or its duration differs from the batch.
+    """
+    margin = Config.progressive_edge_margin_secs
+    opening_median = _get_median_duration(openings.values())
+    ending_median = _get_median_duration(endings.values())
+
+    unconfident_openings = {index for index, opening in openings.items()
+                            if not _is_consistent(opening, opening_median) or opening.end > window - margin}
+    unconfident_endings = {index for index, ending in endings.items()
+                           if not _is_consistent(ending, ending_median)
+                           or ending.start < total_durations[index] - window + margin}
+    return unconfident_openings, unconfident_endings
+
+
+def get_next_window(window: int,
+                    episodes_count: int,
+                    unconfident_count: int,
+                    openings: dict[int, Interval],
+                    endings: dict[int, Interval]) -> int:
+    """
+    Returns the extended window for the unconfident episodes.
+    If most of the batch agrees on the scenes, the others are likely shifted by a cold open or a recap,
+    so the window grows by the length of a scene. Otherwise, the scenes are not known yet and the window doubles.
+    Without the progressive matching, the window expected by the scene priors falls back to the full one at once.
+    """
+    if not Config.progressive_matching:
+        return Config.seconds_to_match
+
+    if episodes_count > 0 and unconfident_count / episodes_count <= 0.5:
+        scene_duration = max(_get_median_duration(openings.values()) or 0,
+                             _get_median_duration(endings.values()) or 0,
+                             Config.min_scene_length_secs)
+        next_window = window + math.ceil(scene_duration)
+    else:
+        next_window = window * 2
+
+    return min(next_window, Config.seconds_to_match)
+
+
+def _is_consistent(scene: Interval, median_duration: float | None) -> bool:
+    if not _is_found(scene):
+        return False
+    return (median_duration is None
+            or abs(scene.end - scene.start - median_duration) <= Config.progressive_duration_tolerance_secs)
+
+
+def _is_found(scene: Interval) -> bool:
+    return (not math.isnan(scene.start)
+            and not math.isnan(scene.end)
+            and scene.end - scene.start >= Config.min_scene_length_secs)
+
+
+def _get_median_duration(scenes: Iterable[Interval]) -> float | None:
+    durations = [scene.end - scene.start for scene in scenes if _is_found(scene)]
+    return median(durations) if durations else None
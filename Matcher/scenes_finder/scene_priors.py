@@ -0,0 +1,113 @@
+import json
+import logging
+import math
+import os
+import uuid
+from statistics import median
+from typing import NamedTuple
+
+from Common.py.models import VideoKey, Scenes
+from Matcher.config.config import Config
+from Matcher.helpers import metrics
+from Matcher.helpers.disk_cache import DiskCache
+
+logger = logging.getLogger(__name__)
+
+# The window is rounded up, so the next batches of the group get the same window and hit the fingerprint store.
+_WINDOW_STEP_SECS = 30
+_MIN_KNOWN_EPISODES = 2
+
+
+class _KnownScenes(NamedTuple):
+    """Offset of the end of the opening and offset of the start of the ending from the end of the episode."""
+    opening_end: float | None
+    ending_start_from_end: float | None
+
+
+def get_window(video_keys: list[VideoKey]) -> int | None:
+    """
+    Returns the window that covers the scenes known for the other episodes of the title,
+    so only the window around the expected scenes is downloaded.
+    The episodes of the same dub are preferred, the other dubs are used if too few episodes of the dub are known.
+    :return: Seconds of the head and the tail to match or None if the scenes are not known well enough
+    """
+    if not Config.scene_priors or len(video_keys) == 0:
+        return None
+
+    my_anime_list_id, dub = video_keys[0].my_anime_list_id, video_keys[0].dub
+    batch_episodes = {video_key.episode for video_key in video_keys}
+    known_scenes = {key: scenes for key, scenes in _load(my_anime_list_id).items()
+                    if not (key[0] == dub and key[1] in batch_episodes)}
+    same_dub = [scenes for (known_dub, _), scenes in known_scenes.items() if known_dub == dub]
+    known = same_dub if len(same_dub) >= _MIN_KNOWN_EPISODES else list(known_scenes.values())
+
+    opening_ends = [scenes.opening_end for scenes in known if scenes.opening_end is not None]
+    ending_starts = [scenes.ending_start_from_end for scenes in known if scenes.ending_start_from_end is not None]
+    if len(opening_ends) < _MIN_KNOWN_EPISODES or len(ending_starts) < _MIN_KNOWN_EPISODES:
+        return None
+
+    expected = max(median(opening_ends), median(ending_starts)) + Config.scene_prior_margin_secs
+    window = math.ceil(expected / _WINDOW_STEP_SECS) * _WINDOW_STEP_SECS
+    if window >= Config.seconds_to_match:
+        return None
+
+    logger.info(f"Scenes of {my_anime_list_id} are expected within {window}s "
+                f"by {len(known)} known episodes")
+    metrics.count('scene_prior_hits')
+    return window
+
+
+def save_scenes(scenes_by_video: list[tuple[VideoKey, Scenes, float]]) -> None:
+    """
+    Keeps the found scenes of the videos of the same title with the durations of the videos.
+    Concurrent jobs of the title may overwrite each other, which only loses some of the priors.
+    """
+    if not Config.scene_priors or len(scenes_by_video) == 0:
+        return
+
+    my_anime_list_id = scenes_by_video[0][0].my_anime_list_id
+    known_scenes = _load(my_anime_list_id)
+    for video_key, scenes, total_duration in scenes_by_video:
+        if scenes.opening is None and scenes.ending is None:
+            continue
+        known_scenes[(video_key.dub, video_key.episode)] = _KnownScenes(
+            scenes.opening.end if scenes.opening else None,
+            total_duration - scenes.ending.start if scenes.ending else None)
+
+    _save(my_anime_list_id, known_scenes)
+
+
+def _load(my_anime_list_id: int) -> dict[tuple[str, int], _KnownScenes]:
+    path = _get_cache().get(_get_key(my_anime_list_id))
+    if path is None:
+        return {}
+
+    try:
+        with open(path) as f:
+            entries = json.load(f)
+    except FileNotFoundError:
+        # The entry was evicted by another process in the meantime.
+        return {}
+
+    return {(dub, episode): _KnownScenes(opening_end, ending_start_from_end)
+            for dub, episode, opening_end, ending_start_from_end in entries}
+
+
+def _save(my_anime_list_id: int, known_scenes: dict[tuple[str, int], _KnownScenes]) -> None:
+    cache = _get_cache()
+    if not cache.enabled:
+        return
+
+    os.makedirs(Config.temp_dir, exist_ok=True)
+    temp_path = os.path.join(Config.temp_dir, f'{uuid.uuid4().hex}.json')
+    with open(temp_path, 'w') as f:
+        json.dump([[dub, episode, *scenes] for (dub, episode), scenes in known_scenes.items()], f)
+    cache.put(_get_key(my_anime_list_id), temp_path)
+
+
+def _get_key(my_anime_list_id: int) -> str:
+    return DiskCache.make_key('scenes', str(my_anime_list_id))
+
+
+def _get_cache() -> DiskCache:
+    return DiskCache(os.path.join(Config.cache_dir, 'scenes'), Config.scene_priors_cache_max_bytes)
@@ -0,0 +1,148 @@
+import hashlib
+from collections import Counter
+from typing import NamedTuple
+
+from series_intro_recognizer.config import Config as SirConfig
+from series_intro_recognizer.tp.interval import Interval as SirInterval
+
+from Matcher.scenes_finder.segment_ref import SegmentRef, TS_PACKET_SIZE
+
+_TS_SYNC_BYTE = 0x47
+_PES_START_CODE = b'\x00\x00\x01'
+_PRIVATE_STREAM_1 = 0xBD  # AC-3 and other audio streams without their own id
+
+
+class SegmentDigest(NamedTuple):
+    """Digest of the audio of a segment and the position of the segment in the analysed window."""
+    start: float
+    duration: float
+    digest: str
+
+
+def get_digest(data: bytes) -> str:
+    """
+    Hashes the audio payload of the segment.
+    The timestamps and the continuity counters of the containers differ between the episodes,
+    so only the elementary audio streams of MPEG-TS and the media data of fragmented MP4 are hashed.
+    Other segments are hashed as they are.
+    """
+    if len(data) >= TS_PACKET_SIZE and data[0] == _TS_SYNC_BYTE:
+        payload = _get_ts_audio_payload(data)
+    else:
+        payload = _get_mp4_media_data(data)
+    return hashlib.blake2b(payload if payload else data, digest_size=16).hexdigest()
+
+
+def get_window_digests(segments: list[SegmentRef],
+                       digests: list[str],
+                       window_offset: float,
+                       window_duration: float) -> list[SegmentDigest]:
+    """
+    Positions the digests of the downloaded segments in the analysed window.
+    :param segments: Segments of the downloaded range in order, the initialization section is skipped
+    :param window_offset: Offset of the window from the beginning of the range
+    """
+    window_digests: list[SegmentDigest] = []
+    segment_start = -window_offset
+    for segment, digest in zip(segments, digests):
+        start = max(segment_start, 0)
+        end = min(segment_start + segment.duration * segment.fraction, window_duration)
+        segment_start += segment.duration
+        if segment.duration > 0 and end > start:
+            window_digests.append(SegmentDigest(start, end - start, digest))
+
+    return window_digests
+
+
+def find_shared_scene(digests1: list[SegmentDigest],
+                      digests2: list[SegmentDigest],
+                      cfg: SirConfig) -> tuple[SirInterval, SirInterval] | None:
+    """
+    Finds the run of consecutive segments with the same audio in both windows.
+    Segments repeated within a window, such as silence, are not matched.
+    :return: Intervals of the run in both windows or None if there is no single run
+             of the length the recognizer accepts, so the audio has to be compared
+    """
+    repeated = {digest for digests in (digests1, digests2)
+                for digest, count in Counter(segment.digest for segment in digests).items() if count > 1}
+    positions2 = {segment.digest: i for i, segment in enumerate(digests2) if segment.digest not in repeated}
+
+    runs: list[tuple[SirInterval, SirInterval]] = []
+    i = 0
+    while i < len(digests1):
+        j = positions2.get(digests1[i].digest)
+        if j is None:
+            i += 1
+            continue
+
+        length = 1
+        while (i + length < len(digests1) and j + length < len(digests2)
+               and digests1[i + length].digest == digests2[j + length].digest):
+            length += 1
+
+        interval1 = _get_interval(digests1[i:i + length])
+        interval2 = _get_interval(digests2[j:j + length])
+        if cfg.min_segment_length_sec <= interval1.end - interval1.start <= cfg.max_segment_length_sec:
+            runs.append((interval1, interval2))
+        i += length
+
+    return runs[0] if len(runs) == 1 else None
+
+
+def _get_interval(digests: list[SegmentDigest]) -> SirInterval:
+    return SirInterval(digests[0].start, digests[-1].start + digests[-1].duration)
+
+
+def _get_ts_audio_payload(data: bytes) -> bytes:
+    """
+    Concatenates the payloads of the MPEG-TS packets of the audio streams without the PES headers.
+    """
+    audio_pids: set[int] = set()
+    payload = bytearray()
+    for offset in range(0, len(data) - TS_PACKET_SIZE + 1, TS_PACKET_SIZE):
+        packet = data[offset:offset + TS_PACKET_SIZE]
+        if packet[0] != _TS_SYNC_BYTE:
+            break
+
+        payload_unit_start = packet[1] & 0x40
+        pid = ((packet[1] & 0x1F) << 8) | packet[2]
+        adaptation_field_control = (packet[3] >> 4) & 0x3
+        if not adaptation_field_control & 0x1:
+            continue
+        start = 4 + (1 + packet[4] if adaptation_field_control & 0x2 else 0)
+
+        if payload_unit_start and packet[start:start + 3] == _PES_START_CODE and start + 9 <= TS_PACKET_SIZE:
+            stream_id = packet[start + 3]
+            if not (0xC0 <= stream_id <= 0xDF or stream_id == _PRIVATE_STREAM_1):
+                continue
+            audio_pids.add(pid)
+            start += 9 + packet[start + 8]
+        if pid in audio_pids:
+            payload += packet[start:]
+
+    return bytes(payload)
+
+
+def _get_mp4_media_data(data: bytes) -> bytes:
+    """
+    Concatenates the mdat boxes of the fragmented MP4 segment, the moof boxes hold the timestamps.
+    """
+    payload = bytearray()
+    offset = 0
+    while offset + 8 <= len(data):
+        size = int.from_bytes(data[offset:offset + 4], 'big')
+        box_type = data[offset + 4:offset + 8]
+        header_size = 8
+        if size == 1 and offset + 16 <= len(data):
+            size = int.from_bytes(data[offset + 8:offset + 16], 'big')
+            header_size = 16
+        elif size == 0:
+            size = len(data) - offset
+        if size < header_size:
+            return b''
+
+        if box_type == b'mdat':
+            payload += data[offset + header_size:offset + size]
+        offset += size
+
+    return bytes(payload)
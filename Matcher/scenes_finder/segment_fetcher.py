@@ -0,0 +1,198 @@
+import asyncio
+import collections
+import logging
+import math
+import random
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+from urllib.parse import urlparse
+
+from aiohttp import ClientSession, ClientResponse, ClientError
+
+from Matcher.config.config import Config
+from Matcher.helpers import metrics
+from Matcher.scenes_finder.adaptive_limiter import AdaptiveLimiter, Transfer
+from Matcher.scenes_finder.segment_ref import SegmentRef, TS_PACKET_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Number of the latest download times per host used to estimate the tail latency.
+_LATENCY_SAMPLES = 50
+# Hedging starts once this many download times of the host are known.
+_MIN_LATENCY_SAMPLES = 10
+
+# Latest download times by host. Used from the download engine loop only.
+_latencies: dict[str, collections.deque[float]] = {}
+
+
+class IncompleteSegmentError(ClientError):
+    """The connection was closed before the whole segment was received."""
+
+
+async def fetch_segment(session: ClientSession, limiter: AdaptiveLimiter, segment: SegmentRef) -> bytes:
+    """
+    Downloads the segment, retrying failed attempts with jittered exponential backoff.
+    A retry resumes the download from the last received byte.
+    An attempt that takes longer than the usual downloads of the host is hedged with a duplicate request,
+    the first one to finish wins.
+    """
+    received = b''
+    tries = max(Config.download_max_retries_for_ts, 1)
+    for attempt in range(tries):
+        progress = [bytearray(received), bytearray(received)]
+        try:
+            return await _fetch_hedged(session, limiter, segment, progress)
+        except (ClientError, TimeoutError) as e:
+            if attempt + 1 >= tries:
+                metrics.count('segment_errors', host=get_host(segment))
+                raise
+
+            # Every attempt got a prefix of the segment, the longest one is resumed.
+            received = bytes(max(progress, key=len))
+            delay = random.uniform(0, min(Config.download_retry_max_delay_secs,
+                                          Config.download_retry_base_delay_secs * 2 ** attempt))
+            logger.warning(f"Failed to download {segment.url} ({e!r}), retrying in {delay:.1f}s "
+                           f"from byte {len(received)}...")
+            metrics.count('segment_retries', host=get_host(segment))
+            await asyncio.sleep(delay)
+
+    raise AssertionError("Unreachable")
+
+
+def get_host(segment: SegmentRef) -> str:
+    return urlparse(segment.url).hostname or ''
+
+
+async def _fetch_hedged(session: ClientSession,
+                        limiter: AdaptiveLimiter,
+                        segment: SegmentRef,
+                        progress: list[bytearray]) -> bytes:
+    """
+    Runs the primary request and, if it is slow, a hedged one. Each request fills its own progress buffer.
+    Fails only if all started requests fail.
+    """
+    started = asyncio.Event()
+    primary = asyncio.create_task(_fetch_once(session, limiter, segment, progress[0], started))
+    requests = [primary]
+    try:
+        hedge_delay = _get_hedge_delay(get_host(segment))
+        if hedge_delay is not None:
+            # The hedging timer starts when the primary request gets a download slot.
+            slot_acquired = asyncio.create_task(started.wait())
+            await asyncio.wait([primary, slot_acquired], return_when=asyncio.FIRST_COMPLETED)
+            slot_acquired.cancel()
+            if not primary.done():
+                await asyncio.wait([primary], timeout=hedge_delay)
+            if not primary.done():
+                logger.debug(f"Hedging {segment.url} after {hedge_delay:.1f}s")
+                metrics.count('segment_hedges', host=get_host(segment))
+                requests.append(asyncio.create_task(_fetch_once(session, limiter, segment, progress[1])))
+
+        errors: list[BaseException] = []
+        pending = set(requests)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for request in done:
+                error = request.exception()
+                if error is None:
+                    return request.result()
+                errors.append(error)
+
+        raise errors[-1]
+    finally:
+        for request in requests:
+            request.cancel()
+
+
+async def _fetch_once(session: ClientSession,
+                      limiter: AdaptiveLimiter,
+                      segment: SegmentRef,
+                      received: bytearray,
+                      started: asyncio.Event | None = None) -> bytes:
+    """
+    Downloads the rest of the segment after the received bytes and appends it to them.
+    The timeout starts once the request got a download slot, so waiting for the slot is not counted.
+    """
+    async with _download_slot(limiter, segment) as transfer:
+        if started is not None:
+            started.set()
+
+        async with asyncio.timeout(Config.segment_timeout_secs):
+            headers = segment.get_range_header(len(received))
+            async with session.get(segment.url, headers=headers, raise_for_status=True) as response:
+                resumed_from = len(received)
+                async for data in _iterate_segment_content(response, segment, resumed_from):
+                    received.extend(data)
+                transfer.bytes = len(received) - resumed_from
+
+    logger.debug(f"Downloaded {segment.url} ({len(received)} bytes)")
+    return bytes(received)
+
+
+async def _iterate_segment_content(response: ClientResponse,
+                                   segment: SegmentRef,
+                                   received: int) -> AsyncIterator[bytes]:
+    """
+    Yields the bytes of the segment after the received ones.
+    If only a fraction of the segment is needed, the download stops on the first TS packet boundary after it.
+    """
+    offset = segment.byte_range[0] if segment.byte_range is not None else 0
+    if response.status == 206:
+        skip = 0
+        total_length = segment.byte_range[1] if segment.byte_range is not None else (
+            received + response.content_length if response.content_length is not None else None)
+    else:
+        # The server ignored the Range header and sends the whole resource.
+        skip = offset + received
+        total_length = segment.byte_range[1] if segment.byte_range is not None else response.content_length
+
+    limit = total_length
+    if segment.fraction < 1 and total_length is not None:
+        limit = min(total_length, math.ceil(total_length * segment.fraction / TS_PACKET_SIZE) * TS_PACKET_SIZE)
+
+    async for data in response.content.iter_chunked(1024 * 1024):
+        metrics.count('downloaded_bytes', len(data), host=get_host(segment))
+        if skip > 0:
+            skipped = min(skip, len(data))
+            data = data[skipped:]
+            skip -= skipped
+
+        if limit is not None and received + len(data) >= limit:
+            yield data[:limit - received]
+            return
+
+        received += len(data)
+        yield data
+
+    if limit is not None:
+        raise IncompleteSegmentError(f"Received {received} of {limit} bytes of {segment.url}")
+
+
+def _get_hedge_delay(host: str) -> float | None:
+    """
+    Returns the time after which a request is hedged: the 95th percentile of the recent download times of the host.
+    """
+    if not Config.segment_hedging:
+        return None
+
+    latencies = _latencies.get(host)
+    if latencies is None or len(latencies) < _MIN_LATENCY_SAMPLES:
+        return None
+
+    tail = sorted(latencies)[math.ceil(len(latencies) * 0.95) - 1]
+    return max(tail, Config.segment_hedge_min_delay_secs)
+
+
+@asynccontextmanager
+async def _download_slot(limiter: AdaptiveLimiter, segment: SegmentRef) -> AsyncIterator[Transfer]:
+    """
+    Waits for a download slot of the segment host and reports the download to the limiter.
+    The download is measured once it got the slot, so the time reflects the host latency.
+    """
+    host = get_host(segment)
+    async with limiter.acquire(host) as transfer:
+        with metrics.timer('segment_download', host=host):
+            loop = asyncio.get_running_loop()
+            started_at = loop.time()
+            yield transfer
+            _latencies.setdefault(host, collections.deque(maxlen=_LATENCY_SAMPLES)).append(loop.time() - started_at)
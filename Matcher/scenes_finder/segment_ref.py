@@ -0,0 +1,88 @@
+import re
+from typing import NamedTuple
+
+import m3u8
+
+from Matcher.helpers.not_none import not_none
+
+# MPEG-TS streams consist of packets of this size, so a truncated segment is cut on a packet boundary.
+TS_PACKET_SIZE = 188
+
+
+class SegmentRef(NamedTuple):
+    """
+    Reference to the part of a media segment that has to be downloaded.
+    byte_range is (offset, length) of the segment inside the resource if the playlist uses EXT-X-BYTERANGE.
+    fraction is the leading share of the segment that covers the requested window.
+    """
+    url: str
+    duration: float
+    byte_range: tuple[int, int] | None = None
+    fraction: float = 1.0
+
+    def get_cache_key_parts(self) -> list[str]:
+        parts = [self.url]
+        if self.byte_range is not None:
+            parts.append(f'bytes={self.byte_range[0]}+{self.byte_range[1]}')
+        if self.fraction < 1:
+            parts.append(f'fraction={self.fraction:.4f}')
+        return parts
+
+    def get_range_header(self, received: int = 0) -> dict[str, str]:
+        """
+        :param received: Number of the leading bytes of the segment that are already downloaded
+        """
+        if self.byte_range is None:
+            return {'Range': f'bytes={received}-'} if received > 0 else {}
+
+        offset, length = self.byte_range
+        return {'Range': f'bytes={offset + received}-{offset + length - 1}'}
+
+
+def get_segment_refs(playlist: m3u8.M3U8) -> list[SegmentRef]:
+    """
+    Builds references to all segments of the media playlist.
+    Implicit EXT-X-BYTERANGE offsets continue the previous range of the same resource.
+    """
+    refs: list[SegmentRef] = []
+    next_offsets: dict[str, int] = {}
+    for segment in playlist.segments:
+        url = segment.absolute_uri if segment.base_uri else not_none(segment.uri)
+        byte_range = None
+        if segment.byterange:
+            match = re.fullmatch(r'(\d+)(?:@(\d+))?', segment.byterange.strip())
+            if match is None:
+                raise ValueError(f"Invalid byte range: {segment.byterange}")
+            length = int(match.group(1))
+            offset = int(match.group(2)) if match.group(2) is not None else next_offsets.get(url, 0)
+            byte_range = (offset, length)
+            next_offsets[url] = offset + length
+
+        refs.append(SegmentRef(url, not_none(segment.duration), byte_range))
+
+    return refs
+
+
+def get_init_segment_ref(playlist: m3u8.M3U8) -> SegmentRef | None:
+    """
+    Returns the initialization section (EXT-X-MAP) that has to precede the fragmented MP4 segments.
+    """
+    if not playlist.segment_map:
+        return None
+
+    init_section = playlist.segment_map[0]
+    url = init_section.absolute_uri if init_section.base_uri else not_none(init_section.uri)
+    byte_range = None
+    if init_section.byterange:
+        length, _, offset = init_section.byterange.partition('@')
+        byte_range = (int(offset or 0), int(length))
+
+    return SegmentRef(url, 0.0, byte_range)
+
+
+def is_truncatable(playlist: m3u8.M3U8) -> bool:
+    """
+    Returns True if the segments are MPEG-TS and can be cut on a packet boundary.
+    Fragmented MP4 segments (EXT-X-MAP) must be downloaded completely.
+    """
+    return len(playlist.segment_map or []) == 0
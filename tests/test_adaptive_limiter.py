@@ -0,0 +1,62 @@
+import asyncio
+
+from Matcher.config.config import Config
+from Matcher.scenes_finder.adaptive_limiter import AdaptiveLimiter, get_process_budget, get_process_ceiling
+
+
+def _get_peak_concurrency(downloads: int) -> int:
+    limiter = AdaptiveLimiter()
+    active = peak = 0
+
+    async def download() -> None:
+        nonlocal active, peak
+        async with limiter.acquire('cdn.example') as transfer:
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            transfer.bytes = 1024 ** 2
+            active -= 1
+
+    async def run() -> None:
+        await asyncio.gather(*(download() for _ in range(downloads)))
+
+    asyncio.run(run())
+    return peak
+
+
+def test_splits_the_group_budget_between_the_prefetch_workers():
+    Config.initialize_from_dict({})
+    with Config.override({'download_threads': '12', 'prefetch_workers': '3'}):
+        assert get_process_budget() == 4
+    with Config.override({'download_threads': '2', 'prefetch_workers': '4'}):
+        assert get_process_budget() == 1
+
+
+def test_splits_the_ceiling_between_the_workers_of_all_groups():
+    Config.initialize_from_dict({})
+    with Config.override({'download_threads': '4', 'download_threads_max': '48',
+                          'prefetch_workers': '2', 'parallel_groups': '3'}):
+        assert get_process_ceiling() == 8
+    with Config.override({'download_threads': '24', 'download_threads_max': '8', 'prefetch_workers': '1'}):
+        assert get_process_ceiling() == 24
+
+
+def test_keeps_the_static_limit_without_adapting():
+    Config.initialize_from_dict({})
+    with Config.override({'download_threads': '4', 'download_threads_max': '16', 'prefetch_workers': '1',
+                          'adaptive_download_threads': 'false'}):
+        assert _get_peak_concurrency(100) == 4
+
+
+def test_raises_the_limit_above_the_static_one_on_fast_transfers():
+    Config.initialize_from_dict({})
+    with Config.override({'download_threads': '4', 'download_threads_max': '16', 'prefetch_workers': '1',
+                          'parallel_groups': '1', 'adaptive_download_threads': 'true'}):
+        assert 4 < _get_peak_concurrency(400) <= 16
+
+
+def test_keeps_the_concurrency_within_the_share_of_the_worker():
+    Config.initialize_from_dict({})
+    with Config.override({'download_threads': '4', 'download_threads_max': '16', 'prefetch_workers': '2',
+                          'parallel_groups': '1', 'adaptive_download_threads': 'true'}):
+        assert _get_peak_concurrency(400) <= 8
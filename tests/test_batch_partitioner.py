@@ -0,0 +1,56 @@
+from Matcher.helpers.batch_partitioner import partition
+
+
+def test_balances_the_core_sizes():
+    batches = partition(list(range(11)), core_size=4, context_size=1)
+
+    assert [batch.core for batch in batches] == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9, 10]]
+
+
+def test_never_leaves_a_short_tail_with_the_context():
+    batches = partition(list(range(21)), core_size=10, context_size=2)
+
+    assert [len(batch.core) for batch in batches] == [7, 7, 7]
+
+
+def test_merges_the_short_tail_without_the_context():
+    batches = partition(list(range(11)), core_size=10, context_size=0)
+
+    assert len(batches) == 1
+    assert batches[0].core == batches[0].episodes == list(range(11))
+
+
+def test_keeps_at_least_the_batch_size_without_the_context():
+    batches = partition(list(range(39)), core_size=10, context_size=0)
+
+    assert [len(batch.core) for batch in batches] == [13, 13, 13]
+    assert all(batch.episodes == batch.core for batch in batches)
+
+
+def test_extends_the_cores_by_the_context():
+    batches = partition(list(range(11)), core_size=4, context_size=2)
+
+    assert [batch.episodes for batch in batches] == [[0, 1, 2, 3, 4, 5],
+                                                     [2, 3, 4, 5, 6, 7, 8, 9],
+                                                     [6, 7, 8, 9, 10]]
+
+
+def test_covers_every_episode_by_a_single_core():
+    episodes = list(range(37))
+
+    for context_size in (0, 3):
+        batches = partition(episodes, core_size=10, context_size=context_size)
+
+        assert [episode for batch in batches for episode in batch.core] == episodes
+
+
+def test_keeps_a_small_group_in_a_single_batch():
+    for context_size in (0, 5):
+        batches = partition(list(range(3)), core_size=10, context_size=context_size)
+
+        assert len(batches) == 1
+        assert batches[0].core == batches[0].episodes == [0, 1, 2]
+
+
+def test_returns_no_batches_for_no_episodes():
+    assert partition([], core_size=10, context_size=2) == []
@@ -0,0 +1,71 @@
+import os
+import time
+
+from Matcher.helpers.disk_cache import DiskCache
+
+
+def _write(path, size: int) -> str:
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    return str(path)
+
+
+def _put(cache: DiskCache, tmp_path, name: str, size: int, accessed_at: float) -> str:
+    path = cache.put(DiskCache.make_key(name), _write(tmp_path / name, size))
+    os.utime(path, (accessed_at, accessed_at))
+    return path
+
+
+def test_evicts_the_least_recently_used_entries(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache'), max_bytes=250)
+    now = time.time()
+    _put(cache, tmp_path, 'a', 100, now - 30)
+    _put(cache, tmp_path, 'b', 100, now - 20)
+    assert cache.get(DiskCache.make_key('a')) is not None  # Marks 'a' as recently used.
+
+    cache.put(DiskCache.make_key('c'), _write(tmp_path / 'c', 100))
+
+    assert cache.get(DiskCache.make_key('a')) is not None
+    assert cache.get(DiskCache.make_key('b')) is None
+    assert cache.get(DiskCache.make_key('c')) is not None
+
+
+def test_keeps_the_new_entry_over_the_budget(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache'), max_bytes=50)
+    _put(cache, tmp_path, 'a', 40, time.time() - 10)
+
+    path = cache.put(DiskCache.make_key('b'), _write(tmp_path / 'b', 100))
+
+    assert os.path.exists(path)
+    assert cache.get(DiskCache.make_key('a')) is None
+
+
+def test_moves_or_keeps_the_source(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache'), max_bytes=1000)
+    moved = _write(tmp_path / 'moved', 10)
+    kept = _write(tmp_path / 'kept', 10)
+
+    cache.put(DiskCache.make_key('moved'), moved)
+    cache.put(DiskCache.make_key('kept'), kept, keep_source=True)
+
+    assert not os.path.exists(moved)
+    assert os.path.exists(kept)
+
+
+def test_copies_the_entry_over_the_target(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache'), max_bytes=1000)
+    cache.put(DiskCache.make_key('a'), _write(tmp_path / 'a', 10))
+    target = _write(tmp_path / 'target', 3)
+
+    assert cache.copy_to(DiskCache.make_key('a'), target)
+    assert os.path.getsize(target) == 10
+    assert not cache.copy_to(DiskCache.make_key('missing'), str(tmp_path / 'missing'))
+
+
+def test_is_disabled_without_a_budget(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache'), max_bytes=0)
+    source = _write(tmp_path / 'a', 10)
+
+    assert cache.put(DiskCache.make_key('a'), source) == source
+    assert cache.get(DiskCache.make_key('a')) is None
+    assert not os.path.exists(tmp_path / 'cache')
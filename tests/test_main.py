@@ -0,0 +1,56 @@
+from typing import NamedTuple
+
+from Common.py.models import VideoKey
+from Matcher import main
+from Matcher.config.config import Config
+
+
+class _Video(NamedTuple):
+    my_anime_list_id: int
+    dub: str
+    episode: int
+
+
+VIDEOS = [_Video(1, 'Dub', episode) for episode in range(1, 5)]
+KEYS = [VideoKey(1, 'Dub', episode) for episode in range(1, 5)]
+
+
+def _process_batch_incrementally(monkeypatch, iterate_scenes) -> tuple[list[VideoKey], list[VideoKey]]:
+    uploaded: list[VideoKey] = []
+    empty: list[VideoKey] = []
+    monkeypatch.setattr(main, 'iterate_scenes', iterate_scenes)
+    monkeypatch.setattr(main.animan_client, 'update_video_scenes',
+                        lambda request: uploaded.extend(item.video_key for item in request.items))
+    monkeypatch.setattr(main.animan_client, 'upload_empty_scenes', empty.extend)
+
+    Config.initialize_from_dict({})
+    with Config.override({'incremental_matching': 'true'}):
+        main._process_batch(VIDEOS, KEYS, [])
+    return uploaded, empty
+
+
+def test_retries_only_the_videos_not_uploaded_before_the_failure(monkeypatch):
+    attempts: list[list[VideoKey]] = []
+
+    def iterate_scenes(_videos, targets):
+        attempts.append(list(targets))
+        for key in targets:
+            yield key, None
+            if len(attempts) == 1:
+                raise RuntimeError("Download failed")
+
+    uploaded, empty = _process_batch_incrementally(monkeypatch, iterate_scenes)
+
+    assert attempts == [KEYS, KEYS[1:]]
+    assert uploaded == KEYS
+    assert empty == []
+
+
+def test_uploads_empty_scenes_for_the_videos_without_scenes(monkeypatch):
+    def iterate_scenes(_videos, targets):
+        yield targets[0], None
+
+    uploaded, empty = _process_batch_incrementally(monkeypatch, iterate_scenes)
+
+    assert uploaded == KEYS[:1]
+    assert empty == KEYS[1:]
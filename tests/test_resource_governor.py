@@ -0,0 +1,32 @@
+import os
+
+from Matcher.config.config import Config
+from Matcher.helpers import resource_governor
+
+
+def _write(path: str, size: int) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+
+
+def test_measures_only_the_directories_of_the_matcher(tmp_path):
+    Config.initialize_from_dict({})
+    _write(str(tmp_path / 'audio_merger' / 'a.npy'), 100)
+    _write(str(tmp_path / 'jobs' / '0' / 'audio_merger' / 'b.npy'), 10)
+    _write(str(tmp_path / 'cache' / 'segments' / 'c.ts'), 1000)
+    _write(str(tmp_path / 'unrelated' / 'd.bin'), 1000)
+    _write(str(tmp_path / 'e.bin'), 1000)
+
+    with Config.override({'temp_dir': str(tmp_path), 'cache_dir': str(tmp_path / 'cache')}):
+        assert resource_governor.get_temp_disk_bytes() == 110
+
+
+def test_reuses_the_recent_measurement(tmp_path):
+    Config.initialize_from_dict({})
+    with Config.override({'temp_dir': str(tmp_path)}):
+        _write(str(tmp_path / 'intake' / 'a.npy'), 100)
+        assert resource_governor.get_temp_disk_bytes() == 100
+
+        _write(str(tmp_path / 'intake' / 'b.npy'), 100)
+        assert resource_governor.get_temp_disk_bytes() == 100
@@ -0,0 +1,64 @@
+from series_intro_recognizer.config import Config as SirConfig
+
+from Matcher.scenes_finder.segment_digests import SegmentDigest, find_shared_scene, get_digest, get_window_digests
+from Matcher.scenes_finder.segment_ref import SegmentRef
+
+SEGMENT_DURATION = 6.0
+CFG = SirConfig(min_segment_length_sec=30, max_segment_length_sec=150)
+
+
+def _window(*digests: str) -> list[SegmentDigest]:
+    return [SegmentDigest(i * SEGMENT_DURATION, SEGMENT_DURATION, digest) for i, digest in enumerate(digests)]
+
+
+def _scene(length: int) -> list[str]:
+    return [f'scene{i}' for i in range(length)]
+
+
+def test_finds_the_shared_run_in_both_windows():
+    shared = find_shared_scene(_window('a', *_scene(5), 'b'), _window('c', 'd', *_scene(5), 'e'), CFG)
+
+    assert shared is not None
+    interval1, interval2 = shared
+    assert (interval1.start, interval1.end) == (6.0, 36.0)
+    assert (interval2.start, interval2.end) == (12.0, 42.0)
+
+
+def test_ignores_a_run_shorter_than_the_recognizer_accepts():
+    assert find_shared_scene(_window(*_scene(4), 'a'), _window(*_scene(4), 'b'), CFG) is None
+
+
+def test_ignores_a_run_longer_than_the_recognizer_accepts():
+    assert find_shared_scene(_window(*_scene(30), 'a'), _window(*_scene(30), 'b'), CFG) is None
+
+
+def test_ignores_the_segments_repeated_within_a_window():
+    silence = ['silence'] * 6
+
+    assert find_shared_scene(_window('a', *silence), _window('b', *silence), CFG) is None
+
+
+def test_compares_the_audio_if_several_runs_are_shared():
+    first, second = _scene(5), [f'other{i}' for i in range(5)]
+
+    assert find_shared_scene(_window(*first, 'a', *second), _window(*first, 'b', *second), CFG) is None
+
+
+def test_positions_the_digests_in_the_window():
+    segments = [SegmentRef('a.ts', 10.0), SegmentRef('b.ts', 10.0), SegmentRef('c.ts', 10.0, fraction=0.5)]
+
+    digests = get_window_digests(segments, ['a', 'b', 'c'], window_offset=5.0, window_duration=20.0)
+
+    assert digests == [SegmentDigest(0.0, 5.0, 'a'), SegmentDigest(5.0, 10.0, 'b'), SegmentDigest(15.0, 5.0, 'c')]
+
+
+def _box(box_type: bytes, payload: bytes) -> bytes:
+    return (8 + len(payload)).to_bytes(4, 'big') + box_type + payload
+
+
+def test_hashes_only_the_media_data_of_fragmented_mp4():
+    def fragment(sequence: int, audio: bytes) -> bytes:
+        return _box(b'moof', sequence.to_bytes(4, 'big')) + _box(b'mdat', audio)
+
+    assert get_digest(fragment(1, b'audio')) == get_digest(fragment(2, b'audio'))
+    assert get_digest(fragment(1, b'audio')) != get_digest(fragment(1, b'other'))
@@ -0,0 +1,73 @@
+import asyncio
+import re
+
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+
+from Matcher.config.config import Config
+from Matcher.scenes_finder.adaptive_limiter import AdaptiveLimiter
+from Matcher.scenes_finder.segment_fetcher import fetch_segment
+from Matcher.scenes_finder.segment_ref import SegmentRef, TS_PACKET_SIZE
+
+DATA = bytes(i % 251 for i in range(TS_PACKET_SIZE * 10))
+CONFIGURATION = {
+    'download_max_retries_for_ts': '3',
+    'download_retry_base_delay_secs': '0',
+    'segment_hedging': 'false',
+    'segment_timeout_secs': '10',
+}
+
+
+def _fetch(segment_path: str, handler, byte_range: tuple[int, int] | None = None, fraction: float = 1.0) -> bytes:
+    async def run() -> bytes:
+        app = web.Application()
+        app.router.add_get(segment_path, handler)
+        async with TestServer(app) as server, ClientSession() as session:
+            segment = SegmentRef(str(server.make_url(segment_path)), 10.0, byte_range, fraction)
+            return await fetch_segment(session, AdaptiveLimiter(), segment)
+
+    Config.initialize_from_dict({})
+    with Config.override(CONFIGURATION):
+        return asyncio.run(run())
+
+
+def _get_range(request: web.Request) -> tuple[int, int]:
+    match = re.fullmatch(r'bytes=(\d+)-(\d*)', request.headers.get('Range', 'bytes=0-'))
+    assert match is not None
+    return int(match.group(1)), int(match.group(2)) + 1 if match.group(2) else len(DATA)
+
+
+def test_resumes_the_broken_download_from_the_received_bytes():
+    ranges: list[str | None] = []
+
+    async def handler(request: web.Request) -> web.StreamResponse:
+        ranges.append(request.headers.get('Range'))
+        start, end = _get_range(request)
+        response = web.StreamResponse(status=206 if 'Range' in request.headers else 200)
+        response.content_length = end - start
+        await response.prepare(request)
+        if len(ranges) == 1:
+            await response.write(DATA[start:start + 940])
+            request.transport.close()
+            return response
+        await response.write(DATA[start:end])
+        return response
+
+    assert _fetch('/a.ts', handler) == DATA
+    assert ranges == [None, 'bytes=940-']
+
+
+def test_cuts_the_byte_range_out_of_the_whole_resource():
+    async def handler(_request: web.Request) -> web.Response:
+        # The server ignores the Range header.
+        return web.Response(body=DATA)
+
+    assert _fetch('/a.ts', handler, byte_range=(376, 564)) == DATA[376:940]
+
+
+def test_downloads_the_fraction_up_to_the_packet_boundary():
+    async def handler(request: web.Request) -> web.Response:
+        start, end = _get_range(request)
+        return web.Response(status=206, body=DATA[start:end])
+
+    assert _fetch('/a.ts', handler, byte_range=(0, len(DATA)), fraction=0.45) == DATA[:TS_PACKET_SIZE * 5]
@@ -0,0 +1,61 @@
+import m3u8
+import pytest
+
+from Matcher.scenes_finder.segment_ref import SegmentRef, get_init_segment_ref, get_segment_refs
+
+BASE_URI = 'https://cdn.example/video/'
+
+
+def _load(*lines: str) -> m3u8.M3U8:
+    return m3u8.loads('\n'.join(['#EXTM3U', '#EXT-X-VERSION:4', '#EXT-X-TARGETDURATION:10', *lines,
+                                 '#EXT-X-ENDLIST']), uri=f'{BASE_URI}index.m3u8')
+
+
+def test_resolves_the_segment_urls():
+    refs = get_segment_refs(_load('#EXTINF:10.0,', 'a.ts', '#EXTINF:4.5,', 'https://other.example/b.ts'))
+
+    assert refs == [SegmentRef(f'{BASE_URI}a.ts', 10.0), SegmentRef('https://other.example/b.ts', 4.5)]
+
+
+def test_continues_implicit_offsets_of_the_same_resource():
+    refs = get_segment_refs(_load('#EXTINF:10.0,', '#EXT-X-BYTERANGE:1000@500', 'a.ts',
+                                  '#EXTINF:10.0,', '#EXT-X-BYTERANGE:2000', 'a.ts',
+                                  '#EXTINF:10.0,', '#EXT-X-BYTERANGE:300', 'b.ts',
+                                  '#EXTINF:10.0,', '#EXT-X-BYTERANGE:400', 'a.ts'))
+
+    assert [ref.byte_range for ref in refs] == [(500, 1000), (1500, 2000), (0, 300), (3500, 400)]
+
+
+def test_builds_the_range_headers():
+    whole = SegmentRef(f'{BASE_URI}a.ts', 10.0)
+    ranged = SegmentRef(f'{BASE_URI}a.ts', 10.0, (500, 1000))
+
+    assert whole.get_range_header() == {}
+    assert whole.get_range_header(received=100) == {'Range': 'bytes=100-'}
+    assert ranged.get_range_header() == {'Range': 'bytes=500-1499'}
+    assert ranged.get_range_header(received=100) == {'Range': 'bytes=600-1499'}
+
+
+def test_separates_the_cache_keys_of_the_ranges():
+    first = SegmentRef(f'{BASE_URI}a.ts', 10.0, (0, 1000))
+    second = SegmentRef(f'{BASE_URI}a.ts', 10.0, (1000, 1000))
+    truncated = first._replace(fraction=0.5)
+
+    keys = {tuple(ref.get_cache_key_parts()) for ref in (first, second, truncated)}
+
+    assert len(keys) == 3
+
+
+def test_rejects_an_invalid_byte_range():
+    playlist = _load('#EXTINF:10.0,', 'a.ts')
+    playlist.segments[0].byterange = 'invalid'
+
+    with pytest.raises(ValueError):
+        get_segment_refs(playlist)
+
+
+def test_reads_the_initialization_section():
+    playlist = _load('#EXT-X-MAP:URI="init.mp4",BYTERANGE="720@0"', '#EXTINF:10.0,', 'a.m4s')
+
+    assert get_init_segment_ref(playlist) == SegmentRef(f'{BASE_URI}init.mp4', 0.0, (0, 720))
+    assert get_init_segment_ref(_load('#EXTINF:10.0,', 'a.ts')) is None